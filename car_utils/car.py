@@ -2,7 +2,7 @@ import json
 import threading
 
 from car_utils.hardware import PIMachine
-from car_utils.motor import DCMotorController, DCMotor, ServoMotor
+from car_utils.motor import DCMotorController, DCMotor, ServoMotor, Direction, State
 
 GPIO_PIN_DISTRIBUTION_PATH = "gpio_pin_distribution.json"
 
@@ -124,6 +124,15 @@ class Car():
         """
         self.gyroscope_servo_motors["horizontal"].change_degree(-1 * self.horizontal_change_value)
 
+    def move_camera(self, right: float, up: float):
+        """
+        Turn camera gyroscope by a given number of degrees.
+        :param right: degrees to turn right, negative to turn left.
+        :param up: degrees to turn up, negative to turn down.
+        """
+        self.gyroscope_servo_motors["vertical"].change_degree(right)
+        self.gyroscope_servo_motors["horizontal"].change_degree(up)
+
     def reset_camera_position(self):
         """
         Reset camera gyroscope position to its initial position.
@@ -131,6 +140,26 @@ class Car():
         for name, motor in self.gyroscope_servo_motors.items():
             motor.reset()
 
+    def get_drive_state(self):
+        """
+        :return: {field: value} of every wheel motor: "wheels.<group>.<name>.rotating" 1 or 0, ".direction" 1 forward
+        or -1 backward, ".speed" pwm duty cycle.
+        """
+        state = {}
+        for wheel_group, wheel_motors in self.wheel_DC_motors.items():
+            for wheel_motor_name, wheel_motor_object in wheel_motors.items():
+                field = f"wheels.{wheel_group}.{wheel_motor_name}"
+                state[f"{field}.rotating"] = 1 if wheel_motor_object.state == State.Rotate else 0
+                state[f"{field}.direction"] = 1 if wheel_motor_object.direction == Direction.Forward else -1
+                state[f"{field}.speed"] = DCMotor.speed_pwm[wheel_motor_object.speed.name.upper()]
+        return state
+
+    def get_camera_state(self):
+        """
+        :return: {field: value} of the camera gyroscope: "camera.<name>.degree" degree of every servo motor.
+        """
+        return {f"camera.{name}.degree": motor.degree for name, motor in self.gyroscope_servo_motors.items()}
+
     def __initialize_wheel_controllers(self):
         """
         Initialize the DCMotor controllers used to control the wheels DC motors.
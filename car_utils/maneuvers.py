@@ -0,0 +1,177 @@
+import collections
+import threading
+import time
+
+# Condition.wait wakes up late by up to a scheduler tick, so the last stretch before a step is waited by yielding.
+SPIN_TIME = 0.002
+SWEEP_STEP_TIME = 0.02
+
+
+class ManeuverScheduler:
+    """
+    Runs timed maneuvers on the car, such as turning for some milliseconds, against time.monotonic().
+    Every maneuver runs on an axis, and starting a maneuver on an axis replaces the one running there. Steps run on the
+    scheduler thread while holding lock, and start and cancel must be called with lock held, so a cancelled maneuver
+    never runs another step.
+    """
+
+    def __init__(self, lock):
+        """
+        Initialize ManeuverScheduler object and start its thread.
+        :param lock: lock held while running steps, car.lock
+        """
+        self.lock = lock
+        self.condition = threading.Condition()
+        # {axis: deque of (deadline, function)}
+        self.maneuvers = {}
+        self.started_maneuvers = 0
+        self.replaced_maneuvers = 0
+        self.cancelled_maneuvers = 0
+        self.completed_maneuvers = 0
+        self.executed_steps = 0
+        self.total_late_time = 0.0
+        self.max_late_time = 0.0
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def start(self, axis, steps):
+        """
+        Start a maneuver, replacing the one running on its axis. Steps due right away are run before returning, so
+        steps that are all due right away are a plain command, which cancels the running maneuver.
+        Must be called with lock held.
+        :param axis: name of the axis, such as "drive" or "camera"
+        :param steps: list of (seconds from now, function), sorted by time
+        """
+        start_time = time.monotonic()
+        due_steps = [function for offset, function in steps if offset <= 0]
+        later_steps = collections.deque((start_time + offset, function) for offset, function in steps if offset > 0)
+        self.condition.acquire()
+        if self.maneuvers.pop(axis, None) is not None:
+            if later_steps:
+                self.replaced_maneuvers += 1
+            else:
+                self.cancelled_maneuvers += 1
+        if later_steps:
+            self.started_maneuvers += 1
+            self.maneuvers[axis] = later_steps
+            self.condition.notify()
+        self.condition.release()
+        for function in due_steps:
+            function()
+
+    def cancel(self, axis):
+        """
+        Cancel the maneuver running on an axis, leaving the car as its last step left it. Must be called with lock held.
+        :param axis: name of the axis
+        """
+        self.condition.acquire()
+        if self.maneuvers.pop(axis, None) is not None:
+            self.cancelled_maneuvers += 1
+        self.condition.release()
+
+    def get_counters(self):
+        """
+        :return: {"started", "replaced", "cancelled", "completed": maneuver counters, "steps": steps run,
+        "average_late_ms", "max_late_ms": how late the steps ran}
+        """
+        return {"started": self.started_maneuvers, "replaced": self.replaced_maneuvers,
+                "cancelled": self.cancelled_maneuvers, "completed": self.completed_maneuvers,
+                "steps": self.executed_steps,
+                "average_late_ms": round(self.total_late_time / max(self.executed_steps, 1) * 1000, 3),
+                "max_late_ms": round(self.max_late_time * 1000, 3)}
+
+    def close(self):
+        """
+        Stop the thread. Running maneuvers are dropped.
+        """
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+        self.thread.join()
+
+    def run(self):
+        """
+        Run the steps of the maneuvers when they are due, until closed.
+        """
+        while True:
+            self.condition.acquire()
+            try:
+                next_step = self.__wait_for_step()
+            except Exception as e:
+                # A step that can't be waited for is dropped with its maneuver, so it never stops the thread and the
+                # later maneuvers still run.
+                print(f"[Log] - Dropping maneuver: {e}")
+                self.__drop_next_maneuver()
+                continue
+            finally:
+                self.condition.release()
+            if next_step is None:
+                return
+
+            deadline, axis, steps = next_step
+            while time.monotonic() < deadline:
+                time.sleep(0)
+            self.lock.acquire()
+            try:
+                self.condition.acquire()
+                # The maneuver may have been replaced or cancelled while waiting for the lock.
+                is_current = self.maneuvers.get(axis) is steps and steps[0][0] == deadline
+                if is_current:
+                    function = steps.popleft()[1]
+                    if not steps:
+                        self.maneuvers.pop(axis)
+                        self.completed_maneuvers += 1
+                self.condition.release()
+                if is_current:
+                    late_time = time.monotonic() - deadline
+                    function()
+                    self.executed_steps += 1
+                    self.total_late_time += late_time
+                    self.max_late_time = max(self.max_late_time, late_time)
+            except Exception as e:
+                print(e)
+            finally:
+                self.lock.release()
+
+    def __wait_for_step(self):
+        """
+        Wait until a step is due or the scheduler is closed. Must be called with self.condition held.
+        :return: (deadline, axis, steps of the maneuver) of the step, None once closed.
+        """
+        while self.running:
+            next_step = min(((steps[0][0], axis, steps) for axis, steps in self.maneuvers.items()), default=None,
+                            key=lambda step: step[0])
+            if next_step is None:
+                self.condition.wait()
+                continue
+            remaining = next_step[0] - time.monotonic()
+            if remaining <= SPIN_TIME:
+                return next_step
+            self.condition.wait(remaining - SPIN_TIME)
+        return None
+
+    def __drop_next_maneuver(self):
+        """
+        Drop the maneuver with the earliest step. Must be called with self.condition held.
+        """
+        next_step = min(((steps[0][0], axis) for axis, steps in self.maneuvers.items()), default=None,
+                        key=lambda step: step[0])
+        if next_step is not None:
+            self.maneuvers.pop(next_step[1])
+            self.cancelled_maneuvers += 1
+
+
+def get_sweep_steps(move, right: float, up: float, duration: float):
+    """
+    Split a camera move into steps of SWEEP_STEP_TIME, so the camera moves smoothly instead of jumping.
+    :param move: function called with (right degrees, up degrees) for every step, car.move_camera
+    :param right: degrees to move right in total
+    :param up: degrees to move up in total
+    :param duration: How long the move takes, in seconds.
+    :return: steps for ManeuverScheduler.start
+    """
+    step_count = max(1, round(duration / SWEEP_STEP_TIME))
+    return [(duration * index / step_count, lambda: move(right / step_count, up / step_count))
+            for index in range(1, step_count + 1)]
@@ -16,7 +16,8 @@ class Speed(Enum):
     Motor speed level
     """
     Low = 1,
-    High = 2
+    High = 2,
+    Medium = 3
 
 
 class State(Enum):
@@ -64,7 +65,8 @@ class ServoMotor(Component):
         """
         Reset motor to initial degree
         """
-        self.__set_degree(self.initial_degree)
+        self.degree = self.initial_degree
+        self.__set_degree(self.degree)
 
     def initialize_pins(self):
         """
@@ -151,27 +153,29 @@ class DCMotor(Component):
         # print(self.gpio_pins)
         self.initialize_pins()
 
-    def go_forward(self, speed: Speed = Speed.High):
+    def go_forward(self, speed: Speed = None):
         """
         Make motor spin forward
-        :param speed: Set spin speed
+        :param speed: Set spin speed, None to keep the current speed.
         :return:
         """
         self.state = State.Rotate
         self.direction = Direction.Forward
-        self.speed = speed
+        if speed is not None:
+            self.speed = speed
         self.update_in_pin(self.gpio_pins_dict["in1"], InPinState.HIGH)
         self.update_in_pin(self.gpio_pins_dict["in2"], InPinState.LOW)
 
-    def go_backwards(self, speed: Speed = Speed.High):
+    def go_backwards(self, speed: Speed = None):
         """
         Make motor spin backwards
-        :param speed: Set spin speed
+        :param speed: Set spin speed, None to keep the current speed.
         :return:
         """
         self.state = State.Rotate
         self.direction = Direction.Backward
-        self.speed = speed
+        if speed is not None:
+            self.speed = speed
         self.update_in_pin(self.gpio_pins_dict["in1"], InPinState.LOW)
         self.update_in_pin(self.gpio_pins_dict["in2"], InPinState.HIGH)
 
@@ -179,9 +183,7 @@ class DCMotor(Component):
         """
         Make motor stop.
         """
-        self.state = State.Rotate
-        # self.direction = Direction
-        # self.speed = speed
+        self.state = State.Stop
         self.update_in_pin(self.gpio_pins_dict["in1"], InPinState.HIGH)
         self.update_in_pin(self.gpio_pins_dict["in2"], InPinState.HIGH)
 
@@ -189,18 +191,21 @@ class DCMotor(Component):
         """
         Set speed to low
         """
+        self.speed = Speed.Low
         self.update_pwm(self.gpio_pins_dict["en"], 25)
 
     def medium_speed(self):
         """
         Set speed to medium
         """
+        self.speed = Speed.Medium
         self.update_pwm(self.gpio_pins_dict["en"], 50)
 
     def high_speed(self):
         """
         Set speed to high
         """
+        self.speed = Speed.High
         self.update_pwm(self.gpio_pins_dict["en"], 75)
 
     def initialize_pins(self):
@@ -1,4 +1,5 @@
 import sys
+import threading
 from enum import Enum
 
 import pygame
@@ -27,10 +28,14 @@ class Commands(Enum):
     TOGGLE_DISTANCE = None
     RESET_CAMERA_POSITION = PICommunication.reset_camera_position()
     STOP = PICommunication.stop()
+    TAKE_CONTROL = PICommunication.take_control()  # = Drive the car, if no other client does
+    RELEASE_CONTROL = PICommunication.release_control()  # = Let another client drive the car
 
 class Gui:
     UPPER_BORDER = 0.7
     LOWER_BORDER = -0.7
+    CAR_STATE_POSITION = (10, 10)
+    CAR_STATE_LINE_HEIGHT = 18
 
     def __init__(self):
         """
@@ -70,6 +75,9 @@ class Gui:
             self.axes = {"left_horizontal": 0, "left_vertical": 1, "right_horizontal": 3, "right_vertical": 4}
             self.buttons = {"start": 8, 'Y': 3, 'X': 2, 'B': 1, 'A': 0}
 
+        self.car_state = {}
+        self.car_state_lock = threading.Lock()
+        self.font = pygame.font.SysFont(None, 22)
 
     def get_events(self):
         """
@@ -151,6 +159,10 @@ class Gui:
                     commands.append(Commands.TOGGLE_DISTANCE)
                 elif event.button == self.buttons["Y"]:
                     commands.append(Commands.RESET_CAMERA_POSITION)
+                elif event.button == self.buttons["A"]:
+                    commands.append(Commands.TAKE_CONTROL)
+                elif event.button == self.buttons["B"]:
+                    commands.append(Commands.RELEASE_CONTROL)
                 elif event.button == 4:
                     commands.append(Commands.TOGGLE_DEPTH_MAP)
                 elif event.button == 5:
@@ -163,6 +175,29 @@ class Gui:
 
         return commands
 
+    def set_car_state(self, changes, state):
+        """
+        Listener of CarStateReceiver, keeps the state to draw on the next frame.
+        :param changes: {field name: value} of the fields that changed
+        :param state: {field name: value} of every field
+        """
+        self.car_state_lock.acquire()
+        self.car_state = state
+        self.car_state_lock.release()
+
+    def draw_car_state(self):
+        """
+        Draw the car state pushed by the server in the top left corner of the screen.
+        """
+        self.car_state_lock.acquire()
+        state = self.car_state
+        self.car_state_lock.release()
+        x, y = Gui.CAR_STATE_POSITION
+        for name, value in sorted(state.items()):
+            text = self.font.render(f"{name}: {value:g}", True, (0, 0, 0), (255, 255, 255))
+            self.screen.blit(text, (x, y))
+            y += Gui.CAR_STATE_LINE_HEIGHT
+
 
 def main():
     gui = Gui()
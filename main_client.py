@@ -14,9 +14,16 @@ from gui import Gui, Commands
 from image_processing.distance import DistanceCalculator2
 from image_processing.object_detection import ObjectDetector, DetectionResult
 from image_processing.stereo import StereoDepthMap
+from network.car_state import CarStateReceiver
+from network.channel import MODE_LATEST, Channel
+from network.command_sender import CommandSender
 from network.communication import TCPStream
 from network.protocol import PICommunication
-from network.stream_receiver import StreamReceiver
+from network.socket_profiles import PROFILE_BULK_VIDEO, PROFILE_LOW_LATENCY_CONTROL, apply_socket_profile, \
+    get_socket_profile
+from network.stream_receiver import StreamReceiver, split_stereo_frame
+from network.telemetry import ControlTelemetry
+from network.udp_control import create_udp_control_sender
 from try_distance import DistanceCalculator3
 
 CUTOFF = 50
@@ -37,35 +44,42 @@ tl - turn left\n
 q - back to main menu\n"""
 CONFIDENCE = 0.75
 CONSTANTS_PATH = "constants.json"
+CONTROL_SOCKET_PROFILE = None
 DESTINATION_SIZE = (640, 480)
 FPS = 24
 LOCK = threading.Lock()
 MAIN_TCP_SERVER_ADDRESS = ("192.168.1.35", 10001)
+RECONNECT_ATTEMPTS = 50
+RECONNECT_INTERVAL = 0.05
 MAIN_MENU_TEXT = """
 [1] Control car movement\n
 [2] Choose stream source\n
 [3] Exit\n"""
 # STREAM_FRAME_SHAPE = (192, 256, 3)
 STEREO_CALIBRATION_FILE = "image_processing/calibration/stereo_cam.yml"
+# (width, height) of the frames STEREO_CALIBRATION_FILE was calibrated with.
+STEREO_CALIBRATION_SIZE = (640, 480)
 STREAM_FRAME_SHAPE = (192, 256, 3)
 STREAM_FRAME_GRID_ROWS = 4
 STREAM_FRAME_GRID_COLUMNS = 4
 # RECEIVERS = {}
 RUNNING = True
 THREADS = []
-FRAME_QUEUE = []
-DEPTH_MAP_QUEUE = []
+# Depth maps are computed from the latest pair of frames only, so they never lag behind the stream.
+STEREO_FRAMES = Channel("stereo frames", MODE_LATEST)
+DEPTH_MAPS = Channel("depth maps", MODE_LATEST)
 BACKGROUND_COLOR = (255, 255, 255)
 SCREEN_DIMENSIONS = [1600, 800]
 
 
 def initialize_receivers(constants):
     global RECEIVERS
-    receiver1 = StreamReceiver('0.0.0.0', 5000)
+    video_socket_profile = get_socket_profile(constants, PROFILE_BULK_VIDEO)
+    receiver1 = StreamReceiver('0.0.0.0', 5000, video_socket_profile)
     t1 = threading.Thread(target=receiver1.receive_stream)
     t1.start()
 
-    receiver2 = StreamReceiver('0.0.0.0', 5001)
+    receiver2 = StreamReceiver('0.0.0.0', 5001, video_socket_profile)
     t2 = threading.Thread(target=receiver2.receive_stream)
     t2.start()
 
@@ -76,22 +90,37 @@ def initialize_receivers(constants):
     return receiver1, receiver2, t1, t2
 
 
+def receive_frames(receiver1, receiver2, stereo_layout=None):
+    """
+    :param receiver1: StreamReceiver of the left camera, or of both cameras in stereo mode
+    :param receiver2: StreamReceiver of the right camera
+    :param stereo_layout: layout of the frames of the stereo stream, None if the cameras stream separately
+    :return: new left frame, new right frame, None for a camera without a new frame. In stereo mode both come
+    together, taken at the same moment.
+    """
+    left_frame = receiver1.frames.get_nowait()
+    if stereo_layout is None:
+        return left_frame, receiver2.frames.get_nowait()
+    if left_frame is None:
+        return None, None
+    return split_stereo_frame(left_frame, stereo_layout)
+
+
 def create_depth_map():
     depth_map_obj = StereoDepthMap(STEREO_CALIBRATION_FILE)
     while RUNNING:
-        ret = False
-        if len(FRAME_QUEUE) > 2:
-            LOCK.acquire()
-            not_used = FRAME_QUEUE.pop(0)
-            not_used2 = FRAME_QUEUE.pop(0)
-            left_frame, right_frame = FRAME_QUEUE.pop(0)
-            ret = True
-            LOCK.release()
-        if ret:
+        frames = STEREO_FRAMES.get(timeout=0.5)
+        if frames is not None:
+            left_frame, right_frame = frames
+            # The streams adapt their resolution, but the frames are rectified with the matrices of the calibration,
+            # which only fit frames of the calibrated size.
+            if (left_frame.shape[1], left_frame.shape[0]) != STEREO_CALIBRATION_SIZE:
+                left_frame = cv2.resize(left_frame, STEREO_CALIBRATION_SIZE)
+            if (right_frame.shape[1], right_frame.shape[0]) != STEREO_CALIBRATION_SIZE:
+                right_frame = cv2.resize(right_frame, STEREO_CALIBRATION_SIZE)
             depth_map = depth_map_obj.get_depth_image(left_frame, right_frame)
-            DEPTH_MAP_QUEUE.append(depth_map)
+            DEPTH_MAPS.put(depth_map)
         # cv2.waitKey(1)
-        time.sleep(1.0 / 60)
     # return
     # sys.exit()
 
@@ -173,9 +202,8 @@ def put_results_on_frame(frame, results):
             i += 1
 
 
-def handle_stream(constants, screen):
+def handle_stream(constants, screen, gui_object=None):
     global THREADS
-    global FRAME_QUEUE
 
     depth_map_thread = threading.Thread(target=create_depth_map)
     depth_map_thread.start()
@@ -187,6 +215,7 @@ def handle_stream(constants, screen):
     distance_calculator = DistanceCalculator3()
     # distance_calculator = DistanceCalculator()
     receiver1, receiver2, receiver_thread_1, receiver_thread_2 = initialize_receivers(constants)
+    stereo_layout = constants.get("video", {}).get("stereo_layout") or None
     detector = ObjectDetector("image_processing/", CONFIDENCE)
     left_results = []
     right_results = []
@@ -197,37 +226,29 @@ def handle_stream(constants, screen):
 
         LOCK.acquire()
 
+        received_left_frame, received_right_frame = receive_frames(receiver1, receiver2, stereo_layout)
+
         # Get left frame
-        if receiver1.frame_queue:
-            left_ret = True
-            # LOCK.acquire()
-            left_frame = receiver1.frame_queue.pop(0)
-            # LOCK.release()
+        left_ret = received_left_frame is not None
+        if left_ret:
+            left_frame = received_left_frame
             frame, left_results = detector.detect(left_frame)
 
-        else:
-            left_ret = False
-
         # Get right frame
-        if receiver2.frame_queue:
-            right_ret = True
-            # LOCK.acquire()
-            right_frame = receiver2.frame_queue.pop(0)
-            # LOCK.release()
+        right_ret = received_right_frame is not None
+        if right_ret:
+            right_frame = received_right_frame
             frame, right_results = detector.detect(right_frame)
 
-        else:
-            right_ret = False
-
         # Handle stereo cases
         if left_ret and right_ret:
 
             # Create depth map
             # LOCK.acquire()
-            FRAME_QUEUE.append((left_frame, right_frame))
-            if DEPTH_MAP_QUEUE:
+            STEREO_FRAMES.put((left_frame, right_frame))
+            depth_map = DEPTH_MAPS.get_nowait()
+            if depth_map is not None:
                 if RUNNING:
-                    depth_map = DEPTH_MAP_QUEUE.pop(0)
                     depth_map_size = (300, 225)
                     blit_frame(screen, depth_map, depth_map_size, ((SCREEN_DIMENSIONS[0] - depth_map_size[0]) / 2, 550))
                 else:
@@ -250,6 +271,8 @@ def handle_stream(constants, screen):
                 put_results_on_frame(right_frame, right_results)
             right_frame_size = (640, 480)
             blit_frame(screen, right_frame, right_frame_size, (SCREEN_DIMENSIONS[0] / 2 - right_frame_size[0], 50))
+        if gui_object is not None:
+            gui_object.draw_car_state()
 
         pygame.display.flip()
         try:
@@ -269,30 +292,71 @@ def handle_stream(constants, screen):
     receiver_thread_1.join()
     receiver_thread_2.join()
     depth_map_thread.join()
+    for channel in (receiver1.frames, receiver2.frames, STEREO_FRAMES, DEPTH_MAPS):
+        print(f"[Log] Channel {channel.name}: {channel.get_counters()}")
+    print("[Log] Stream reassembly: ", receiver1.get_counters(), receiver2.get_counters())
 
 
-def main():
-    global RUNNING
-    global THREADS
-    gui_object = Gui()
-    screen = gui_object.screen
-    constants = json.load(open(CONSTANTS_PATH))
-    show_stream_thread = threading.Thread(target=handle_stream, args=(constants, screen))
-    THREADS.append(show_stream_thread)
-    show_stream_thread.start()
-
+def connect_to_server(session_ticket=None):
+    """
+    Connect to the main tcp server and request the camera streams.
+    :param session_ticket: session_ticket of a previous TCPStream, to resume its session without a key exchange.
+    :return: server_socket, server_tcp_stream
+    """
     server_socket = socket.socket()
+    socket_settings = apply_socket_profile(server_socket, CONTROL_SOCKET_PROFILE)
     try:
         server_socket.connect(MAIN_TCP_SERVER_ADDRESS)
     except socket.error as e:
         raise socket.error("Could not connect to server. Failed with error:\n" + str(e))
 
-    # time.sleep(7.0)
-
-    server_tcp_stream = TCPStream(server_socket, 1024, 4, 8, 1024, False)
+    server_tcp_stream = TCPStream(server_socket, 1024, 4, 8, 1024, False, session_ticket=session_ticket)
+    print(f"[Log] Key exchange ({server_tcp_stream.key_exchange}) took "
+          f"{server_tcp_stream.handshake_time * 1000:.1f} ms")
+    print(f"[Log] Socket settings: {socket_settings}")
 
     print("[Log] Sending: Request for camera initialization")
     server_tcp_stream.send_by_size(PICommunication.initialize_cameras())
+    return server_socket, server_tcp_stream
+
+
+def reconnect_to_server(server_tcp_stream):
+    """
+    Reconnect after the connection to the server dropped, resuming the session of server_tcp_stream. The server keeps
+    the camera streams running, so they are reattached.
+    :param server_tcp_stream: TCPStream that dropped
+    :return: server_tcp_stream
+    """
+    server_tcp_stream.sock.close()
+    for attempt in range(RECONNECT_ATTEMPTS):
+        try:
+            return connect_to_server(server_tcp_stream.session_ticket)[1]
+        except (socket.error, ValueError) as e:
+            print(f"[Log] Reconnect attempt {attempt + 1} failed: {e}")
+            time.sleep(RECONNECT_INTERVAL)
+    raise socket.error("Could not reconnect to server")
+
+
+def main():
+    global CONTROL_SOCKET_PROFILE
+    global RUNNING
+    global THREADS
+    gui_object = Gui()
+    screen = gui_object.screen
+    constants = json.load(open(CONSTANTS_PATH))
+    CONTROL_SOCKET_PROFILE = get_socket_profile(constants, PROFILE_LOW_LATENCY_CONTROL)
+    show_stream_thread = threading.Thread(target=handle_stream, args=(constants, screen, gui_object))
+    THREADS.append(show_stream_thread)
+    show_stream_thread.start()
+
+    server_socket, server_tcp_stream = connect_to_server()
+    telemetry = ControlTelemetry()
+    car_state = CarStateReceiver()
+    car_state.add_listener(gui_object.set_car_state)
+    command_sender = CommandSender(server_tcp_stream, reconnect=reconnect_to_server,
+                                   create_udp_lane=lambda tcp_stream: create_udp_control_sender(
+                                       tcp_stream, MAIN_TCP_SERVER_ADDRESS[0], CONTROL_SOCKET_PROFILE),
+                                   telemetry=telemetry, car_state=car_state)
 
     print("Starting main loop")
     while RUNNING:
@@ -307,15 +371,19 @@ def main():
             elif command == Commands.TOGGLE_DISTANCE:
                 pass
             elif command == Commands.DISCONNECT:
-                server_tcp_stream.send_by_size(PICommunication.disconnect("Exit"))
-                server_socket.close()
+                command_sender.send(PICommunication.disconnect("Exit"))
+                command_sender.close()
+                print("[Log] Commands: ", command_sender.get_counters())
+                print("[Log] Control telemetry: ", telemetry.get_report())
+                print("[Log] Car state: ", car_state.get_counters())
+                command_sender.tcp_stream.sock.close()
                 LOCK.acquire()
                 RUNNING = False
                 print("Set global variable RUNNING to False. RUNNING: ", RUNNING)
                 LOCK.release()
                 break
             else:
-                server_tcp_stream.send_by_size(command.value)
+                command_sender.send(command.value)
         if not RUNNING:
             break
         time.sleep(1.0 / 50)
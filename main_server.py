@@ -1,128 +1,736 @@
+import argparse
+import asyncio
 import json
 import threading
-from subprocess import Popen
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from car_utils.car import Car
-from network.communication import TCPStream
+from car_utils.maneuvers import ManeuverScheduler, get_sweep_steps
+from network.actuator import ActuatorWorker
+from network.async_communication import AsyncTCPServer, UDPControlProtocol
+from network.car_state import CarStatePublisher, get_car_state_rates
+from network.channel import MODE_RING, Channel
+from network.communication import KEY_EXCHANGE_ECDH, TCPStream
+from network.dispatcher import CommandDispatcher
 # from network.communication import TCPServer
 from network.protocol import PICommunication
+from network.sessions import VIEWER_BANDWIDTH_CAP, SessionManager
+from network.socket_profiles import PROFILE_BULK_VIDEO, apply_socket_profile, get_socket_profile
 from network.socket_utils import initialize_server
+from network.streamer import LINK_BUDGET, TILE_SIZE, StreamingService
+from network.telemetry import AckBatcher, ControlTelemetry
+from network.udp_control import UDPControlReceiver
 
-CAMERA_OPENED = {'left': False, 'right': False}
+ACTIVE_CLIENTS = []
+CAMERA_CHECK_INTERVAL = 1.0
+# Messages the worker threads may queue for a client while its socket is busy, the oldest are dropped beyond it.
+CLIENT_OUTBOX_CAPACITY = 64
+CAMERA_OPENED = {'left': False, 'right': False, 'stereo': False}
 CAMERAS = {}
-CAMERA_USED = {"left": False, "right": False}
-CAMERA_INDEX = {"left": 0, "right": 2}
+# Runs the stream changes of sessions off the event loop of the async server, in the order they were made.
+CAMERA_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+# The "stereo" camera packs the frames of both cameras into one stream, see StereoCapture.
+CAMERA_INDEX = {"left": 0, "right": 2, "stereo": (0, 2)}
+CAMERA_AXIS = "camera"
 CONFIDENCE = 0.75
 CONSTANTS_PATH = "constants.json"
 # DESTINATION_SIZE = (160, 120)
 DESTINATION_SIZE = (256, 192)
 # DESTINATION_SIZE = (256, 192)
+DRIVE_AXIS = "drive"
+DISCONNECT_CODE = PICommunication.MessageCode.DISCONNECT.value.encode()
+PING_CODE = PICommunication.MessageCode.PING.value.encode()
+PONG_CODE = PICommunication.MessageCode.PONG.value.encode()
+SUBSCRIBE_CAR_STATE_CODE = PICommunication.MessageCode.SUBSCRIBE_CAR_STATE.value.encode()
+TAKE_CONTROL_CODE = PICommunication.MessageCode.TAKE_CONTROL.value.encode()
+RELEASE_CONTROL_CODE = PICommunication.MessageCode.RELEASE_CONTROL.value.encode()
+# Commands viewers may send besides the general messages, none of them moves the car. Anyone watching may stop it.
+VIEWER_COMMAND_CODES = {PICommunication.MessageCode.INITIALIZE_CAMERAS.value.encode(),
+                        PICommunication.MessageCode.STOP.value.encode()}
 FPS = 24
 GPIO_PIN_DISTRIBUTION_PATH = "gpio_pin_distribution.json"
 LEFT_CAMERA_ADDRESS = "192.168.1.36:5000"
 LEFT_CAMERA_INDEX = 0
 LOCK = threading.Lock()
-PROCESSES = []
 RIGHT_CAMERA_ADDRESS = "192.168.1.36:5001"
-CAMERA_PORT = {"left": 5000, "right": 5001}
+CAMERA_PORT = {"left": 5000, "right": 5001, "stereo": 5000}
 RIGHT_CAMERA_INDEX = 2
 RUNNING = True
 # STREAM_FRAME_SHAPE = (192, 256, 3)
-STREAMERS = {}
+# Layout of the stereo stream from constants.json, None to stream the cameras separately
+STEREO_LAYOUT = None
+# Cameras streamed to the clients, ["stereo"] in stereo mode
+STREAM_CAMERAS = ["left", "right"]
+# StreamingService of the cameras, created when the server starts
+STREAMING = None
+# {session id: (host, bandwidth cap)} of the sessions watching the cameras
+STREAM_DESTINATIONS = {}
+TELEMETRY = ControlTelemetry()
 THREADS = []
-PROCESSES = []
+UDP_CONTROL_BATCH_SIZE = 16
 
 
-def main():
+def start_streamer(camera):
+    """
+    Start streaming a camera from the server process. Its destinations are kept, so sessions watching it get its
+    frames as soon as it opens. Must be called with LOCK held.
+    :param camera: "left", "right" or "stereo"
+    """
+    print("Initializing stream for camera: ", camera)
+    STREAMING.start(camera, CAMERA_INDEX[camera], STEREO_LAYOUT if camera == "stereo" else None)
+    CAMERA_OPENED[camera] = True
+
+
+def update_stream_destination(camera, host):
+    """
+    Send the stream of a camera to host with the bandwidth cap of the sessions watching from there, or stop sending
+    to it if none is. Must be called with LOCK held.
+    :param camera: "left", "right" or "stereo"
+    :param host: host of a client
+    """
+    bandwidth_caps = [bandwidth_cap for session_host, bandwidth_cap in STREAM_DESTINATIONS.values()
+                      if session_host == host]
+    if not bandwidth_caps:
+        STREAMING.remove_destination(camera, host, CAMERA_PORT[camera])
+    else:
+        STREAMING.add_destination(camera, host, CAMERA_PORT[camera], 0 if 0 in bandwidth_caps else max(bandwidth_caps))
+
+
+def initialize_cameras(constants):
+    """
+    Create the streaming service and open the cameras, so the first client to watch gets video without waiting for
+    them to open. In stereo mode both cameras are grabbed together and sent as one stream, so the depth map of the
+    client is computed from frames taken at the same moment.
+    :param constants: json containing constants
+    """
+    global STEREO_LAYOUT, STREAM_CAMERAS, STREAMING
+
+    video = constants.get("video", {})
+    STEREO_LAYOUT = video.get("stereo_layout") or None
+    if STEREO_LAYOUT is not None:
+        STREAM_CAMERAS = ["stereo"]
+    STREAMING = StreamingService(get_socket_profile(constants, PROFILE_BULK_VIDEO),
+                                 video.get("link_budget", LINK_BUDGET), video.get("tile_size", TILE_SIZE))
+    LOCK.acquire()
+    for camera in STREAM_CAMERAS:
+        start_streamer(camera)
+    LOCK.release()
+
+
+def watch_cameras(session):
+    """
+    Send the camera streams to a session, with its bandwidth cap. Every camera is captured and encoded once, however
+    many sessions watch it. Cameras that stopped streaming are started again.
+    :param session: Session
+    """
+    LOCK.acquire()
+    session.watching_cameras = True
+    STREAM_DESTINATIONS[session.id] = (session.host, session.bandwidth_cap)
+    for camera in STREAM_CAMERAS:
+        if not STREAMING.is_streaming(camera):
+            start_streamer(camera)
+        else:
+            print("Reattaching to running stream for camera: ", camera)
+        update_stream_destination(camera, session.host)
+    LOCK.release()
+
+
+def stop_watching_cameras(session):
+    """
+    Stop sending the camera streams to a session. The cameras keep streaming, so a reconnecting client gets its video
+    back immediately.
+    :param session: Session
+    """
+    LOCK.acquire()
+    session.watching_cameras = False
+    if STREAM_DESTINATIONS.pop(session.id, None) is not None:
+        for camera in STREAM_CAMERAS:
+            update_stream_destination(camera, session.host)
+    LOCK.release()
+
+
+def update_session_streams(session):
+    """
+    Apply the bandwidth cap of a session whose role changed to its camera streams.
+    :param session: Session
+    """
+    if session.watching_cameras:
+        watch_cameras(session)
+
+
+def create_dispatcher(car, maneuvers):
+    """
+    Register the handlers of the car and video stream commands. Handlers get the content as a memoryview, and the
+    Session of the client that sent the command, None for commands of the udp control lane.
+    Drive and turn commands with a duration, and camera sweeps, run as timed maneuvers on maneuvers. Any other command
+    on the same axis cancels the running maneuver.
+    :param car: Car
+    :param maneuvers: ManeuverScheduler running on car.lock
+    :return: CommandDispatcher
+    """
+    dispatcher = CommandDispatcher()
+    MessageCode = PICommunication.MessageCode
+
+    # Car control:
+    drive_commands = {
+        MessageCode.MOVE_FORWARD: car.go_forward,
+        MessageCode.MOVE_BACKWARDS: car.go_backwards,
+        MessageCode.TURN_RIGHT: car.turn_right,
+        MessageCode.TURN_LEFT: car.turn_left,
+    }
+    car_commands = {
+        MessageCode.LOW_SPEED: car.low,
+        MessageCode.MEDIUM_SPEED: car.medium,
+        MessageCode.HIGH_SPEED: car.high,
+    }
+    camera_commands = {
+        MessageCode.CAMERA_RIGHT: car.move_camera_right,
+        MessageCode.CAMERA_LEFT: car.move_camera_left,
+        MessageCode.CAMERA_DOWN: car.move_camera_down,
+        MessageCode.CAMERA_UP: car.move_camera_up,
+        MessageCode.RESET_CAMERA_POSITION: car.reset_camera_position,
+    }
+
+    def drive(content, car_command):
+        duration = PICommunication.parse_duration(content)
+        maneuvers.start(DRIVE_AXIS, [(0, car_command)] + ([(duration, car.stop)] if duration > 0 else []))
+
+    def stop():
+        maneuvers.cancel(DRIVE_AXIS)
+        car.stop()
+
+    def move_camera(car_command):
+        maneuvers.cancel(CAMERA_AXIS)
+        car_command()
+
+    def sweep_camera(content):
+        maneuvers.start(CAMERA_AXIS, get_sweep_steps(car.move_camera, *PICommunication.parse_camera_sweep(content)))
+
+    for code, car_command in drive_commands.items():
+        dispatcher.register(code, lambda content, session, car_command=car_command: drive(content, car_command),
+                            PICommunication.parse_duration)
+    dispatcher.register(MessageCode.STOP, lambda content, session: stop())
+    for code, car_command in car_commands.items():
+        dispatcher.register(code, lambda content, session, car_command=car_command: car_command())
+    for code, car_command in camera_commands.items():
+        dispatcher.register(code, lambda content, session, car_command=car_command: move_camera(car_command))
+    dispatcher.register(MessageCode.CAMERA_SWEEP, lambda content, session: sweep_camera(content),
+                        PICommunication.parse_camera_sweep)
+
+    # Video stream control:
+    dispatcher.register(MessageCode.INITIALIZE_CAMERAS, lambda content, session: watch_cameras(session))
+
+    def execute_batch(content, session):
+        """
+        Execute the commands of a batch, or none of them if any is unknown or invalid.
+        :return: Whether all the commands of the batch are known and valid.
+        """
+        messages = PICommunication.split_batch(content)
+        if not all(dispatcher.validate(message) for message in messages):
+            print("[Log] - Refusing batch with an unknown or invalid command")
+            return False
+        known = True
+        for message in messages:
+            known = dispatcher.dispatch(message, session) and known
+        return known
+
+    dispatcher.register(MessageCode.BATCH, execute_batch)
+    return dispatcher
+
+
+def handle_udp_control(actuator, udp_control_server, udp_control):
+    """
+    Queue the commands of the udp control lane on the actuator, until the server stops. Stale and reordered datagrams
+    are dropped by udp_control, so a lost datagram never delays the ones after it. Only idempotent car commands arrive
+    there, so unknown ones are ignored instead of answered, and so are the ones of viewers.
+    :param actuator: ActuatorWorker
+    :param udp_control_server: UDPServer of the udp control lane
+    :param udp_control: UDPControlReceiver
+    """
+    while RUNNING:
+        for datagram in udp_control_server.get_messages(UDP_CONTROL_BATCH_SIZE, timeout=0.5):
+            message, session = udp_control.decode(datagram)
+            if message is None or not session.is_controller():
+                continue
+            sequence_number, message = PICommunication.split_sequenced(message)
+            if sequence_number is None:
+                actuator.submit(message)
+            else:
+                # Acks gathered while the actuator is busy are sent together once it is idle.
+                actuator.submit(message, done=lambda known, acks=session.acks, sequence_number=sequence_number:
+                                acks.add(sequence_number), flush=session.acks.flush)
+    print("[Log] - Udp control datagrams: ", udp_control.get_counters(), udp_control_server.get_counters())
+
+
+def handle_timing_message(content):
+    """
+    Handle the ping and pong messages of a client with TELEMETRY, outside of car.lock so the round trip doesn't include
+    waiting for the car.
+    :param content: message received from the client
+    :return: None if the message is not a ping or pong. Otherwise the message to send back, b"" for none.
+    """
+    code = content[:PICommunication.msg_code_size]
+    if code == PING_CODE:
+        return TELEMETRY.handle_ping(content[PICommunication.msg_code_size:])
+    if code == PONG_CODE:
+        return TELEMETRY.handle_pong(content[PICommunication.msg_code_size:]) or b""
+    return None
+
+
+def handle_session_message(sessions, session, actuator, message):
+    """
+    Handle the control handoff messages of a client, and refuse the car commands of viewers, except STOP.
+    :param sessions: SessionManager
+    :param session: Session of the client
+    :param actuator: ActuatorWorker
+    :param message: message received from the client, without its sequence number
+    :return: None if the message should be queued on the actuator. Otherwise the message to send back, b"" for none.
+    """
+    code = message[:PICommunication.msg_code_size]
+    if code == TAKE_CONTROL_CODE:
+        if sessions.take_control(session):
+            return b""
+        return PICommunication.error("Another client is in control")
+    if code == RELEASE_CONTROL_CODE:
+        if sessions.release_control(session):
+            actuator.submit(PICommunication.stop())
+        return b""
+    if not session.is_controller() and code not in VIEWER_COMMAND_CODES:
+        return PICommunication.error("Only the controlling client can drive the car")
+    return None
+
+
+def send_outbox(client_tcp_stream, outbox, connected):
+    """
+    Send the messages the worker threads queued for a client, such as acks and car state pushes, until it disconnects.
+    A client whose socket stalls only holds up this thread, never the actuator or the car state push.
+    :param client_tcp_stream: TCPStream of the client
+    :param outbox: Channel of the messages to send
+    :param connected: threading.Event, cleared once the client disconnected
+    """
+    while RUNNING and connected.is_set():
+        message = outbox.get(timeout=0.5)
+        if message is None:
+            continue
+        try:
+            client_tcp_stream.send_by_size(message)
+        except (ConnectionError, OSError) as e:
+            print(f"[Log] - Failed sending to client ({e})")
+            break
+
+
+def start_client(actuator, sessions, tcp_server, client_socket, client_address, udp_control=None, car_state=None):
+    """
+    Do the handshake with a client that just connected, then handle it. Every client runs this in its own thread.
+    :param actuator: ActuatorWorker
+    :param sessions: SessionManager
+    :param tcp_server: TCPServer the client connected to
+    :param client_socket: socket of the client
+    :param client_address: address of the client
+    :param udp_control: UDPControlReceiver to open the udp control lane of the client on, None if there is none.
+    :param car_state: CarStatePublisher the client can subscribe to, None if there is none.
+    """
+    client_tcp_stream = tcp_server.handshake(client_socket, client_address)
+    if client_tcp_stream is None:
+        return
+    print("Client address: ", client_address)
+    print(f"[Log] - Key exchange ({client_tcp_stream.key_exchange}) took "
+          f"{client_tcp_stream.handshake_time * 1000:.1f} ms")
+    handle_client(actuator, sessions, client_tcp_stream, client_address, udp_control, car_state)
+
+
+def handle_client(actuator, sessions, client_tcp_stream, client_address, udp_control=None, car_state=None):
+    """
+    Receive commands from a client and queue them on the actuator, until the client disconnects or the connection
+    drops. Every client runs this in its own thread, which never waits for the car. Pings are answered right away, and
+    sequenced commands are acknowledged once executed.
+    The client gets a session, in control of the car or as a viewer. The car stops when the controlling client leaves,
+    and the server shuts down when the last connected client disconnects.
+    :param actuator: ActuatorWorker
+    :param sessions: SessionManager
+    :param client_tcp_stream: TCPStream of the client
+    :param client_address: address of the client
+    :param udp_control: UDPControlReceiver to open the udp control lane of the client on, None if there is none.
+    :param car_state: CarStatePublisher the client can subscribe to, None if there is none.
+    """
+    global RUNNING
+
+    session = sessions.open(client_address[0], client_tcp_stream.send_by_size, client_tcp_stream.session_key,
+                            client_tcp_stream.resumed_session_key)
+    # Acks and errors of executed commands are sent from a thread of the client, so the actuator never waits on it.
+    outbox = Channel(f"outbox {client_address}", MODE_RING, CLIENT_OUTBOX_CAPACITY)
+    connected = threading.Event()
+    connected.set()
+    threading.Thread(target=send_outbox, args=(client_tcp_stream, outbox, connected), daemon=True).start()
+    acks = AckBatcher(outbox.put)
+    session.acks = acks
+
+    def command_done(known, sequence_number, message):
+        """
+        Called by the actuator once a command was executed.
+        """
+        if sequence_number is not None:
+            acks.add(sequence_number)
+        if not known:
+            print(f"Command code: {bytes(message[:PICommunication.msg_code_size])}\n")
+            outbox.put(PICommunication.error("Unknown or invalid command"))
+
+    lane_id = udp_control.register(client_tcp_stream.session_key, session) if udp_control is not None else None
+    LOCK.acquire()
+    ACTIVE_CLIENTS.append(client_tcp_stream)
+    LOCK.release()
+    while RUNNING:
+        try:
+            content_length, content = client_tcp_stream.recv_by_size()
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"[Log] - Connection to {client_address} dropped ({e}), waiting for client to reconnect")
+            client_tcp_stream.sock.close()
+            break
+
+        try:
+            # General messages:
+            if content[:PICommunication.msg_code_size] == DISCONNECT_CODE:
+                client_tcp_stream.send_by_size(PICommunication.disconnect("User exited"))
+                client_tcp_stream.sock.close()
+                LOCK.acquire()
+                if ACTIVE_CLIENTS == [client_tcp_stream]:
+                    RUNNING = False
+                LOCK.release()
+                break
+            if content[:PICommunication.msg_code_size] == SUBSCRIBE_CAR_STATE_CODE:
+                if car_state is not None:
+                    # Pushed through the outbox, so a stalled client never holds up the pushes to the others.
+                    car_state.subscribe(outbox.put)
+                continue
+            reply = handle_timing_message(content)
+            if reply is not None:
+                if reply:
+                    client_tcp_stream.send_by_size(reply)
+                continue
+            sequence_number, message = PICommunication.split_sequenced(content)
+            reply = handle_session_message(sessions, session, actuator, message)
+            if reply is not None:
+                if sequence_number is not None:
+                    acks.add(sequence_number)
+                    acks.flush()
+                if reply:
+                    client_tcp_stream.send_by_size(reply)
+                continue
+            actuator.submit(message, session,
+                            lambda known, sequence_number=sequence_number, message=message:
+                            command_done(known, sequence_number, message), acks.flush)
+        except Exception as e:
+            print(e)
+
+    connected.clear()
+    if lane_id is not None:
+        # Close the lane first, so a late datagram can't restart the car.
+        udp_control.unregister(lane_id)
+    if sessions.close(session):
+        actuator.submit(PICommunication.stop())
+    stop_watching_cameras(session)
+    if car_state is not None:
+        car_state.unsubscribe(outbox.put)
+    LOCK.acquire()
+    ACTIVE_CLIENTS.remove(client_tcp_stream)
+    LOCK.release()
+
+
+def publish_car_state(car_state):
+    """
+    Push the car state to the subscribed clients every tick, until the server stops.
+    :param car_state: CarStatePublisher
+    """
+    next_tick = time.monotonic()
+    while RUNNING:
+        car_state.tick()
+        next_tick += car_state.tick_interval
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+def run_threaded_server():
     """
-    Main loop of the server. Receives commands from client and executes them on car.
+    Main loop of the server. Accepts clients, and handles each one in its own thread.
+    When a connection drops, the car stops and the client can reconnect. Camera streams keep running, and the client
+    can resume its session with the ticket it got, without a new key exchange.
+    Drive and camera commands can also arrive on the udp control lane, which is handled by its own thread, and the
+    car state is pushed to subscribed clients from another one.
     """
 
     global RUNNING
-    global PROCESSES
     global THREADS
-    global CAMERA_USED
     # detector = ObjectDetector("image_processing/", CONFIDENCE)
 
     constants = json.load(open(CONSTANTS_PATH))
+    car = Car()
+    initialize_cameras(constants)
+    sessions = SessionManager(constants.get("sessions", {}).get("viewer_bandwidth_cap", VIEWER_BANDWIDTH_CAP),
+                              update_session_streams)
+    udp_control_server = initialize_server(constants, "udp_control_server", THREADS)
+    udp_control = UDPControlReceiver(udp_control_server.address[1])
+    maneuvers = ManeuverScheduler(car.lock)
+    actuator = ActuatorWorker(create_dispatcher(car, maneuvers), car.lock)
+    udp_control_thread = threading.Thread(target=handle_udp_control, args=(actuator, udp_control_server, udp_control))
+    THREADS.append(udp_control_thread)
+    udp_control_thread.start()
+    car_state = CarStatePublisher({"drive": car.get_drive_state, "camera": car.get_camera_state},
+                                  get_car_state_rates(constants))
+    car_state_thread = threading.Thread(target=publish_car_state, args=(car_state,))
+    THREADS.append(car_state_thread)
+    car_state_thread.start()
     tcp_server = initialize_server(constants, "main_tcp_server", THREADS)
-    # client_socket = tcp_server.get_client()
-    # client_tcp_stream = TCPStream(client_socket, 1024, 4, 8, 1024)
-    client_tcp_stream, client_address = tcp_server.get_client()
+    tcp_server.extra_capabilities.append(udp_control.capability)
+
+    next_camera_check = time.monotonic() + CAMERA_CHECK_INTERVAL
+    while RUNNING:
+        client_socket, client_address = tcp_server.get_client_socket(timeout=0.5)
+        if time.monotonic() >= next_camera_check:
+            next_camera_check = time.monotonic() + CAMERA_CHECK_INTERVAL
+            check_cameras()
+        if client_socket is None:
+            continue
+        # The handshake runs on the thread of the client, so a slow or silent client never holds up the others.
+        client_thread = threading.Thread(target=start_client,
+                                         args=(actuator, sessions, tcp_server, client_socket, client_address,
+                                               udp_control, car_state))
+        LOCK.acquire()
+        THREADS.append(client_thread)
+        LOCK.release()
+        client_thread.start()
+
+    tcp_server.running = False
+    udp_control_server.running = False
+    stop_cameras()
+    for thread in THREADS:
+        thread.join()
+    actuator.close()
+    maneuvers.close()
+    print("[Log] - Commands: ", actuator.dispatcher.get_counters())
+    print("[Log] - Actuator lanes: ", actuator.get_counters())
+    print("[Log] - Maneuvers: ", maneuvers.get_counters())
+    print("[Log] - Car state push: ", car_state.get_counters())
+    print("[Log] - Sessions: ", sessions.get_counters())
+    print("[Log] - Round trip: ", TELEMETRY.rtt.get_percentiles())
+
+
+async def handle_client_async(actuator, sessions, client_stream, client_address, udp_control=None, car_state=None):
+    """
+    asyncio version of handle_client. Commands are queued on the actuator, whose threads hand their results back to the
+    event loop, so neither the loop nor the client ever waits for the car.
+    :param actuator: ActuatorWorker
+    :param sessions: SessionManager
+    :param client_stream: AsyncTCPStream of the client
+    :param client_address: address of the client
+    :param udp_control: UDPControlReceiver to open the udp control lane of the client on, None if there is none.
+    :param car_state: CarStatePublisher the client can subscribe to, None if there is none.
+    """
+    global RUNNING
+
+    loop = asyncio.get_running_loop()
     print("Client address: ", client_address)
-    car = Car()
+    print(f"[Log] - Key exchange ({client_stream.tcp_stream.key_exchange}) took "
+          f"{client_stream.tcp_stream.handshake_time * 1000:.1f} ms")
+    session = sessions.open(client_address[0], client_stream.send_nowait, client_stream.tcp_stream.session_key,
+                            client_stream.tcp_stream.resumed_session_key)
+    acks = AckBatcher(client_stream.send_nowait)
+    session.acks = acks
 
-    client_host = client_address[0]
+    def command_done(known, sequence_number, message):
+        """
+        Called on the event loop once a command was executed.
+        """
+        if sequence_number is not None:
+            acks.add(sequence_number)
+        if not known:
+            print(f"Command code: {bytes(message[:PICommunication.msg_code_size])}\n")
+            client_stream.send_nowait(PICommunication.error("Unknown or invalid command"))
+
+    lane_id = udp_control.register(client_stream.tcp_stream.session_key, session) if udp_control is not None else None
+    ACTIVE_CLIENTS.append(client_stream)
     while RUNNING:
-        content_length, content = client_tcp_stream.recv_by_size()
-        code, message = PICommunication.parse_message(content)
+        try:
+            content_length, content = await client_stream.recv_by_size()
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"[Log] - Connection to {client_address} dropped ({e}), waiting for client to reconnect")
+            client_stream.close()
+            break
 
         try:
-            # Car control:
-            if code == PICommunication.MessageCode.MOVE_FORWARD:
-                car.go_forward()
-            elif code == PICommunication.MessageCode.MOVE_BACKWARDS:
-                car.go_backwards()
-            elif code == PICommunication.MessageCode.STOP:
-                car.stop()
-            elif code == PICommunication.MessageCode.LOW_SPEED:
-                car.low()
-            elif code == PICommunication.MessageCode.MEDIUM_SPEED:
-                car.medium()
-            elif code == PICommunication.MessageCode.HIGH_SPEED:
-                car.high()
-            elif code == PICommunication.MessageCode.TURN_RIGHT:
-                car.turn_right()
-            elif code == PICommunication.MessageCode.TURN_LEFT:
-                car.turn_left()
-            elif code == PICommunication.MessageCode.CAMERA_RIGHT:
-                car.move_camera_right()
-            elif code == PICommunication.MessageCode.CAMERA_LEFT:
-                car.move_camera_left()
-            elif code == PICommunication.MessageCode.CAMERA_DOWN:
-                car.move_camera_down()
-            elif code == PICommunication.MessageCode.CAMERA_UP:
-                car.move_camera_up()
-            elif code == PICommunication.MessageCode.RESET_CAMERA_POSITION:
-                car.reset_camera_position()
-
-            # Video stream control:
-            elif code == PICommunication.MessageCode.INITIALIZE_CAMERAS:
-                cameras = ["left", "right"]
-                for camera in cameras:
-                    if CAMERA_USED[camera]:
-                        print("Camera already used!")
-                    else:
-                        print("Initializing stream for camera: ", camera)
-                        id = CAMERA_INDEX[camera]
-                        address = client_host + ":" +str(CAMERA_PORT[camera])
-                        print(id, address)
-                        LOCK.acquire()
-                        p = Popen(['python3', 'network/streamer.py', '-a', address, '-i', str(id)])
-                        PROCESSES.append(p)
-                        CAMERA_OPENED[camera] = True
-                        LOCK.release()
             # General messages:
-            elif code == PICommunication.MessageCode.DISCONNECT:
-                client_tcp_stream.send_by_size(PICommunication.disconnect("User exited"))
-                client_tcp_stream.sock.close()
+            if content[:PICommunication.msg_code_size] == DISCONNECT_CODE:
+                await client_stream.send_by_size(PICommunication.disconnect("User exited"))
+                client_stream.close()
+                if ACTIVE_CLIENTS == [client_stream]:
+                    RUNNING = False
                 break
-            else:
-                print(f"Command code: {code}\n")
-                client_tcp_stream.send_by_size(PICommunication.error("Unknown command"))
-            #time.sleep(1.0 / 60)
+            if content[:PICommunication.msg_code_size] == SUBSCRIBE_CAR_STATE_CODE:
+                if car_state is not None:
+                    car_state.subscribe(client_stream.send_nowait)
+                continue
+            reply = handle_timing_message(content)
+            if reply is not None:
+                if reply:
+                    await client_stream.send_by_size(reply)
+                continue
+            sequence_number, message = PICommunication.split_sequenced(content)
+            reply = handle_session_message(sessions, session, actuator, message)
+            if reply is not None:
+                if sequence_number is not None:
+                    acks.add(sequence_number)
+                    acks.flush()
+                if reply:
+                    await client_stream.send_by_size(reply)
+                continue
+            actuator.submit(message, session,
+                            lambda known, sequence_number=sequence_number, message=message:
+                            loop.call_soon_threadsafe(command_done, known, sequence_number, message),
+                            lambda: loop.call_soon_threadsafe(acks.flush))
         except Exception as e:
             print(e)
 
+    if lane_id is not None:
+        udp_control.unregister(lane_id)
+    if sessions.close(session):
+        actuator.submit(PICommunication.stop())
+    await loop.run_in_executor(CAMERA_EXECUTOR, stop_watching_cameras, session)
+    if car_state is not None:
+        car_state.unsubscribe(client_stream.send_nowait)
+    ACTIVE_CLIENTS.remove(client_stream)
+
+
+def handle_udp_message_async(actuator, message, session):
+    """
+    asyncio version of the udp control thread, called on the event loop for every datagram that was not dropped.
+    Acks are sent from the event loop once the actuator is idle.
+    :param actuator: ActuatorWorker
+    :param message: message decoded by UDPControlReceiver
+    :param session: Session of the lane
+    """
+    if not session.is_controller():
+        return
+    loop = asyncio.get_running_loop()
+    acks = session.acks
+    sequence_number, message = PICommunication.split_sequenced(message)
+    if sequence_number is None:
+        actuator.submit(message)
+    else:
+        actuator.submit(message, done=lambda known: acks.add(sequence_number),
+                        flush=lambda: loop.call_soon_threadsafe(acks.flush))
+
+
+def check_cameras():
+    """
+    Start the cameras that stopped streaming again, while sessions are watching.
+    """
     LOCK.acquire()
-    RUNNING = False
+    for camera, opened in CAMERA_OPENED.items():
+        if opened and not STREAMING.is_streaming(camera):
+            print(f"[Log] - Camera stream {camera} stopped")
+            CAMERA_OPENED[camera] = False
+            if STREAM_DESTINATIONS:
+                start_streamer(camera)
     LOCK.release()
-    print("Processes: ", PROCESSES)
-    for p in PROCESSES:
-        print("Killing camera process with id: ", p.pid)
-        p.kill()
-    for thread in THREADS:
-        thread.join()
+
+
+async def manage_cameras():
+    """
+    Check the camera streams until the server stops. The check waits for LOCK, which other threads hold while starting
+    camera workers, so it runs in an executor instead of blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while RUNNING:
+        await loop.run_in_executor(None, check_cameras)
+        await asyncio.sleep(CAMERA_CHECK_INTERVAL)
+
+
+async def publish_car_state_async(car_state):
+    """
+    asyncio version of publish_car_state.
+    :param car_state: CarStatePublisher
+    """
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+    while RUNNING:
+        car_state.tick()
+        next_tick += car_state.tick_interval
+        await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+
+async def run_async_server():
+    """
+    Main loop of the server on a single asyncio event loop: accepting clients, command dispatch, the car state push
+    and camera management all run as coroutines. The udp control lane is a datagram endpoint on the same loop.
+    """
+    loop = asyncio.get_running_loop()
+    constants = json.load(open(CONSTANTS_PATH))
+    server_info = constants["main_tcp_server"]
+    tcp_server = AsyncTCPServer((server_info["ip"], int(server_info["port"])), server_info["recv_size"],
+                                key_exchange=server_info.get("key_exchange", KEY_EXCHANGE_ECDH),
+                                socket_profile=get_socket_profile(constants, server_info.get("socket_profile")))
+    car = Car()
+    initialize_cameras(constants)
+    # Roles change on the event loop, and applying them to the streams waits for LOCK.
+    sessions = SessionManager(constants.get("sessions", {}).get("viewer_bandwidth_cap", VIEWER_BANDWIDTH_CAP),
+                              lambda session: loop.run_in_executor(CAMERA_EXECUTOR, update_session_streams, session))
+    maneuvers = ManeuverScheduler(car.lock)
+    actuator = ActuatorWorker(create_dispatcher(car, maneuvers), car.lock)
+    car_state = CarStatePublisher({"drive": car.get_drive_state, "camera": car.get_camera_state},
+                                  get_car_state_rates(constants))
+
+    udp_info = constants["udp_control_server"]
+    udp_control = UDPControlReceiver(int(udp_info["port"]))
+    udp_transport, udp_protocol = await loop.create_datagram_endpoint(
+        lambda: UDPControlProtocol(udp_control,
+                                   lambda message, session: handle_udp_message_async(actuator, message, session)),
+        local_addr=(udp_info["ip"], int(udp_info["port"])))
+    udp_socket_settings = apply_socket_profile(udp_transport.get_extra_info("socket"),
+                                               get_socket_profile(constants, udp_info.get("socket_profile")))
+    print(f"[Log] - Socket settings of udp control lane: {udp_socket_settings}")
+    tcp_server.extra_capabilities.append(udp_control.capability)
+
+    serve_task = asyncio.create_task(tcp_server.serve(
+        lambda client_stream, client_address: handle_client_async(actuator, sessions, client_stream, client_address,
+                                                                  udp_control, car_state)))
+    car_state_task = asyncio.create_task(publish_car_state_async(car_state))
+    await manage_cameras()
+    await car_state_task
+
+    udp_transport.close()
+    print("[Log] - Udp control datagrams: ", udp_control.get_counters())
+    tcp_server.running = False
+    await serve_task
+    for task in tcp_server.session_tasks:
+        task.cancel()
+    stop_cameras()
+    actuator.close()
+    maneuvers.close()
+    print("[Log] - Commands: ", actuator.dispatcher.get_counters())
+    print("[Log] - Actuator lanes: ", actuator.get_counters())
+    print("[Log] - Maneuvers: ", maneuvers.get_counters())
+    print("[Log] - Car state push: ", car_state.get_counters())
+    print("[Log] - Sessions: ", sessions.get_counters())
+    print("[Log] - Round trip: ", TELEMETRY.rtt.get_percentiles())
+
+
+def stop_cameras():
+    """
+    Stop all camera streams and release the cameras.
+    """
+    print("[Log] - Camera streams: ", STREAMING.get_counters())
+    STREAMING.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='PI-Force1 car server.')
+    parser.add_argument('--asyncio', dest='use_asyncio', action='store_true',
+                        help='Run the control server on an asyncio event loop instead of a thread per client')
+    args = parser.parse_args()
+
+    if args.use_asyncio:
+        asyncio.run(run_async_server())
+    else:
+        run_threaded_server()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,246 @@
+import collections
+import threading
+
+from network.protocol import COMMAND_AXES, PICommunication
+
+MessageCode = PICommunication.MessageCode
+
+LANE_SAFETY = 0
+LANE_DRIVE = 1
+LANE_CAMERA = 2
+LANE_HOUSEKEEPING = 3
+LANE_NAMES = ["safety", "drive", "camera", "housekeeping"]
+# Lanes served by the actuator thread, in priority order. Housekeeping runs on its own thread without the car lock,
+# so spawning a camera stream never holds up the car.
+ACTUATOR_LANES = (LANE_SAFETY, LANE_DRIVE, LANE_CAMERA)
+HOUSEKEEPING_LANES = (LANE_HOUSEKEEPING,)
+
+BATCH_CODE = MessageCode.BATCH.value.encode()
+CAMERA_SWEEP_CODE = MessageCode.CAMERA_SWEEP.value.encode()
+RESET_CAMERA_POSITION_CODE = MessageCode.RESET_CAMERA_POSITION.value.encode()
+STOP_CODE = MessageCode.STOP.value.encode()
+LANES = {STOP_CODE: LANE_SAFETY, RESET_CAMERA_POSITION_CODE: LANE_CAMERA, CAMERA_SWEEP_CODE: LANE_CAMERA}
+for code, axis in COMMAND_AXES.items():
+    LANES.setdefault(code, LANE_DRIVE if axis in ("drive", "speed") else LANE_CAMERA)
+# {key: keys of the pending commands it makes pointless}. The key of a command is its axis, or its code if it has
+# none. Camera steps add up, so they are never superseded by each other, and neither are the camera stream requests
+# of different sessions. The commands of a pending batch are superseded one by one, so a STOP overtaking a batch
+# takes its drive and speed commands out of it.
+SUPERSEDES = {
+    STOP_CODE: {"drive", "speed", STOP_CODE},
+    "drive": {"drive"},
+    "speed": {"speed"},
+    RESET_CAMERA_POSITION_CODE: {"camera_horizontal", "camera_vertical", RESET_CAMERA_POSITION_CODE, CAMERA_SWEEP_CODE},
+    CAMERA_SWEEP_CODE: {CAMERA_SWEEP_CODE},
+}
+
+
+def get_lane(message):
+    """
+    :param message: message from PICommunication
+    :return: lane of the message. A batch goes to the most urgent lane of its commands.
+    """
+    code = bytes(message[:PICommunication.msg_code_size])
+    if code != BATCH_CODE:
+        return LANES.get(code, LANE_HOUSEKEEPING)
+    try:
+        batched_messages = PICommunication.split_batch(message[PICommunication.msg_code_size:])
+    except ValueError:
+        return LANE_HOUSEKEEPING
+    return min([get_lane(batched_message) for batched_message in batched_messages], default=LANE_HOUSEKEEPING)
+
+
+def get_key(message):
+    """
+    :param message: message from PICommunication, not a batch
+    :return: key of the message in SUPERSEDES, its axis or its code. A STOP is keyed by its code, as it makes the
+    pending speed changes pointless too.
+    """
+    code = bytes(message[:PICommunication.msg_code_size])
+    return code if code == STOP_CODE else COMMAND_AXES.get(code, code)
+
+
+class ActuatorItem:
+    """
+    A command, or a batch of commands, waiting in a lane of the ActuatorWorker.
+    """
+
+    def __init__(self, message, session, done, flush):
+        self.message = message
+        self.session = session
+        self.done = done
+        self.flush = flush
+        self.is_batch = bytes(message[:PICommunication.msg_code_size]) == BATCH_CODE
+        self.messages = [message]
+        if self.is_batch:
+            try:
+                self.messages = PICommunication.split_batch(message[PICommunication.msg_code_size:])
+            except ValueError:
+                self.messages = []
+        # A malformed or empty batch is never superseded, and executed as is so the dispatcher reports it.
+        self.keys = [get_key(batched_message) for batched_message in self.messages] if self.messages else [None]
+
+    def get_superseded_keys(self):
+        """
+        :return: keys of the pending commands this item makes pointless
+        """
+        return set().union(*[SUPERSEDES.get(key, ()) for key in self.keys])
+
+    def strip(self, superseded_keys):
+        """
+        Remove the commands superseded by a newer one.
+        :param superseded_keys: keys of the superseded commands
+        :return: How many commands were removed. The item is empty once all of them were.
+        """
+        kept = [(message, key) for message, key in zip(self.messages, self.keys) if key not in superseded_keys]
+        removed = len(self.keys) - len(kept)
+        if removed and kept:
+            self.messages = [message for message, key in kept]
+            self.keys = [key for message, key in kept]
+            self.message = PICommunication.batch(self.messages)
+        elif removed:
+            self.messages = []
+            self.keys = []
+        return removed
+
+    def is_empty(self):
+        return not self.keys
+
+
+class ActuatorWorker:
+    """
+    Executes commands on the car from its own threads, so the threads reading sockets never block on hardware.
+    Commands wait in priority lanes: safety (STOP), drive, camera servos and housekeeping. The most urgent waiting
+    command always runs next, and a new command drops the waiting commands it makes pointless in its own lane and in
+    less urgent ones, such as a STOP dropping a waiting move forward.
+    """
+
+    def __init__(self, dispatcher, lock):
+        """
+        Initialize ActuatorWorker object and start its threads.
+        :param dispatcher: CommandDispatcher to execute commands with
+        :param lock: lock held while executing commands of the actuator lanes, car.lock
+        """
+        self.dispatcher = dispatcher
+        self.lock = lock
+        self.condition = threading.Condition()
+        self.lanes = [collections.deque() for lane_name in LANE_NAMES]
+        self.pending_flushes = {lanes: set() for lanes in (ACTUATOR_LANES, HOUSEKEEPING_LANES)}
+        self.executed_commands = [0] * len(LANE_NAMES)
+        self.superseded_commands = [0] * len(LANE_NAMES)
+        self.running = True
+        self.threads = [threading.Thread(target=self.run, args=(ACTUATOR_LANES, lock)),
+                        threading.Thread(target=self.run, args=(HOUSEKEEPING_LANES, None))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, message, session=None, done=None, flush=None):
+        """
+        Queue a command. Never blocks on hardware.
+        :param message: message from PICommunication
+        :param session: Session of the client that sent the command, passed on to the handler
+        :param done: function called with whether the command is known and ran without an error once it was executed,
+        or with True if it was superseded. Called from a worker thread.
+        :param flush: function called once the worker has no more commands to execute, for example to send the acks
+        gathered by done together.
+        """
+        lane = get_lane(message)
+        item = ActuatorItem(message, session, done, flush)
+        superseded = []
+        self.condition.acquire()
+        superseded_keys = item.get_superseded_keys()
+        if superseded_keys:
+            for pending_lane in range(lane, len(self.lanes)):
+                kept = collections.deque()
+                for pending_item in self.lanes[pending_lane]:
+                    self.superseded_commands[pending_lane] += pending_item.strip(superseded_keys)
+                    if pending_item.is_empty():
+                        superseded.append(pending_item)
+                    else:
+                        kept.append(pending_item)
+                self.lanes[pending_lane] = kept
+        self.lanes[lane].append(item)
+        # The acks of superseded commands go out with the next flush of the thread serving the new command.
+        lane_group = ACTUATOR_LANES if lane in ACTUATOR_LANES else HOUSEKEEPING_LANES
+        self.pending_flushes[lane_group].update(pending_item.flush for pending_item in superseded
+                                                if pending_item.flush is not None)
+        self.condition.notify_all()
+        self.condition.release()
+        for superseded_item in superseded:
+            self.__finish(superseded_item, True)
+
+    def get_counters(self):
+        """
+        :return: {lane name: {"executed": commands executed, "superseded": commands dropped, batched ones included,
+        "pending": waiting}}
+        """
+        return {lane_name: {"executed": self.executed_commands[lane], "superseded": self.superseded_commands[lane],
+                            "pending": len(self.lanes[lane])}
+                for lane, lane_name in enumerate(LANE_NAMES)}
+
+    def close(self):
+        """
+        Stop the threads. Commands still waiting are dropped.
+        """
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify_all()
+        self.condition.release()
+        for thread in self.threads:
+            thread.join()
+
+    def run(self, lanes, lock):
+        """
+        Execute the commands of lanes, most urgent lane first, until closed.
+        :param lanes: lane indexes in priority order
+        :param lock: lock to hold while executing, None for none.
+        """
+        while True:
+            self.condition.acquire()
+            self.condition.wait_for(lambda: not self.running or any(self.lanes[lane] for lane in lanes))
+            if not self.running:
+                self.condition.release()
+                return
+            lane = next(lane for lane in lanes if self.lanes[lane])
+            item = self.lanes[lane].popleft()
+            if item.flush is not None:
+                self.pending_flushes[lanes].add(item.flush)
+            self.condition.release()
+
+            known = True
+            if lock is not None:
+                lock.acquire()
+            try:
+                known = self.dispatcher.dispatch(item.message, item.session)
+            except Exception as e:
+                print(e)
+                known = False
+            finally:
+                if lock is not None:
+                    lock.release()
+            self.executed_commands[lane] += 1
+            self.__finish(item, known)
+
+            self.condition.acquire()
+            flushes = []
+            if not any(self.lanes[lane] for lane in lanes):
+                flushes = self.pending_flushes[lanes]
+                self.pending_flushes[lanes] = set()
+            self.condition.release()
+            for flush in flushes:
+                try:
+                    flush()
+                except Exception as e:
+                    print(e)
+
+    @staticmethod
+    def __finish(item, known):
+        """
+        Call the done function of an item. Errors are printed, so they never stop a worker.
+        """
+        if item.done is None:
+            return
+        try:
+            item.done(known)
+        except Exception as e:
+            print(e)
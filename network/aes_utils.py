@@ -1,3 +1,6 @@
+import hashlib
+import hmac
+
 from Crypto.Cipher import AES
 import base64
 from Crypto import Random
@@ -52,3 +55,95 @@ class AESCipher(object):
         """
         padding_size = int(s[-1])
         return s[: len(s) - padding_size]
+
+
+
+class AESCTRHMACCipher(object):
+    """
+    Authenticated AES-CTR + HMAC-SHA256 cipher for a session. Messages are raw bytes: no padding and no base64.
+    The AES key schedule and the keyed HMAC are created once, and every message only encrypts its counter blocks.
+    Nonces are built from a direction prefix and a message counter, so the same keys are safe to use both ways, and
+    replayed or reordered messages are rejected.
+    """
+    counter_size = 8
+    tag_size = 16
+    overhead = counter_size + tag_size
+    # Longer messages are cheaper with pycryptodome's CTR mode, even though it expands the key again.
+    max_key_stream_blocks = 16
+
+    def __init__(self, key, is_server: bool):
+        """
+        Initialize an AESCTRHMACCipher object
+        :param key: 32 bytes. The first half is the AES key, the second half is the HMAC key.
+        :param is_server: Whether this side is the server. Decides the nonce prefix for each direction.
+        """
+        self.bs = AES.block_size
+        self.key = key[:16]
+        self.ecb_cipher = AES.new(self.key, AES.MODE_ECB)
+        self.hmac = hmac.new(key[16:], digestmod=hashlib.sha256)
+        self.send_prefix = b"\x00\x00\x00\x01" if is_server else b"\x00\x00\x00\x00"
+        self.recv_prefix = b"\x00\x00\x00\x00" if is_server else b"\x00\x00\x00\x01"
+        self.send_counter = 0
+        self.last_recv_counter = -1
+
+    def encrypt(self, raw, associated_data=b""):
+        """
+        Encrypt and authenticate a message.
+        :param raw: message to encrypt
+        :param associated_data: data sent in the clear that should be authenticated too, such as the frame header.
+        :return: counter + ciphertext + tag. type: bytes.
+        """
+        counter = self.send_counter.to_bytes(self.counter_size, "big")
+        self.send_counter += 1
+        nonce = self.send_prefix + counter
+        ciphertext = self._xor_key_stream(raw, nonce)
+        return counter + ciphertext + self._tag(nonce, associated_data, ciphertext)
+
+    def decrypt(self, enc, associated_data=b""):
+        """
+        Verify and decrypt a message.
+        :param enc: counter + ciphertext + tag
+        :param associated_data: same associated data that was given to encrypt.
+        :return: Message decrypted. type: bytes.
+        Raises ValueError if the message was tampered with, replayed or is older than the last one received.
+        """
+        if len(enc) < self.overhead:
+            raise ValueError("Message too short")
+        counter = bytes(enc[:self.counter_size])
+        ciphertext = bytes(enc[self.counter_size:-self.tag_size])
+        nonce = self.recv_prefix + counter
+        if not hmac.compare_digest(self._tag(nonce, associated_data, ciphertext), enc[-self.tag_size:]):
+            raise ValueError("Message authentication failed")
+        counter_value = int.from_bytes(counter, "big")
+        if counter_value <= self.last_recv_counter:
+            raise ValueError(f"Stale message counter {counter_value}, last was {self.last_recv_counter}")
+        self.last_recv_counter = counter_value
+        return self._xor_key_stream(ciphertext, nonce)
+
+    def _xor_key_stream(self, data, nonce):
+        """
+        AES-CTR: xor data with the encrypted counter blocks nonce + block index.
+        :param data: bytes to encrypt or decrypt
+        :param nonce: 12 bytes nonce of the message
+        :return: data xored with the key stream
+        """
+        if not data:
+            return b""
+        blocks_amount = (len(data) + self.bs - 1) // self.bs
+        if blocks_amount > self.max_key_stream_blocks:
+            return AES.new(self.key, AES.MODE_CTR, nonce=nonce, initial_value=0).encrypt(data)
+        key_stream = self.ecb_cipher.encrypt(b"".join(nonce + i.to_bytes(4, "big") for i in range(blocks_amount)))
+        data_value = int.from_bytes(data, "big") ^ int.from_bytes(key_stream[:len(data)], "big")
+        return data_value.to_bytes(len(data), "big")
+
+    def _tag(self, nonce, associated_data, ciphertext):
+        """
+        The nonce carries the direction prefix, so a message is never accepted by the side that sent it.
+        :return: Truncated HMAC of the nonce, the associated data and the ciphertext.
+        """
+        mac = self.hmac.copy()
+        mac.update(nonce)
+        mac.update(len(associated_data).to_bytes(4, "big"))
+        mac.update(associated_data)
+        mac.update(ciphertext)
+        return mac.digest()[:self.tag_size]
@@ -0,0 +1,161 @@
+import asyncio
+import socket
+
+from network.communication import HANDSHAKE_TIMEOUT, KEY_EXCHANGE_ECDH, TCPStream
+from network.socket_profiles import apply_socket_profile
+
+
+class AsyncTCPStream:
+    """
+    asyncio counterpart of TCPStream, with the same framing and encryption.
+    The handshake is done by a TCPStream, and frames are then read and written through asyncio streams.
+    """
+
+    def __init__(self, tcp_stream: TCPStream, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Initialize AsyncTCPStream object. Use AsyncTCPStream.create instead.
+        :param tcp_stream: TCPStream that did the handshake, holds the framing and cipher state.
+        :param reader: asyncio.StreamReader of the socket
+        :param writer: asyncio.StreamWriter of the socket
+        """
+        self.tcp_stream = tcp_stream
+        self.reader = reader
+        self.writer = writer
+        self.header_size = tcp_stream.msg_size_header_size
+
+    @staticmethod
+    async def create(tcp_stream: TCPStream):
+        """
+        :param tcp_stream: TCPStream that did the handshake on a connected socket
+        :return: AsyncTCPStream over the same socket
+        """
+        reader, writer = await asyncio.open_connection(sock=tcp_stream.sock)
+        return AsyncTCPStream(tcp_stream, reader, writer)
+
+    async def recv_by_size(self):
+        """
+        Receive a message, same as TCPStream.recv_by_size.
+        Raises ConnectionError if the connection was closed.
+        :return: content_length, content
+        """
+        try:
+            header = await self.reader.readexactly(self.header_size)
+            prefix_size, content_length = self.tcp_stream.get_frame_layout(header)
+            content = await self.reader.readexactly(content_length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Connection closed by peer")
+        message = bytearray(prefix_size) + content
+        return content_length, self.tcp_stream.decode_message(header, memoryview(message))
+
+    async def send_by_size(self, message):
+        """
+        Send a message, same as TCPStream.send_by_size.
+        :param message:
+        """
+        self.writer.writelines(self.tcp_stream.encode_message(message))
+        await self.writer.drain()
+
+    def send_nowait(self, message):
+        """
+        Queue a message on the writer without waiting for it to drain. Must be called from the event loop.
+        :param message:
+        """
+        self.writer.writelines(self.tcp_stream.encode_message(message))
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncTCPServer:
+    """
+    asyncio counterpart of TCPServer. Each client is handled by a coroutine on the event loop.
+    """
+
+    def __init__(self, address, recv_size, listen_amount=5, key_exchange=KEY_EXCHANGE_ECDH,
+                 socket_profile: dict = None):
+        """
+        Initialize AsyncTCPServer object.
+        :param address: host address
+        :param recv_size: how many bytes to receive every time
+        :param listen_amount: How long to set the waiting line
+        :param key_exchange: KEY_EXCHANGE_ECDH or KEY_EXCHANGE_RSA, see TCPStream
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile, applied to the listening socket
+        and to every accepted client socket.
+        """
+        self.address = address
+        self.recv_size = recv_size
+        self.listen_amount = listen_amount
+        self.key_exchange = key_exchange
+        self.socket_profile = socket_profile
+        self.session_tickets = {}
+        self.extra_capabilities = []
+        self.session_tasks = set()
+        self.running = True
+
+    async def serve(self, handle_client):
+        """
+        Accept clients until self.running is False.
+        :param handle_client: coroutine function called with (AsyncTCPStream, client_address) for every client.
+        """
+        loop = asyncio.get_running_loop()
+        listener = socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        print(f"[Log] - Socket settings of {self.address}: {apply_socket_profile(listener, self.socket_profile)}")
+        listener.bind(self.address)
+        listener.listen(self.listen_amount)
+        listener.setblocking(False)
+        print("[Log] - Server running on address: ", self.address)
+        while self.running:
+            try:
+                client_socket, client_address = await asyncio.wait_for(loop.sock_accept(listener), 0.5)
+            except asyncio.TimeoutError:
+                continue
+            apply_socket_profile(client_socket, self.socket_profile)
+            task = asyncio.create_task(self.__start_session(client_socket, client_address, handle_client))
+            self.session_tasks.add(task)
+            task.add_done_callback(self.session_tasks.discard)
+        listener.close()
+
+    async def __start_session(self, client_socket, client_address, handle_client):
+        """
+        Do the blocking handshake in an executor, so the event loop keeps running, then hand the client over.
+        """
+        loop = asyncio.get_running_loop()
+        client_socket.settimeout(HANDSHAKE_TIMEOUT * 5)
+        try:
+            tcp_stream = await loop.run_in_executor(None, self.__handshake, client_socket)
+        except (OSError, ValueError) as e:
+            print(f"[Log] - Handshake with {client_address} failed: {e}")
+            client_socket.close()
+            return
+        await handle_client(await AsyncTCPStream.create(tcp_stream), client_address)
+
+    def __handshake(self, client_socket):
+        """
+        :return: TCPStream that did the handshake with the client
+        """
+        tcp_stream = TCPStream(client_socket, self.recv_size, 4, 8, 1024, True, key_exchange=self.key_exchange,
+                               session_tickets=self.session_tickets, extra_capabilities=self.extra_capabilities)
+        client_socket.settimeout(None)
+        return tcp_stream
+
+
+class UDPControlProtocol(asyncio.DatagramProtocol):
+    """
+    asyncio counterpart of the udp control server thread. Datagrams are decoded on the event loop as they arrive.
+    """
+
+    def __init__(self, udp_control, handle_message):
+        """
+        Initialize UDPControlProtocol object
+        :param udp_control: UDPControlReceiver
+        :param handle_message: function called with (message, owner of its lane) for every message that was not
+        dropped.
+        """
+        self.udp_control = udp_control
+        self.handle_message = handle_message
+
+    def datagram_received(self, data, addr):
+        message, owner = self.udp_control.decode(data)
+        if message is not None:
+            self.handle_message(message, owner)
@@ -0,0 +1,217 @@
+import struct
+import threading
+import time
+
+from network.protocol import PICommunication
+
+# {field group: samples per second}, for groups missing from constants.json
+CAR_STATE_RATES = {"drive": 20.0, "camera": 10.0}
+CAR_STATE_CODE = PICommunication.MessageCode.CAR_STATE.value.encode()
+CAR_STATE_FIELDS_CODE = PICommunication.MessageCode.CAR_STATE_FIELDS.value.encode()
+
+
+def get_car_state_rates(constants):
+    """
+    :param constants: json containing constants
+    :return: {field group: samples per second}, constants["car_state"] over CAR_STATE_RATES.
+    """
+    rates = dict(CAR_STATE_RATES)
+    rates.update({group: float(rate) for group, rate in constants.get("car_state", {}).items()})
+    return rates
+
+
+class CarStatePublisher:
+    """
+    Server side of the car state push. Samples every field group at its own rate, and sends subscribers only the fields
+    that changed since the last tick. A new subscriber first gets the field names and every current value.
+    Not thread safe except subscribe and unsubscribe: tick must be called from a single thread.
+    """
+
+    def __init__(self, groups: dict, rates: dict = None):
+        """
+        Initialize CarStatePublisher object
+        :param groups: {field group: function returning {field name: value}}, such as car.get_drive_state
+        :param rates: {field group: samples per second}, CAR_STATE_RATES for groups missing from it.
+        """
+        rates = rates if rates is not None else CAR_STATE_RATES
+        self.groups = groups
+        self.intervals = {group: 1.0 / rates.get(group, CAR_STATE_RATES.get(group, 1.0)) for group in groups}
+        # The fastest group sets the tick, the others are sampled every few ticks.
+        self.tick_interval = min(self.intervals.values())
+        self.next_samples = {group: 0.0 for group in groups}
+        self.field_ids = {}
+        self.field_names = []
+        self.values = []
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.new_subscribers = []
+        self.sent_messages = 0
+        self.sent_bytes = 0
+        self.sent_fields = 0
+
+    def subscribe(self, send):
+        """
+        :param send: function that sends a message to the subscriber. Called from tick.
+        """
+        self.lock.acquire()
+        if send not in self.subscribers and send not in self.new_subscribers:
+            self.new_subscribers.append(send)
+        self.lock.release()
+
+    def unsubscribe(self, send):
+        self.lock.acquire()
+        for subscribers in (self.subscribers, self.new_subscribers):
+            if send in subscribers:
+                subscribers.remove(send)
+        self.lock.release()
+
+    def tick(self):
+        """
+        Sample the groups that are due, and send the fields that changed.
+        """
+        now = time.monotonic()
+        changed_fields = {}
+        new_field_names = False
+        for group, read_state in self.groups.items():
+            if now < self.next_samples[group]:
+                continue
+            self.next_samples[group] = max(self.next_samples[group] + self.intervals[group], now)
+            for name, value in read_state().items():
+                field_id = self.field_ids.get(name)
+                if field_id is None:
+                    field_id = self.__add_field(name)
+                    new_field_names = True
+                # Compare as sent on the wire, so values that differ beyond float precision aren't resent.
+                value = struct.unpack("!f", struct.pack("!f", value))[0]
+                if self.values[field_id] != value:
+                    self.values[field_id] = value
+                    changed_fields[field_id] = value
+
+        self.lock.acquire()
+        new_subscribers = self.new_subscribers
+        self.new_subscribers = []
+        subscribers = list(self.subscribers)
+        self.subscribers += new_subscribers
+        self.lock.release()
+
+        if new_subscribers:
+            snapshot = [PICommunication.car_state_fields(self.field_names),
+                        PICommunication.car_state({field_id: value for field_id, value in enumerate(self.values)
+                                                   if value is not None})]
+            self.__send(new_subscribers, snapshot, len(self.values))
+        messages = []
+        if new_field_names:
+            messages.append(PICommunication.car_state_fields(self.field_names))
+        if changed_fields:
+            messages.append(PICommunication.car_state(changed_fields))
+        self.__send(subscribers, messages, len(changed_fields))
+
+    def get_counters(self):
+        """
+        :return: {"subscribers", "messages": messages sent, "bytes": bytes sent, "fields": field values sent}
+        """
+        return {"subscribers": len(self.subscribers) + len(self.new_subscribers), "messages": self.sent_messages,
+                "bytes": self.sent_bytes, "fields": self.sent_fields}
+
+    def __add_field(self, name):
+        """
+        :return: id of the new field
+        """
+        if len(self.field_names) >= PICommunication.car_state_max_fields:
+            raise ValueError("Too many car state fields")
+        self.field_ids[name] = len(self.field_names)
+        self.field_names.append(name)
+        self.values.append(None)
+        return self.field_ids[name]
+
+    def __send(self, subscribers, messages, field_count):
+        """
+        Send messages to subscribers. Subscribers that fail are unsubscribed.
+        """
+        if not messages:
+            return
+        for send in subscribers:
+            try:
+                for message in messages:
+                    send(message)
+            except (ConnectionError, OSError) as e:
+                print(f"[Log] - Failed pushing car state ({e}), unsubscribing")
+                self.unsubscribe(send)
+                continue
+            self.sent_messages += len(messages)
+            self.sent_bytes += sum(len(message) for message in messages)
+            self.sent_fields += field_count
+
+
+class CarStateReceiver:
+    """
+    Client side of the car state push. Keeps the latest value of every field, and calls its listeners with the fields
+    that changed whenever the server pushes an update, so nobody has to poll.
+    """
+
+    def __init__(self):
+        """
+        Initialize CarStateReceiver object
+        """
+        self.lock = threading.Lock()
+        self.field_names = []
+        self.state = {}
+        self.listeners = []
+        self.received_updates = 0
+        self.received_bytes = 0
+        self.last_update_time = None
+
+    def add_listener(self, listener):
+        """
+        :param listener: function called with ({field name: value} of the changed fields, copy of the whole state) on
+        every update. Called from the thread that receives from the server.
+        """
+        self.listeners.append(listener)
+
+    def handle_message(self, code, content):
+        """
+        :param code: code of a car state or car state fields message
+        :param content: content of the message
+        :return: Whether the message was a car state message.
+        """
+        if code == CAR_STATE_FIELDS_CODE:
+            self.lock.acquire()
+            self.field_names = PICommunication.parse_car_state_fields(content)
+            self.lock.release()
+        elif code == CAR_STATE_CODE:
+            changes = {}
+            self.lock.acquire()
+            for field_id, value in PICommunication.parse_car_state(content).items():
+                if field_id < len(self.field_names):
+                    changes[self.field_names[field_id]] = value
+            self.state.update(changes)
+            state = dict(self.state)
+            self.received_updates += 1
+            self.received_bytes += len(content) + PICommunication.msg_code_size
+            self.last_update_time = time.monotonic()
+            self.lock.release()
+            for listener in self.listeners:
+                try:
+                    listener(changes, state)
+                except Exception as e:
+                    print(f"[Log] Car state listener failed: {e}")
+        else:
+            return False
+        return True
+
+    def get_state(self):
+        """
+        :return: {field name: value} of every field received so far
+        """
+        self.lock.acquire()
+        state = dict(self.state)
+        self.lock.release()
+        return state
+
+    def get_counters(self):
+        """
+        :return: {"updates": car state messages received, "bytes": bytes received, "age_ms": time since the last
+        update, None if there was none}
+        """
+        age = None if self.last_update_time is None else round((time.monotonic() - self.last_update_time) * 1000, 3)
+        return {"updates": self.received_updates, "bytes": self.received_bytes, "age_ms": age}
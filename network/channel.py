@@ -0,0 +1,83 @@
+import collections
+import threading
+
+# Only the latest item is kept, so a slow consumer always gets the freshest one.
+MODE_LATEST = "latest"
+# The latest capacity items are kept, the oldest one is dropped when a new one arrives while full.
+MODE_RING = "ring"
+
+
+class Channel:
+    """
+    Bounded channel between threads. A producer never blocks and memory never grows: when the channel is full, the
+    oldest item is dropped to make room for the new one, and counted. A consumer that falls behind skips items instead
+    of falling further behind.
+    """
+
+    def __init__(self, name, mode: str = MODE_LATEST, capacity: int = 1):
+        """
+        Initialize Channel object
+        :param name: name of the channel in logs
+        :param mode: MODE_LATEST or MODE_RING
+        :param capacity: How many items a MODE_RING channel keeps. A MODE_LATEST channel keeps one.
+        """
+        if mode not in (MODE_LATEST, MODE_RING):
+            raise ValueError(f"Unknown channel mode: {mode}")
+        if capacity < 1:
+            raise ValueError("Channel capacity must be at least 1")
+        self.name = name
+        self.mode = mode
+        self.capacity = 1 if mode == MODE_LATEST else capacity
+        self.condition = threading.Condition()
+        self.items = collections.deque()
+        self.put_items = 0
+        self.got_items = 0
+        self.dropped_items = 0
+        self.max_depth = 0
+
+    def put(self, item):
+        """
+        :param item: item to send, anything but None
+        :return: Whether an older item was dropped to make room for it.
+        """
+        self.condition.acquire()
+        dropped = len(self.items) >= self.capacity
+        if dropped:
+            self.items.popleft()
+            self.dropped_items += 1
+        self.items.append(item)
+        self.put_items += 1
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.condition.notify()
+        self.condition.release()
+        return dropped
+
+    def get(self, timeout: float = None):
+        """
+        :param timeout: seconds to wait for an item, None to wait forever and 0 to not wait.
+        :return: the oldest item kept, None if there was none within timeout.
+        """
+        self.condition.acquire()
+        if timeout != 0:
+            self.condition.wait_for(lambda: self.items, timeout=timeout)
+        item = self.items.popleft() if self.items else None
+        if item is not None:
+            self.got_items += 1
+        self.condition.release()
+        return item
+
+    def get_nowait(self):
+        """
+        :return: the oldest item kept, None if there is none.
+        """
+        return self.get(timeout=0)
+
+    def __len__(self):
+        return len(self.items)
+
+    def get_counters(self):
+        """
+        :return: {"put", "got", "dropped": items, "depth": items waiting, "max_depth": most items that waited at once}
+        """
+        return {"put": self.put_items, "got": self.got_items, "dropped": self.dropped_items, "depth": len(self.items),
+                "max_depth": self.max_depth}
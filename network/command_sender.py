@@ -0,0 +1,371 @@
+import select
+import socket
+import struct
+import threading
+import time
+
+from network.protocol import COMMAND_AXES, PICommunication
+
+MessageCode = PICommunication.MessageCode
+
+# Axes whose commands set a state, so repeating the last sent command changes nothing. Camera commands move the
+# camera by a step, so they are only coalesced while pending.
+STATE_AXES = {"drive", "speed"}
+# Drive commands that can carry a duration. With one they are timed maneuvers, which are not a state to repeat.
+TIMED_CODES = {
+    MessageCode.MOVE_FORWARD.value.encode(),
+    MessageCode.MOVE_BACKWARDS.value.encode(),
+    MessageCode.TURN_LEFT.value.encode(),
+    MessageCode.TURN_RIGHT.value.encode(),
+}
+URGENT_CODES = {MessageCode.STOP.value.encode()}
+# Disconnects and control handoffs are handled by the server as they arrive, outside of batches.
+UNBATCHABLE_CODES = {MessageCode.BATCH.value.encode(), MessageCode.DISCONNECT.value.encode(),
+                     MessageCode.TAKE_CONTROL.value.encode(), MessageCode.RELEASE_CONTROL.value.encode()}
+ACK_CODE = MessageCode.ACK.value.encode()
+DISCONNECT_CODE = MessageCode.DISCONNECT.value.encode()
+ERROR_CODE = MessageCode.ERROR.value.encode()
+PONG_CODE = MessageCode.PONG.value.encode()
+ROLE_CODE = MessageCode.ROLE.value.encode()
+# Not available on windows, where the peek of a socket that was just read may block until the next message.
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0)
+
+
+def is_timed_maneuver(message):
+    """
+    :param message: message from PICommunication
+    :return: Whether the message is a drive command with a duration.
+    """
+    code = message[:PICommunication.msg_code_size]
+    try:
+        return code in TIMED_CODES and PICommunication.parse_duration(message[PICommunication.msg_code_size:]) > 0
+    except ValueError:
+        return False
+
+
+class CommandSender:
+    """
+    Sends commands to the server from its own thread, so a slow socket never stalls the gui loop.
+    Pending commands on the same axis are merged so only the latest one is sent, and commands that repeat the current
+    state of the car are dropped. Pending commands are flushed every tick, or right away for STOP, and the commands of
+    a flush are sent in the order they were queued, consecutive ones on the same lane as a single batch frame.
+    When a udp control lane is available, commands with an axis are sent over it, so a lost packet never holds back the
+    commands after it, and the drive state is resent every refresh_interval to make up for lost datagrams. STOP always
+    goes over tcp, so stopping the car never depends on a datagram arriving.
+    Timed maneuvers are never merged, dropped as repeats or resent, so each one runs once. Nothing would make up for a
+    lost one, so they go over tcp too.
+    A second thread handles what the server sends back: the role of the client and errors, and with telemetry, where
+    every frame gets a sequence number and the server is pinged every ping_interval, the pongs and acks. The same
+    thread hands the car state the server pushes to car_state.
+    """
+
+    def __init__(self, tcp_stream, tick: float = 0.02, reconnect=None, create_udp_lane=None,
+                 refresh_interval: float = 0.1, telemetry=None, ping_interval: float = 1.0, car_state=None):
+        """
+        Initialize a CommandSender object and start its thread.
+        :param tcp_stream: TCPStream to the server
+        :param tick: How often to flush pending commands, in seconds.
+        :param reconnect: function called with the dropped TCPStream when a send fails, returns a new TCPStream.
+        None to stop sending.
+        :param create_udp_lane: function called with the TCPStream, returns a UDPControlSender or None. None to send
+        everything over tcp.
+        :param refresh_interval: How often to resend the drive state over the udp lane, in seconds.
+        :param telemetry: ControlTelemetry to measure round trips and command latency with, None to measure nothing.
+        :param ping_interval: How often to ping the server when telemetry is given, in seconds.
+        :param car_state: CarStateReceiver to subscribe to the car state with, None to not subscribe.
+        """
+        self.tcp_stream = tcp_stream
+        self.tick = tick
+        self.reconnect = reconnect
+        self.create_udp_lane = create_udp_lane
+        self.udp_lane = create_udp_lane(tcp_stream) if create_udp_lane is not None else None
+        self.refresh_interval = refresh_interval
+        self.telemetry = telemetry
+        self.ping_interval = ping_interval
+        self.car_state = car_state
+        self.role = None
+        self.condition = threading.Condition()
+        self.pending = []
+        self.pending_axes = {}
+        self.last_sent = {}
+        self.urgent = False
+        self.running = True
+        self.sent_commands = 0
+        self.coalesced_commands = 0
+        self.refreshed_commands = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        # The server pushes the role of the client at any time, so it is always read.
+        self.receiving = True
+        self.receiver_thread = threading.Thread(target=self.receive, daemon=True)
+        self.receiver_thread.start()
+        if car_state is not None:
+            self.tcp_stream.send_by_size(PICommunication.subscribe_car_state())
+
+    def send(self, message):
+        """
+        Queue a command. Never blocks on the network.
+        :param message: message from PICommunication
+        """
+        code = message[:PICommunication.msg_code_size]
+        axis = COMMAND_AXES.get(code)
+        self.condition.acquire()
+        if axis is not None and is_timed_maneuver(message):
+            # Commands queued after the maneuver must be sent after it too.
+            self.pending_axes.pop(axis, None)
+            self.pending.append((axis, message))
+        elif axis is not None and axis in self.pending_axes:
+            self.pending[self.pending_axes[axis]] = (axis, message)
+            self.coalesced_commands += 1
+        else:
+            if axis is not None:
+                self.pending_axes[axis] = len(self.pending)
+            self.pending.append((axis, message))
+        if code in URGENT_CODES:
+            self.urgent = True
+            self.condition.notify()
+        self.condition.release()
+
+    def get_counters(self):
+        """
+        :return: {"sent": commands sent, "coalesced": commands merged or dropped instead of being sent,
+        "refreshed": commands resent over the udp lane}
+        """
+        return {"sent": self.sent_commands, "coalesced": self.coalesced_commands,
+                "refreshed": self.refreshed_commands}
+
+    def close(self):
+        """
+        Flush pending commands and stop the thread.
+        """
+        self.condition.acquire()
+        self.running = False
+        self.condition.notify()
+        self.condition.release()
+        self.thread.join()
+        self.receiving = False
+        self.receiver_thread.join()
+        if self.udp_lane is not None:
+            self.udp_lane.close()
+
+    def run(self):
+        """
+        Flush pending commands every tick, or as soon as an urgent command is queued, until closed.
+        """
+        next_flush = time.monotonic()
+        next_refresh = next_flush + self.refresh_interval
+        next_ping = next_flush
+        while True:
+            self.condition.acquire()
+            self.condition.wait_for(lambda: self.urgent or not self.running,
+                                    timeout=max(0.0, next_flush - time.monotonic()))
+            commands = self.pending
+            self.pending = []
+            self.pending_axes = {}
+            self.urgent = False
+            running = self.running
+            self.condition.release()
+
+            next_flush = time.monotonic() + self.tick
+            self.__send_commands(commands)
+            if not running:
+                break
+            if self.udp_lane is not None and next_flush >= next_refresh:
+                next_refresh = next_flush + self.refresh_interval
+                self.__refresh_state()
+            if self.telemetry is not None and next_flush >= next_ping:
+                next_ping = next_flush + self.ping_interval
+                try:
+                    self.tcp_stream.send_by_size(self.telemetry.ping())
+                except socket.error as e:
+                    print(f"[Log] Failed sending ping: {e}")
+
+    def receive(self):
+        """
+        Handle the messages of the server until closed or disconnected: answer pongs, record acks, print errors, keep
+        the role of the client and update the car state.
+        When the connection drops, waits for the sender thread to reconnect.
+        """
+        while self.receiving:
+            tcp_stream = self.tcp_stream
+            try:
+                readable, writable, errors = select.select([tcp_stream.sock], [], [], 0.5)
+                if not readable:
+                    continue
+                content_length, content = tcp_stream.recv_by_size()
+            except (ConnectionError, OSError, ValueError):
+                time.sleep(self.tick)
+                continue
+            code = content[:PICommunication.msg_code_size]
+            try:
+                if code in (PONG_CODE, ACK_CODE) and self.telemetry is None:
+                    continue
+                if code == PONG_CODE:
+                    reply = self.telemetry.handle_pong(content[PICommunication.msg_code_size:])
+                    if reply is not None:
+                        tcp_stream.send_by_size(reply)
+                elif code == ACK_CODE:
+                    self.telemetry.handle_ack(content[PICommunication.msg_code_size:])
+                elif code == ERROR_CODE:
+                    print(f"[Log] Server error: {content[PICommunication.msg_code_size:]}")
+                elif code == ROLE_CODE:
+                    self.role = bytes(content[PICommunication.msg_code_size:]).decode()
+                    print(f"[Log] Role: {self.role}")
+                elif code == DISCONNECT_CODE:
+                    break
+                elif self.car_state is not None:
+                    self.car_state.handle_message(code, content[PICommunication.msg_code_size:])
+            except (struct.error, socket.error, ValueError) as e:
+                print(f"[Log] Failed handling message {code} from server: {e}")
+
+    def __send_commands(self, commands):
+        """
+        Send the commands of a flush, except the ones that repeat the state last sent on their axis, in the order they
+        were queued. Consecutive commands that go over the same lane are sent as a single batch, and disconnects are
+        sent on their own, after the commands before them.
+        :param commands: list of (axis, message), in the order they were queued.
+        """
+        messages = []
+        use_udp_lane = False
+        for axis, message in commands:
+            if axis in STATE_AXES and self.last_sent.get(axis) == message:
+                self.coalesced_commands += 1
+                continue
+            message_use_udp_lane = self.__use_udp_lane(axis, message)
+            if messages and message_use_udp_lane != use_udp_lane:
+                self.__send_lane(messages, use_udp_lane)
+                messages = []
+            use_udp_lane = message_use_udp_lane
+            messages.append(message)
+        if messages:
+            self.__send_lane(messages, use_udp_lane)
+
+    def __send_lane(self, messages, use_udp_lane):
+        """
+        Send consecutive commands of a flush that go over the same lane.
+        :param messages: list of messages from PICommunication, in the order they were queued.
+        :param use_udp_lane: Whether to send over the udp lane instead of the tcp stream.
+        """
+        if use_udp_lane:
+            self.__send_messages(messages, True)
+            return
+        batch = []
+        for message in messages:
+            if message[:PICommunication.msg_code_size] in UNBATCHABLE_CODES or \
+                    len(message) - PICommunication.msg_code_size > PICommunication.batch_max_content_size:
+                if batch:
+                    self.__send_messages(batch, False)
+                    batch = []
+                self.__send_messages([message], False)
+            else:
+                batch.append(message)
+        if batch:
+            self.__send_messages(batch, False)
+
+    def __use_udp_lane(self, axis, message):
+        """
+        :param axis: axis of the command, None if it has none.
+        :param message: message from PICommunication
+        :return: Whether to send the command over the udp lane instead of the tcp stream.
+        """
+        if self.udp_lane is None or axis is None:
+            return False
+        return message[:PICommunication.msg_code_size] not in URGENT_CODES and not is_timed_maneuver(message)
+
+    def __send_messages(self, messages, use_udp_lane):
+        """
+        Send messages in a single frame, as a batch if there are several. Reconnects if the connection dropped.
+        :param messages: list of messages from PICommunication
+        :param use_udp_lane: Whether to send over the udp lane instead of the tcp stream.
+        """
+        message = self.__sequence(messages[0] if len(messages) == 1 else PICommunication.batch(messages))
+        try:
+            if use_udp_lane and self.udp_lane is not None:
+                self.udp_lane.send(message)
+            else:
+                self.tcp_stream.send_by_size(message)
+        except socket.error as e:
+            if self.reconnect is None:
+                print(f"[Log] Failed sending command: {e}")
+                return
+            print(f"[Log] Connection to server dropped ({e}), reconnecting")
+            try:
+                self.__reconnect()
+                self.tcp_stream.send_by_size(message)
+            except socket.error as e:
+                print(f"[Log] Failed sending command: {e}")
+                return
+        for message in messages:
+            code = message[:PICommunication.msg_code_size]
+            if code == MessageCode.BATCH.value.encode():
+                batched_messages = PICommunication.split_batch(message[PICommunication.msg_code_size:])
+            else:
+                batched_messages = [message]
+            for batched_message in batched_messages:
+                axis = COMMAND_AXES.get(batched_message[:PICommunication.msg_code_size])
+                if axis is not None and is_timed_maneuver(batched_message):
+                    # The maneuver ends with the car stopped, so there is no state left to refresh.
+                    self.last_sent.pop(axis, None)
+                elif axis is not None:
+                    self.last_sent[axis] = batched_message
+        self.sent_commands += len(messages)
+
+    def __refresh_state(self):
+        """
+        Resend the last drive and speed commands over the udp lane, so a lost datagram is made up for within
+        refresh_interval. Nothing is read from the tcp stream while commands go over udp, so this is also where a
+        dropped connection is noticed.
+        """
+        if not self.__tcp_stream_alive():
+            if self.reconnect is None:
+                return
+            print("[Log] Connection to server dropped, reconnecting")
+            try:
+                self.__reconnect()
+            except socket.error as e:
+                print(f"[Log] Failed reconnecting: {e}")
+                return
+        messages = [self.last_sent[axis] for axis in STATE_AXES if axis in self.last_sent]
+        if not messages or self.udp_lane is None:
+            return
+        try:
+            self.udp_lane.send(self.__sequence(messages[0] if len(messages) == 1 else PICommunication.batch(messages)))
+        except socket.error as e:
+            print(f"[Log] Failed sending command: {e}")
+            return
+        self.refreshed_commands += len(messages)
+
+    def __sequence(self, message):
+        """
+        :return: message with a sequence number when measuring telemetry, except disconnects, which are never acked.
+        """
+        if self.telemetry is None or message[:PICommunication.msg_code_size] == DISCONNECT_CODE:
+            return message
+        return self.telemetry.sequence(message)
+
+    def __tcp_stream_alive(self):
+        """
+        :return: Whether the tcp stream is still connected, without blocking or consuming any data.
+        """
+        try:
+            readable, writable, errors = select.select([self.tcp_stream.sock], [], [], 0)
+            # The receiver thread may read the data first, so the peek must not block.
+            return not readable or self.tcp_stream.sock.recv(1, socket.MSG_PEEK | MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except (socket.error, ValueError):
+            return False
+
+    def __reconnect(self):
+        """
+        Replace the dropped tcp stream, and the udp lane of its session.
+        """
+        self.tcp_stream = self.reconnect(self.tcp_stream)
+        # The server stops the car when the connection drops, so the state we sent is gone.
+        self.last_sent = {}
+        if self.create_udp_lane is not None:
+            if self.udp_lane is not None:
+                self.udp_lane.close()
+            self.udp_lane = self.create_udp_lane(self.tcp_stream)
+        if self.car_state is not None:
+            self.tcp_stream.send_by_size(PICommunication.subscribe_car_state())
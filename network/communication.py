@@ -1,23 +1,61 @@
+import queue
+import selectors
 import socket
+import struct
 import sys
 import threading
+import time
 from os import urandom
 
 from Crypto import Random
 from Crypto.Cipher import PKCS1_OAEP
-from Crypto.PublicKey import RSA
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import import_x25519_public_key, key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import ECC, RSA
 
-from network.aes_utils import AESCipher
+from network.aes_utils import AESCipher, AESCTRHMACCipher
+from network.socket_profiles import apply_socket_profile
 
 RSA_KEY_SIZE = 128
 
+# Binary framing: the first byte of the header is BINARY_FRAME_MARKER | flags, which can never be an ascii digit of the
+# legacy zfill header, so both framings can be told apart per message. The rest of the first word is the payload length,
+# followed by the message code.
+BINARY_FRAME_HEADER = struct.Struct("!I4s")
+BINARY_FRAME_MARKER = 0xB0
+BINARY_FRAME_MAX_LENGTH = 0xFFFFFF
+CAPABILITY_AES_CTR_HMAC = b"aes-ctr-hmac"
+CAPABILITY_BINARY_FRAMING = b"binary-framing"
+CIPHER_MODE_AES_CBC = "aes-cbc"
+CIPHER_MODE_AES_CTR_HMAC = "aes-ctr-hmac"
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+FRAME_FLAG_AES_CTR_HMAC = 0x01
+ECDH_HANDSHAKE_PREFIX = b"ECDH"
+HANDSHAKE_HELLO = b"HELO"
+HANDSHAKE_TIMEOUT = 1.0
+KEY_EXCHANGE_ECDH = "ecdh"
+KEY_EXCHANGE_RESUMED = "resumed"
+KEY_EXCHANGE_RSA = "rsa"
+SESSION_TICKET_LIFETIME = 600
+SESSION_TICKET_PREFIX = b"TCKT"
+SESSION_TICKET_REJECTED = b"FULL"
+SESSION_TICKET_SIZE = 16
+SESSION_TICKET_TOKEN = b"ticket="
+UDP_DRAIN_SIZE = 32
+UDP_QUEUE_CAPACITY = 1024
+
 
 class TCPStream:
     """
     Allowing tcp stream between client and server.
     """
 
-    def __init__(self, sock, recv_size, msg_code_size, msg_size_header_size, msg_chunk_size, is_server: bool = False):
+    def __init__(self, sock, recv_size, msg_code_size, msg_size_header_size, msg_chunk_size, is_server: bool = False,
+                 use_binary_framing: bool = True, cipher_mode: str = CIPHER_MODE_AES_CTR_HMAC,
+                 key_exchange: str = KEY_EXCHANGE_ECDH, session_tickets: dict = None, session_ticket: tuple = None,
+                 extra_capabilities: list = None):
         """
         Initialize TCPStream object
         :param sock: socket.socket
@@ -26,6 +64,19 @@ class TCPStream:
         :param msg_size_header_size: size of msg_size_header
         :param msg_chunk_size: size of msg_chunk
         :param is_server: Is the stream on the server side.
+        :param use_binary_framing: Offer (server) or accept (client) binary framing during the handshake. Peers that
+        don't support it keep using the ascii size header. Binary frames carry the code in the clear, so they are only
+        used together with AES-CTR+HMAC, which authenticates it.
+        :param cipher_mode: CIPHER_MODE_AES_CTR_HMAC to offer (server) or accept (client) AES-CTR+HMAC for binary
+        frames, or CIPHER_MODE_AES_CBC to always keep the base64 AES-CBC cipher and the ascii size header.
+        :param key_exchange: Server side only. KEY_EXCHANGE_ECDH for an ephemeral X25519 exchange, or KEY_EXCHANGE_RSA
+        for the per connection RSA key, which old clients require. The client follows whatever the server starts.
+        :param session_tickets: Server side only. {ticket: (session_key, expiry)} shared by all streams of a server.
+        When given, a ticket is issued in the hello, and clients presenting one resume without a key exchange.
+        :param session_ticket: Client side only. session_ticket of a previous stream, to resume its session when the
+        server starts an ECDH exchange.
+        :param extra_capabilities: Server side only. More capability tokens (bytes) to announce in the hello, for
+        features outside the stream, like the udp control lane.
     """
         self.sock = sock
         self.recv_size = recv_size
@@ -33,25 +84,62 @@ class TCPStream:
         self.msg_size_header_size = msg_size_header_size
         self.msg_chunk_size = msg_chunk_size
         self.is_server = is_server
+        self.key_exchange = key_exchange
+        self.handshake_time = None
+        self.session_key = None
+        # Server side only. session_key of the stream whose ticket this stream resumed, None if it did not resume.
+        self.resumed_session_key = None
+        self.session_tickets = session_tickets
+        self.session_ticket = session_ticket
+        self.extra_capabilities = extra_capabilities or []
+        self.use_binary_framing = use_binary_framing and msg_size_header_size == BINARY_FRAME_HEADER.size and \
+            cipher_mode == CIPHER_MODE_AES_CTR_HMAC
+        self.binary_framing_active = False
+        self.peer_capabilities = set()
+        self.use_aes_ctr_hmac = self.use_binary_framing
+        self.aes_ctr_hmac_active = False
         self.aes_cipher = None
+        self.aes_ctr_hmac_cipher = None
+        self.header_buffer = bytearray(msg_size_header_size)
+        self.header_view = memoryview(self.header_buffer)
+        self.recv_buffer = bytearray(recv_size)
+        self.recv_view = memoryview(self.recv_buffer)
+        self.send_lock = threading.Lock()
+        handshake_start = time.perf_counter()
         if self.is_server:
-            self.generate_aes_key_from_server_side()
+            if self.key_exchange == KEY_EXCHANGE_ECDH:
+                self.generate_aes_key_with_ecdh_from_server_side()
+            else:
+                self.generate_aes_key_from_server_side()
+            self.send_hello()
         else:
             self.generate_aes_key_from_client_side()
+            self.recv_hello()
+        self.handshake_time = time.perf_counter() - handshake_start
 
     def generate_aes_key_from_client_side(self):
         """
-        Generate aes keys with RSA from client side
-        :param is_server:
+        Generate aes keys with RSA from client side, or with ECDH if the server started an ECDH exchange.
         Creates AESCipher object for aes encryption.
         """
         data_length, data = self.recv_by_size()
+        if data.startswith(ECDH_HANDSHAKE_PREFIX):
+            self.key_exchange = KEY_EXCHANGE_ECDH
+            server_public_key = data[len(ECDH_HANDSHAKE_PREFIX):]
+            if self.session_ticket is not None and self.resume_session_from_client_side(server_public_key):
+                return
+            key = ECC.generate(curve="Curve25519")
+            client_public_key = key.public_key().export_key(format="raw")
+            self.send_by_size(ECDH_HANDSHAKE_PREFIX + client_public_key)
+            self.set_session_key(self.__derive_ecdh_key(key, server_public_key, server_public_key, client_public_key))
+            return
+        self.key_exchange = KEY_EXCHANGE_RSA
         pub_key = RSA.import_key(data, passphrase=None)
         rsa_cipher = PKCS1_OAEP.new(pub_key)
         aes_key = urandom(16)
         aes_key_ciphered = rsa_cipher.encrypt(aes_key)
         self.send_by_size(aes_key_ciphered)
-        self.aes_cipher = AESCipher(aes_key)
+        self.set_session_key(aes_key)
 
     def generate_aes_key_from_server_side(self):
         """
@@ -64,25 +152,167 @@ class TCPStream:
         cipher = PKCS1_OAEP.new(key)
         data_length, data = self.recv_by_size()
         aes_key = cipher.decrypt(data)
+        self.set_session_key(aes_key)
+
+    def generate_aes_key_with_ecdh_from_server_side(self):
+        """
+        Generate aes key with an ephemeral X25519 key exchange from server side. Takes milliseconds, unlike the RSA key
+        generation.
+        Creates AESCipher object for aes encryption.
+        """
+        key = ECC.generate(curve="Curve25519")
+        server_public_key = key.public_key().export_key(format="raw")
+        self.send_by_size(ECDH_HANDSHAKE_PREFIX + server_public_key)
+        data_length, data = self.recv_by_size()
+        if data.startswith(SESSION_TICKET_PREFIX):
+            if self.resume_session_from_server_side(data[len(SESSION_TICKET_PREFIX):], server_public_key):
+                return
+            data_length, data = self.recv_by_size()
+        if not data.startswith(ECDH_HANDSHAKE_PREFIX):
+            raise ValueError("Client does not support ECDH key exchange")
+        client_public_key = data[len(ECDH_HANDSHAKE_PREFIX):]
+        self.set_session_key(self.__derive_ecdh_key(key, client_public_key, server_public_key, client_public_key))
+
+    def resume_session_from_client_side(self, server_nonce):
+        """
+        Present self.session_ticket instead of doing a key exchange.
+        :param server_nonce: first handshake message of the server, fresh for every connection
+        :return: Whether the server accepted the ticket. If not, the caller continues with a full key exchange.
+        """
+        ticket, session_key = self.session_ticket
+        client_nonce = urandom(SESSION_TICKET_SIZE)
+        self.send_by_size(SESSION_TICKET_PREFIX + ticket + client_nonce)
+        data_length, data = self.recv_by_size()
+        if data != SESSION_TICKET_PREFIX:
+            return False
+        self.key_exchange = KEY_EXCHANGE_RESUMED
+        self.set_session_key(self.__derive_resumed_key(session_key, server_nonce, client_nonce))
+        return True
+
+    def resume_session_from_server_side(self, ticket_message, server_nonce):
+        """
+        Resume the session of a ticket issued by this server. Tickets are single use.
+        :param ticket_message: ticket followed by the client nonce
+        :param server_nonce: first handshake message of the server
+        :return: Whether the ticket was accepted. If not, the client is told to do a full key exchange.
+        """
+        ticket = ticket_message[:SESSION_TICKET_SIZE]
+        client_nonce = ticket_message[SESSION_TICKET_SIZE:]
+        session = self.session_tickets.pop(ticket, None) if self.session_tickets is not None else None
+        if session is None or session[1] < time.monotonic():
+            self.send_by_size(SESSION_TICKET_REJECTED)
+            return False
+        self.send_by_size(SESSION_TICKET_PREFIX)
+        self.key_exchange = KEY_EXCHANGE_RESUMED
+        self.resumed_session_key = session[0]
+        self.set_session_key(self.__derive_resumed_key(session[0], server_nonce, client_nonce))
+        return True
+
+    @staticmethod
+    def __derive_resumed_key(session_key, server_nonce, client_nonce):
+        """
+        The resumed session keeps the secret of the ticket, but gets fresh keys, so message counters can start over
+        without reusing a nonce.
+        :return: 16 bytes aes key
+        """
+        return HKDF(session_key, 16, b"", SHA256, context=SESSION_TICKET_PREFIX + server_nonce + client_nonce)
+
+    @staticmethod
+    def __derive_ecdh_key(private_key, peer_public_key, server_public_key, client_public_key):
+        """
+        :param private_key: our ephemeral X25519 key
+        :param peer_public_key: raw X25519 public key of the other side
+        :param server_public_key: raw public key of the server, bound into the derived key
+        :param client_public_key: raw public key of the client, bound into the derived key
+        :return: 16 bytes aes key
+        """
+        context = ECDH_HANDSHAKE_PREFIX + server_public_key + client_public_key
+        return key_agreement(eph_priv=private_key, eph_pub=import_x25519_public_key(peer_public_key),
+                             kdf=lambda shared_secret: HKDF(shared_secret, 16, b"", SHA256, context=context))
+
+    def set_session_key(self, aes_key):
+        """
+        Create the session ciphers from the exchanged key. The AES-CTR+HMAC keys are derived from it, so the two modes
+        never share a key.
+        :param aes_key: exchanged session key
+        """
+        self.session_key = aes_key
         self.aes_cipher = AESCipher(aes_key)
+        if self.use_aes_ctr_hmac:
+            aes_ctr_hmac_key = HKDF(aes_key, 32, b"", SHA256, context=CAPABILITY_AES_CTR_HMAC)
+            self.aes_ctr_hmac_cipher = AESCTRHMACCipher(aes_ctr_hmac_key, self.is_server)
+
+    def get_capabilities(self):
+        """
+        :return: List of the optional stream features supported by this side.
+        """
+        capabilities = []
+        if self.use_binary_framing:
+            capabilities.append(CAPABILITY_BINARY_FRAMING)
+        if self.use_aes_ctr_hmac:
+            capabilities.append(CAPABILITY_AES_CTR_HMAC)
+        return capabilities
+
+    def send_hello(self):
+        """
+        Send the capabilities of the server to the client, right after the key exchange, with a new session ticket if
+        tickets are enabled. Old clients never read it, so it is harmless for them.
+        """
+        capabilities = self.get_capabilities() + self.extra_capabilities
+        if self.session_tickets is not None:
+            capabilities.append(SESSION_TICKET_TOKEN + self.issue_session_ticket().hex().encode())
+        self.send_by_size(HANDSHAKE_HELLO + b" ".join(capabilities))
 
-    def recv_by_size(self):
+    def issue_session_ticket(self):
+        """
+        Store the session key under a new random ticket, and forget expired tickets.
+        :return: ticket
+        """
+        now = time.monotonic()
+        for ticket, session in list(self.session_tickets.items()):
+            if session[1] < now:
+                self.session_tickets.pop(ticket, None)
+        ticket = urandom(SESSION_TICKET_SIZE)
+        self.session_tickets[ticket] = (self.session_key, now + SESSION_TICKET_LIFETIME)
+        return ticket
+
+    def recv_hello(self):
+        """
+        Wait shortly for the server capabilities, and turn on the features both sides support.
+        Old servers don't send a hello, so the stream stays in legacy mode after HANDSHAKE_TIMEOUT.
+        """
+        result = self.recv_by_size_with_timeout(HANDSHAKE_TIMEOUT)
+        if not isinstance(result, tuple) or not result[1].startswith(HANDSHAKE_HELLO):
+            return
+        self.peer_capabilities = set()
+        self.session_ticket = None
+        for capability in result[1][len(HANDSHAKE_HELLO):].split():
+            if capability.startswith(SESSION_TICKET_TOKEN):
+                self.session_ticket = (bytes.fromhex(capability[len(SESSION_TICKET_TOKEN):].decode()), self.session_key)
+            else:
+                self.peer_capabilities.add(capability)
+        # Without AES-CTR+HMAC the code of a binary frame would go unencrypted and unauthenticated, so a server that
+        # lacks it gets the ascii size header, with the whole message encrypted.
+        if self.use_binary_framing and CAPABILITY_BINARY_FRAMING in self.peer_capabilities and \
+                CAPABILITY_AES_CTR_HMAC in self.peer_capabilities:
+            self.binary_framing_active = True
+            self.aes_ctr_hmac_active = True
+
+    def recv_by_size(self, zero_copy: bool = False):
         """
         Receive tcp message by a certain size mentioned in the first 8 characters of the message.
+        The message is read with recv_into into self.recv_buffer, which is reused between calls and only grows when a
+        larger message arrives.
+        :param zero_copy: Return a memoryview over self.recv_buffer instead of a bytes copy. Only applies to
+        unencrypted streams, and the view is valid until the next receive.
         :return: content_length, content
         """
-        size_header = ""
-        while len(size_header) < self.msg_size_header_size:
-            size_header += self.sock.recv(self.msg_size_header_size - len(size_header)).decode()
+        self.__recv_into(self.header_view)
+        prefix_size, content_length = self.get_frame_layout(self.header_buffer)
 
-        content_length = int(size_header)
-        content = b""
-        while len(content) < content_length:
-            content += self.sock.recv(content_length - len(content))
-
-        if self.aes_cipher is not None:
-            content = self.aes_cipher.decrypt(content)
-        return content_length, content
+        message = self.__get_recv_view(prefix_size + content_length)
+        self.__recv_into(message[prefix_size:])
+        return content_length, self.decode_message(self.header_buffer, message, zero_copy)
 
     def recv_by_size_with_timeout(self, interval):
         """
@@ -92,52 +322,147 @@ class TCPStream:
         :return: content_length, content
         """
         self.sock.settimeout(interval)
+        try:
+            return self.recv_by_size()
+        except socket.timeout:
+            return "Not received yet"
+        finally:
+            self.sock.settimeout(None)
+
+    def __get_recv_view(self, size):
+        """
+        :param size: Amount of bytes needed
+        :return: memoryview of the first size bytes of self.recv_buffer. The buffer grows only if it is too small.
+        """
+        if size > len(self.recv_buffer):
+            self.recv_buffer = bytearray(max(size, 2 * len(self.recv_buffer)))
+            self.recv_view = memoryview(self.recv_buffer)
+        return self.recv_view[:size]
 
-        size_header = ""
-        while len(size_header) < self.msg_size_header_size:
-            try:
-                size_header += self.sock.recv(self.msg_size_header_size - len(size_header)).decode()
-            except socket.timeout:
-                return "Not received yet"
-        content_length = int(size_header)
-        content = ""
-        while len(content) < content_length:
-            try:
-                content += self.sock.recv(content_length - len(content)).decode()
-            except socket.timeout:
-                return "Not received yet"
-
-        if self.aes_cipher is not None:
-            self.aes_cipher.decrypt(content)
-
-        return content_length, content
+    def __recv_into(self, view):
+        """
+        Fill view with bytes from the socket.
+        :param view: memoryview to receive into
+        """
+        received = 0
+        while received < len(view):
+            received_now = self.sock.recv_into(view[received:])
+            if not received_now:
+                raise ConnectionError("Connection closed by peer")
+            received += received_now
+
+    def get_frame_layout(self, header):
+        """
+        :param header: received header, self.msg_size_header_size bytes
+        :return: prefix_size, content_length. content_length bytes follow the header on the wire. Binary frames carry
+        the code in the header, so prefix_size bytes are reserved for it in front of the content, and the message is
+        never concatenated.
+        """
+        if header[0] & 0xF0 == BINARY_FRAME_MARKER:
+            first_word, code = BINARY_FRAME_HEADER.unpack(header)
+            return len(code), first_word & BINARY_FRAME_MAX_LENGTH
+        return 0, int(header)
 
-    def __split_by_len(self, seq, length):
+    def decode_message(self, header, message, zero_copy: bool = False):
         """
-        :param seq: Sequence to split
-        :param length: Chunks size
-        :return: List containing chunks of a sequence, split by length.
+        Decrypt a received frame.
+        :param header: received header
+        :param message: memoryview of prefix_size reserved bytes followed by the content, see get_frame_layout
+        :param zero_copy: Same as in recv_by_size
+        :return: message code followed by the content
         """
-        return [seq[x: x + length] for x in range(0, len(seq), length)]
+        if header[0] & 0xF0 != BINARY_FRAME_MARKER:
+            if self.aes_cipher is not None:
+                return self.aes_cipher.decrypt(message)
+            return message if zero_copy else message.tobytes()
+
+        first_word, code = BINARY_FRAME_HEADER.unpack(header)
+        flags = (first_word >> 24) & 0x0F
+        code_size = len(code)
+        message[:code_size] = code
+
+        if flags & FRAME_FLAG_AES_CTR_HMAC:
+            if self.aes_ctr_hmac_cipher is None:
+                raise ValueError("Received an AES-CTR+HMAC frame, but AES-CTR+HMAC was not offered")
+            decrypted_message = code + self.aes_ctr_hmac_cipher.decrypt(message[code_size:], bytes(header))
+            # The peer only sends binary frames after our hello, so we can answer in kind.
+            self.binary_framing_active = True
+            self.aes_ctr_hmac_active = True
+            return decrypted_message
+        if self.aes_cipher is not None:
+            # Its code could have been rewritten on the way, so the connection is dropped.
+            raise ValueError("Received a binary frame without AES-CTR+HMAC on an encrypted stream")
+        return message if zero_copy else message.tobytes()
 
     def send_by_size(self, message):
         """
         Sends message with the size in the beginning.
+        The header and the content are handed to the kernel together. Safe to call from several threads.
         :param message:
         """
+        self.send_lock.acquire()
+        try:
+            self.__send_buffers(self.encode_message(message))
+        finally:
+            self.send_lock.release()
+
+    def encode_message(self, message):
+        """
+        :param message: message code followed by the content
+        :return: header, payload. Ready to be sent, in the framing and cipher agreed on in the handshake.
+        """
+        if self.binary_framing_active:
+            return self.__encode_binary_frame(message)
         if self.aes_cipher is not None:
             message = self.aes_cipher.encrypt(message)
         header = str(len(message)).zfill(self.msg_size_header_size).encode()
-        self.sock.send(header)
-        chunks = self.__split_by_len(message, self.msg_chunk_size)
-        for chunk in chunks:
-            self.sock.send(chunk)
+        return [header, message]
+
+    def __encode_binary_frame(self, message):
+        """
+        :param message: message code followed by the content
+        :return: header, payload. Only the content is encrypted, and the header is authenticated. Streams without a
+        cipher send the message as is.
+        """
+        code = message[:self.msg_code_size]
+        payload = message[self.msg_code_size:]
+        if self.aes_ctr_hmac_active:
+            payload_length = len(payload) + AESCTRHMACCipher.overhead
+            if payload_length > BINARY_FRAME_MAX_LENGTH:
+                raise ValueError(f"Message of size {payload_length} is too long for a binary frame")
+            first_word = (BINARY_FRAME_MARKER | FRAME_FLAG_AES_CTR_HMAC) << 24 | payload_length
+            header = BINARY_FRAME_HEADER.pack(first_word, code)
+            return [header, self.aes_ctr_hmac_cipher.encrypt(payload, header)]
+        if self.aes_cipher is not None:
+            raise ValueError("Binary frames of an encrypted stream need AES-CTR+HMAC")
+        if len(payload) > BINARY_FRAME_MAX_LENGTH:
+            raise ValueError(f"Message of size {len(payload)} is too long for a binary frame")
+        header = BINARY_FRAME_HEADER.pack(BINARY_FRAME_MARKER << 24 | len(payload), code)
+        return [header, payload]
+
+    def __send_buffers(self, buffers):
+        """
+        Send all buffers with as few syscalls as possible, handling short writes.
+        Uses scatter-gather sendmsg where available (not on Windows), and a single sendall otherwise.
+        :param buffers: list of bytes-like objects
+        """
+        if not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(buffers))
+            return
+        buffers = [memoryview(buffer) for buffer in buffers if len(buffer)]
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if buffers:
+                buffers[0] = buffers[0][sent:]
 
 
 class TCPServer(socket.socket):
 
     def __init__(self, address, recv_size, msg_code_size=4, msg_size_header_size=8, msg_chunk_size=1024, running=True,
-                 listen_amount=5):
+                 listen_amount=5, key_exchange=KEY_EXCHANGE_ECDH, socket_profile: dict = None):
         """
         Initialize TCPServer object.
         :param recv_size: how many bytes to receive every time
@@ -147,81 +472,219 @@ class TCPServer(socket.socket):
         :param address: host address
         :param running: Whether the server is running
         :param listen_amount: How long to set the waiting line
+        :param key_exchange: KEY_EXCHANGE_ECDH or KEY_EXCHANGE_RSA, see TCPStream
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile, applied to the listening socket
+        and to every accepted client socket.
         """
         super().__init__()
-        # self.tcp_stream = TCPStream(recv_size, msg_code_size, msg_size_header_size, msg_chunk_size)
         self.recv_size = recv_size
         self.msg_code_size = msg_code_size
         self.msg_size_header_size = msg_size_header_size
         self.msg_chunk_size = msg_chunk_size
         self.address = address
         self.listen_amount = listen_amount
+        self.key_exchange = key_exchange
+        self.socket_profile = socket_profile
+        self.session_tickets = {}
+        self.extra_capabilities = []
         self.running = True
-        self.client_socket = None
-        self.client_address = "127.0.0.1"
-        self.lock = threading.Lock()
+        self.accepted_clients = queue.Queue()
 
-    def get_client(self):
+    def get_client(self, timeout=None):
+        """
+        Waits until a client connects, without spinning, and does the handshake with it.
+        Clients that fail the handshake are dropped, and the next client is waited for. The handshake runs on the
+        calling thread, so servers with many clients should use get_client_socket and handshake instead.
+        :param timeout: How long to wait for a client, None to wait as long as the server runs.
+        :return: TCPStream object created from client, client address. None, None if no client arrived in time.
         """
-        :return: Waits until a client connects and returns a TCPStream object created from client
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.running:
+            wait_time = None if deadline is None else deadline - time.monotonic()
+            if wait_time is not None and wait_time <= 0:
+                break
+            client_socket, client_address = self.get_client_socket(wait_time)
+            if client_socket is None:
+                continue
+            client_tcp_stream = self.handshake(client_socket, client_address)
+            if client_tcp_stream is not None:
+                return client_tcp_stream, client_address
+        return None, None
+
+    def get_client_socket(self, timeout=None):
+        """
+        Waits until a client connects, without spinning.
+        :param timeout: How long to wait for a client, None to wait as long as the server runs.
+        :return: socket of the client before its handshake, client address. None, None if no client arrived in time.
         """
+        deadline = None if timeout is None else time.monotonic() + timeout
         while self.running:
-            if isinstance(self.client_socket, socket.socket):
-                client_tcp_stream = TCPStream(self.client_socket, 1024, 4, 8, 1024, True)
-                return client_tcp_stream, self.client_address
+            wait_time = 0.5 if deadline is None else min(0.5, deadline - time.monotonic())
+            if wait_time <= 0:
+                break
+            try:
+                return self.accepted_clients.get(timeout=wait_time)
+            except queue.Empty:
+                continue
+        return None, None
+
+    def handshake(self, client_socket, client_address):
+        """
+        Do the handshake with a client from get_client_socket. Blocks for up to a few handshake timeouts, so every
+        client should do it on its own thread.
+        :return: TCPStream object created from client, None if the handshake failed and the client was dropped.
+        """
+        client_socket.settimeout(HANDSHAKE_TIMEOUT * 5)
+        try:
+            client_tcp_stream = TCPStream(client_socket, 1024, 4, 8, 1024, True, key_exchange=self.key_exchange,
+                                          session_tickets=self.session_tickets,
+                                          extra_capabilities=self.extra_capabilities)
+        except (OSError, ValueError) as e:
+            print(f"[Log] - Handshake with {client_address} failed: {e}")
+            client_socket.close()
+            return None
+        client_socket.settimeout(None)
+        return client_tcp_stream
 
     def run(self):
         """
-        Accept new clients and store them in self.client_socket attribute.
+        Accept new clients with a selector and queue them for get_client, until self.running is False.
+        Any number of clients can connect, and a client can reconnect after its connection dropped.
         """
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        print(f"[Log] - Socket settings of {self.address}: {apply_socket_profile(self, self.socket_profile)}")
         self.bind(self.address)
         self.listen(self.listen_amount)
-        client_socket, client_address = self.accept()
-        self.lock.acquire()
-        self.client_socket = client_socket
-        self.client_address = client_address
-        self.lock.release()
-        #
-        # while self.running:
-        #     client_socket, address = self.accept()
-        #     self.handle_client_method(client_socket)
+        self.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self, selectors.EVENT_READ)
+        while self.running:
+            for key, events in selector.select(timeout=0.5):
+                try:
+                    client_socket, client_address = self.accept()
+                except BlockingIOError:
+                    continue
+                client_socket.setblocking(True)
+                apply_socket_profile(client_socket, self.socket_profile)
+                self.accepted_clients.put((client_socket, client_address))
+        selector.close()
 
 
 class UDPServer(socket.socket):
+    """
+    Receives datagrams into a fixed capacity ring buffer. When it is full, the oldest or the newest datagram is dropped
+    according to drop_policy, so a burst of datagrams never grows the queue or the latency without limit.
+    """
 
-    def __init__(self, address, recv_size, running=True):
+    def __init__(self, address, recv_size, running=True, capacity: int = UDP_QUEUE_CAPACITY,
+                 drop_policy: str = DROP_OLDEST, drain_size: int = UDP_DRAIN_SIZE, socket_profile: dict = None):
+        """
+        Initialize UDPServer object.
+        :param address: host address
+        :param recv_size: maximal size of a datagram
+        :param running: Whether the server is running
+        :param capacity: How many datagrams the queue holds.
+        :param drop_policy: DROP_OLDEST to make room for a new datagram when the queue is full, or DROP_NEWEST to drop
+        the new datagram instead.
+        :param drain_size: How many waiting datagrams to receive on every wakeup before queueing them together.
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile
+        """
         super().__init__(socket.AF_INET, socket.SOCK_DGRAM)
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Invalid drop_policy: {drop_policy}")
         self.recv_size = recv_size
         self.address = address
         self.running = running
-        self.message_queue_lock = threading.Lock()
-        self.message_queue = []
-
-    def get_message(self):
-        if not self.message_queue:
-            return None
-        self.message_queue_lock.acquire()
-        msg = self.message_queue.pop(0)
-        self.message_queue_lock.release()
-        return msg
+        self.capacity = capacity
+        self.drop_policy = drop_policy
+        self.drain_size = drain_size
+        self.socket_profile = socket_profile
+        self.message_queue_condition = threading.Condition()
+        self.message_queue = [None] * capacity
+        self.queue_head = 0
+        self.queue_length = 0
+        self.received_messages = 0
+        self.dropped_messages = 0
+
+    def get_message(self, timeout: float = 0):
+        """
+        :param timeout: How long to wait for a message when the queue is empty, in seconds. 0 to return immediately.
+        :return: Oldest received datagram, None if there is none.
+        """
+        messages = self.get_messages(1, timeout)
+        return messages[0] if messages else None
 
-    def __insert_message_to_queue(self, data):
-        self.message_queue_lock.acquire()
-        self.message_queue.append(data)
-        self.message_queue_lock.release()
+    def get_messages(self, max_n, timeout: float = 0):
+        """
+        Take up to max_n datagrams at once, under a single lock acquisition.
+        :param max_n: maximal amount of datagrams to return
+        :param timeout: How long to wait for a message when the queue is empty, in seconds. 0 to return immediately.
+        :return: list of received datagrams, oldest first. Empty if there are none.
+        """
+        self.message_queue_condition.acquire()
+        if not self.queue_length and timeout:
+            self.message_queue_condition.wait(timeout)
+        amount = min(max_n, self.queue_length)
+        messages = []
+        for i in range(amount):
+            index = (self.queue_head + i) % self.capacity
+            messages.append(self.message_queue[index])
+            self.message_queue[index] = None
+        self.queue_head = (self.queue_head + amount) % self.capacity
+        self.queue_length -= amount
+        self.message_queue_condition.release()
+        return messages
+
+    def get_counters(self):
+        """
+        :return: {"received": datagrams received, "dropped": datagrams dropped because the queue was full,
+        "queued": datagrams waiting in the queue}
+        """
+        return {"received": self.received_messages, "dropped": self.dropped_messages, "queued": self.queue_length}
+
+    def __insert_messages_to_queue(self, messages):
+        self.message_queue_condition.acquire()
+        for data in messages:
+            if self.queue_length == self.capacity:
+                self.dropped_messages += 1
+                if self.drop_policy == DROP_NEWEST:
+                    continue
+                self.queue_head = (self.queue_head + 1) % self.capacity
+                self.queue_length -= 1
+            self.message_queue[(self.queue_head + self.queue_length) % self.capacity] = data
+            self.queue_length += 1
+        self.received_messages += len(messages)
+        self.message_queue_condition.notify_all()
+        self.message_queue_condition.release()
 
     def get_run_method(self):
         return self.run
 
     def run(self):
+        """
+        Receive datagrams until self.running is False. Every wakeup of the selector drains up to drain_size waiting
+        datagrams, and queues them with a single lock acquisition.
+        """
         self.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        print(f"[Log] - Socket settings of {self.address}: {apply_socket_profile(self, self.socket_profile)}")
         self.bind(self.address)
+        self.setblocking(False)
+        selector = selectors.DefaultSelector()
+        selector.register(self, selectors.EVENT_READ)
         print("[Log] - Server running on address: ", self.address)
         while self.running:
-            data, address = self.recvfrom(self.recv_size)
-            # print("[Log] - Received data: ", data)
-            self.__insert_message_to_queue(data)
+            if not selector.select(timeout=0.5):
+                continue
+            messages = []
+            try:
+                while len(messages) < self.drain_size:
+                    messages.append(self.recv(self.recv_size))
+            except BlockingIOError:
+                pass
+            # print("[Log] - Received data: ", messages)
+            if messages:
+                self.__insert_messages_to_queue(messages)
+        selector.close()
 
 
 def main():
@@ -0,0 +1,102 @@
+import time
+
+from network.protocol import PICommunication
+
+
+class CommandDispatcher:
+    """
+    Calls the handler registered for the code of a message. Handlers are looked up by the raw 4 bytes code, and get
+    the content as a memoryview, so nothing is decoded unless the handler needs it.
+    Counts the calls and the time spent in every handler.
+    """
+
+    def __init__(self):
+        """
+        Initialize CommandDispatcher object
+        handlers: {raw code: handler}
+        validators: {raw code: validator} of the codes whose content must parse
+        calls: {raw code: number of calls}
+        total_time: {raw code: seconds spent in the handler}
+        max_time: {raw code: longest call in seconds}
+        """
+        self.handlers = {}
+        self.validators = {}
+        self.calls = {}
+        self.total_time = {}
+        self.max_time = {}
+
+    def register(self, code: PICommunication.MessageCode, handler, validator=None):
+        """
+        Register the handler of a message code, replacing the previous one.
+        :param code: PICommunication.MessageCode
+        :param handler: function called with (content, *args) for every message of this code. content is a
+        memoryview. Returns False if the message was not handled.
+        :param validator: function called with the content by validate, raises ValueError if the handler would reject
+        it. None if every content is valid.
+        """
+        raw_code = code.value.encode()
+        self.handlers[raw_code] = handler
+        self.validators.pop(raw_code, None)
+        if validator is not None:
+            self.validators[raw_code] = validator
+        self.calls.setdefault(raw_code, 0)
+        self.total_time.setdefault(raw_code, 0.0)
+        self.max_time.setdefault(raw_code, 0.0)
+
+    def unregister(self, code: PICommunication.MessageCode):
+        self.handlers.pop(code.value.encode(), None)
+        self.validators.pop(code.value.encode(), None)
+
+    def validate(self, message):
+        """
+        Check a message without handling it.
+        :param message: message from PICommunication. type: bytes, bytearray or memoryview
+        :return: Whether a handler is registered for the code, and the validator of the code accepts the content.
+        """
+        message = memoryview(message)
+        raw_code = message[:PICommunication.msg_code_size].tobytes()
+        if raw_code not in self.handlers:
+            return False
+        validator = self.validators.get(raw_code)
+        if validator is None:
+            return True
+        try:
+            validator(message[PICommunication.msg_code_size:])
+        except ValueError:
+            return False
+        return True
+
+    def dispatch(self, message, *args):
+        """
+        :param message: message from PICommunication. type: bytes, bytearray or memoryview
+        :param args: passed on to the handler
+        :return: Whether a handler is registered for the code and handled the message.
+        """
+        message = memoryview(message)
+        raw_code = message[:PICommunication.msg_code_size].tobytes()
+        handler = self.handlers.get(raw_code)
+        if handler is None:
+            return False
+        start = time.perf_counter()
+        try:
+            return handler(message[PICommunication.msg_code_size:], *args) is not False
+        finally:
+            elapsed = time.perf_counter() - start
+            self.calls[raw_code] += 1
+            self.total_time[raw_code] += elapsed
+            if elapsed > self.max_time[raw_code]:
+                self.max_time[raw_code] = elapsed
+
+    def get_counters(self):
+        """
+        :return: {code: {"calls": number of calls, "average_ms": average time, "max_ms": longest call}} of every code
+        that was called.
+        """
+        counters = {}
+        for raw_code, calls in self.calls.items():
+            if not calls:
+                continue
+            counters[raw_code.decode()] = {"calls": calls,
+                                           "average_ms": round(self.total_time[raw_code] / calls * 1000, 3),
+                                           "max_ms": round(self.max_time[raw_code] * 1000, 3)}
+        return counters
@@ -1,3 +1,5 @@
+import math
+import struct
 from enum import Enum
 
 
@@ -5,6 +7,34 @@ class PICommunication:
     msg_code_size = 4
     msg_size_header_size = 8
     msg_header_size = msg_code_size + msg_size_header_size
+    # Every command of a batch is its code, one byte of content length, and its content.
+    batch_max_content_size = 255
+    sequence_number = struct.Struct("!I")
+    timestamp = struct.Struct("!d")
+    # Every changed field of a car state message is its id and its value.
+    car_state_field = struct.Struct("!Bf")
+    car_state_max_fields = 256
+    # Every datagram of the video stream starts with: stream id, frame id, pack index, pack count, capture time
+    # (time.time() on the car) and crc32 of the whole frame.
+    video_header = struct.Struct("!BIHHdI")
+    # Bytes of the encoded frame in every pack but the last.
+    video_pack_size = 65000
+    # Receivers of the video stream report back: stream id, loss (fraction of packs lost), jitter (seconds),
+    # throughput (bytes per second), frame rate (frames per second) and whether they need a keyframe.
+    video_report = struct.Struct("!BffffB")
+    # A frame of a stream in tile mode starts with: video_tiles_code, whether it is a keyframe, id of the frame a delta
+    # frame updates, width, height, tile size and tile count. Then come its tiles, each its index, jpeg size and jpeg.
+    # A keyframe has a single tile, the whole frame. A frame that isn't in tile mode is a plain jpeg.
+    video_tiles_code = b"TILE"
+    video_tiles_header = struct.Struct("!4sBIHHHH")
+    video_tile_header = struct.Struct("!HI")
+    video_max_frame_id = 2 ** 32
+    # Longest duration of a timed drive, turn or camera sweep, in seconds.
+    max_maneuver_time = 30.0
+    # Layouts of the frames of a stereo stream, which packs the frames the left and right cameras took together into
+    # one: the left camera in the left or top half, the right camera in the other.
+    stereo_side_by_side = "side-by-side"
+    stereo_top_bottom = "top-bottom"
 
     class MessageCode(Enum):
         """
@@ -30,18 +60,38 @@ class PICommunication:
         TOGGLE_OBJECT_DETECTION = "OBJD"
         TOGGLE_DISTANCE = "DIST"
         RESET_CAMERA_POSITION = "RCAM"
+        BATCH = "BTCH"  # = Several commands to execute together, in order
+        SEQUENCED = "SEQN"  # = A command with a sequence number, to be acknowledged
+        ACK = "ACKS"  # = Sequence numbers of the commands received
+        PING = "PING"  # = Timestamp to echo back
+        PONG = "PONG"  # = Echoed timestamp, optionally followed by a timestamp to echo back
+        CAMERA_SWEEP = "CAMS"  # = Move the camera by some degrees over a duration
+        SUBSCRIBE_CAR_STATE = "SBST"  # = Start pushing the car state
+        CAR_STATE_FIELDS = "STFL"  # = Names of the car state fields, by id
+        CAR_STATE = "STAT"  # = Car state fields that changed
+        TAKE_CONTROL = "TCTL"  # = Become the client that controls the car
+        RELEASE_CONTROL = "RCTL"  # = Stop controlling the car, so another client can take control
+        ROLE = "ROLE"  # = Role of the client, controller or viewer
 
     @staticmethod
     def initialize_cameras():
         return PICommunication.__format_message(PICommunication.MessageCode.INITIALIZE_CAMERAS)
 
     @staticmethod
-    def move_forward():
-        return PICommunication.__format_message(PICommunication.MessageCode.MOVE_FORWARD, b"")
+    def move_forward(duration: float = 0):
+        """
+        :param duration: How long to drive before stopping, in seconds. 0 to keep driving.
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.MOVE_FORWARD,
+                                                str(duration).encode() if duration else b"")
 
     @staticmethod
-    def move_backwards():
-        return PICommunication.__format_message(PICommunication.MessageCode.MOVE_BACKWARDS, b"")
+    def move_backwards(duration: float = 0):
+        """
+        :param duration: How long to drive before stopping, in seconds. 0 to keep driving.
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.MOVE_BACKWARDS,
+                                                str(duration).encode() if duration else b"")
 
     @staticmethod
     def stop():
@@ -61,10 +111,16 @@ class PICommunication:
 
     @staticmethod
     def turn_right(duration: float = 0):
+        """
+        :param duration: How long to turn before stopping, in seconds. 0 to keep turning.
+        """
         return PICommunication.__format_message(PICommunication.MessageCode.TURN_RIGHT, str(duration).encode())
 
     @staticmethod
     def turn_left(duration: float = 0):
+        """
+        :param duration: How long to turn before stopping, in seconds. 0 to keep turning.
+        """
         return PICommunication.__format_message(PICommunication.MessageCode.TURN_LEFT, str(duration).encode())
 
     @staticmethod
@@ -83,6 +139,52 @@ class PICommunication:
     def move_camera_right():
         return PICommunication.__format_message(PICommunication.MessageCode.CAMERA_RIGHT)
 
+    @staticmethod
+    def sweep_camera(right: float, up: float, duration: float):
+        """
+        :param right: degrees to move the camera right, negative for left
+        :param up: degrees to move the camera up, negative for down
+        :param duration: How long the move takes, in seconds.
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.CAMERA_SWEEP,
+                                                f"{right},{up},{duration}".encode())
+
+    @staticmethod
+    def parse_camera_sweep(content):
+        """
+        :param content: content of a camera sweep message
+        :return: right, up, duration
+        Raises ValueError if the content is malformed, or the duration is outside (0, max_maneuver_time].
+        """
+        right, up, duration = (float(value) for value in bytes(content).split(b","))
+        if not math.isfinite(right) or not math.isfinite(up):
+            raise ValueError(f"Camera sweep of {right}, {up} degrees")
+        PICommunication.__check_duration(duration)
+        return right, up, duration
+
+    @staticmethod
+    def parse_duration(content):
+        """
+        :param content: content of a drive or turn message
+        :return: duration in seconds, 0 if the message has none.
+        Raises ValueError if the content is malformed, or the duration is outside (0, max_maneuver_time].
+        """
+        if not len(content):
+            return 0.0
+        duration = float(bytes(content))
+        PICommunication.__check_duration(duration)
+        return duration
+
+    @staticmethod
+    def __check_duration(duration: float):
+        """
+        Raises ValueError if duration is not a number of seconds in (0, max_maneuver_time], so a duration off the
+        network can't keep the car driving or schedule endless steps.
+        """
+        if not 0 < duration <= PICommunication.max_maneuver_time:
+            raise ValueError(f"Maneuver duration {duration} is outside (0, {PICommunication.max_maneuver_time}]")
+
     @staticmethod
     def toggle_depth_map():
         return PICommunication.__format_message(PICommunication.MessageCode.TOGGLE_DEPTH_MAP)
@@ -107,6 +209,305 @@ class PICommunication:
     def disconnect(exit_code: str):
         return PICommunication.__format_message(PICommunication.MessageCode.DISCONNECT, exit_code.encode())
 
+    @staticmethod
+    def batch(messages: list):
+        """
+        Pack several messages into one, so they are sent in a single frame and executed together.
+        :param messages: list of messages from PICommunication. Batches and disconnects can't be part of a batch.
+        :return: Message encoded. type: bytes
+        """
+        content = bytearray()
+        for message in messages:
+            code = message[:PICommunication.msg_code_size]
+            message_content = message[PICommunication.msg_code_size:]
+            if code in (PICommunication.MessageCode.BATCH.value.encode(),
+                        PICommunication.MessageCode.DISCONNECT.value.encode()):
+                raise ValueError(f"Can't batch message code {code}")
+            if len(message_content) > PICommunication.batch_max_content_size:
+                raise ValueError(f"Content of {code} is too long for a batch")
+            content += code + bytes([len(message_content)]) + message_content
+        return PICommunication.__format_message(PICommunication.MessageCode.BATCH, bytes(content))
+
+    @staticmethod
+    def split_batch(content: bytes):
+        """
+        :param content: content of a batch message
+        :return: list of the messages in the batch, in order. type: list of bytes
+        Raises ValueError if the batch is truncated or holds a message that can't be batched.
+        """
+        messages = []
+        index = 0
+        while index < len(content):
+            length_index = index + PICommunication.msg_code_size
+            if length_index >= len(content):
+                raise ValueError("Batch is truncated")
+            end = length_index + 1 + content[length_index]
+            if end > len(content):
+                raise ValueError("Batch is truncated")
+            code = bytes(content[index:length_index])
+            if code in (PICommunication.MessageCode.BATCH.value.encode(),
+                        PICommunication.MessageCode.DISCONNECT.value.encode()):
+                raise ValueError(f"Can't batch message code {code}")
+            messages.append(code + bytes(content[length_index + 1:end]))
+            index = end
+        return messages
+
+    @staticmethod
+    def parse_batch(content: bytes):
+        """
+        :param content: content of a batch message
+        :return: list of (message code, content) of the messages in the batch, in order.
+        """
+        return [PICommunication.parse_message(message) for message in PICommunication.split_batch(content)]
+
+    @staticmethod
+    def sequenced(sequence_number: int, message: bytes):
+        """
+        :param sequence_number: number of the command, acknowledged by the receiver
+        :param message: message from PICommunication
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.SEQUENCED,
+                                                PICommunication.sequence_number.pack(sequence_number) + message)
+
+    @staticmethod
+    def split_sequenced(message):
+        """
+        :param message: message from PICommunication
+        :return: sequence number, the message inside. None, message if the message has no sequence number.
+        """
+        if bytes(message[:PICommunication.msg_code_size]) != PICommunication.MessageCode.SEQUENCED.value.encode():
+            return None, message
+        start = PICommunication.msg_code_size
+        end = start + PICommunication.sequence_number.size
+        if len(message) < end + PICommunication.msg_code_size:
+            raise ValueError("Sequenced message is truncated")
+        return PICommunication.sequence_number.unpack(message[start:end])[0], message[end:]
+
+    @staticmethod
+    def ack(sequence_numbers: list):
+        """
+        :param sequence_numbers: sequence numbers of the commands received
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(
+            PICommunication.MessageCode.ACK,
+            struct.pack(f"!{len(sequence_numbers)}I", *sequence_numbers))
+
+    @staticmethod
+    def parse_ack(content):
+        """
+        :param content: content of an ack message
+        :return: tuple of the acknowledged sequence numbers
+        """
+        return struct.unpack(f"!{len(content) // PICommunication.sequence_number.size}I", content)
+
+    @staticmethod
+    def ping(timestamp: float):
+        """
+        :param timestamp: time.monotonic() of the sender
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.PING,
+                                                PICommunication.timestamp.pack(timestamp))
+
+    @staticmethod
+    def pong(echoed_timestamp: float, timestamp: float = None):
+        """
+        :param echoed_timestamp: timestamp of the ping or pong that is answered
+        :param timestamp: time.monotonic() of the sender, for the receiver to echo back in a pong. None for no answer.
+        :return: Message encoded. type: bytes
+        """
+        content = PICommunication.timestamp.pack(echoed_timestamp)
+        if timestamp is not None:
+            content += PICommunication.timestamp.pack(timestamp)
+        return PICommunication.__format_message(PICommunication.MessageCode.PONG, content)
+
+    @staticmethod
+    def parse_timestamps(content):
+        """
+        :param content: content of a ping or pong message
+        :return: tuple of the timestamps in the content
+        """
+        return struct.unpack(f"!{len(content) // PICommunication.timestamp.size}d", content)
+
+    @staticmethod
+    def take_control():
+        return PICommunication.__format_message(PICommunication.MessageCode.TAKE_CONTROL)
+
+    @staticmethod
+    def release_control():
+        return PICommunication.__format_message(PICommunication.MessageCode.RELEASE_CONTROL)
+
+    @staticmethod
+    def role(role: str):
+        """
+        :param role: "controller" or "viewer"
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(PICommunication.MessageCode.ROLE, role.encode())
+
+    @staticmethod
+    def subscribe_car_state():
+        return PICommunication.__format_message(PICommunication.MessageCode.SUBSCRIBE_CAR_STATE)
+
+    @staticmethod
+    def car_state_fields(names: list):
+        """
+        :param names: names of the car state fields. The id of a field is its index.
+        :return: Message encoded. type: bytes
+        """
+        if len(names) > PICommunication.car_state_max_fields:
+            raise ValueError("Too many car state fields")
+        content = bytearray()
+        for name in names:
+            encoded_name = name.encode()
+            content += bytes([len(encoded_name)]) + encoded_name
+        return PICommunication.__format_message(PICommunication.MessageCode.CAR_STATE_FIELDS, bytes(content))
+
+    @staticmethod
+    def parse_car_state_fields(content):
+        """
+        :param content: content of a car state fields message
+        :return: list of the field names, by id
+        Raises ValueError if the content is truncated.
+        """
+        content = bytes(content)
+        names = []
+        index = 0
+        while index < len(content):
+            end = index + 1 + content[index]
+            if end > len(content):
+                raise ValueError("Car state fields are truncated")
+            names.append(content[index + 1:end].decode())
+            index = end
+        return names
+
+    @staticmethod
+    def car_state(fields: dict):
+        """
+        :param fields: {field id: value} of the fields that changed
+        :return: Message encoded. type: bytes
+        """
+        return PICommunication.__format_message(
+            PICommunication.MessageCode.CAR_STATE,
+            b"".join(PICommunication.car_state_field.pack(field_id, value) for field_id, value in fields.items()))
+
+    @staticmethod
+    def parse_car_state(content):
+        """
+        :param content: content of a car state message
+        :return: {field id: value}
+        """
+        return dict(PICommunication.car_state_field.iter_unpack(content))
+
+    @staticmethod
+    def video_pack(stream_id: int, frame_id: int, pack_index: int, pack_count: int, capture_time: float, crc: int,
+                   payload: bytes):
+        """
+        :param stream_id: id of the stream, such as the camera
+        :param frame_id: number of the frame in its stream, wraps around at video_max_frame_id
+        :param pack_index: index of the pack in its frame
+        :param pack_count: number of packs of the frame
+        :param capture_time: When the frame was captured, time.time() on the car.
+        :param crc: zlib.crc32 of the whole encoded frame
+        :param payload: part of the encoded frame
+        :return: datagram encoded. type: bytes
+        """
+        return PICommunication.video_header.pack(stream_id, frame_id % PICommunication.video_max_frame_id, pack_index,
+                                                 pack_count, capture_time, crc) + payload
+
+    @staticmethod
+    def parse_video_pack(datagram):
+        """
+        :param datagram: datagram of the video stream
+        :return: stream id, frame id, pack index, pack count, capture time, crc, payload (memoryview)
+        Raises ValueError if the datagram is too short or its pack index is out of range.
+        """
+        if len(datagram) < PICommunication.video_header.size:
+            raise ValueError("Video datagram is truncated")
+        stream_id, frame_id, pack_index, pack_count, capture_time, crc = \
+            PICommunication.video_header.unpack_from(datagram)
+        if pack_index >= pack_count:
+            raise ValueError(f"Pack {pack_index} of a frame of {pack_count} packs")
+        return (stream_id, frame_id, pack_index, pack_count, capture_time, crc,
+                memoryview(datagram)[PICommunication.video_header.size:])
+
+    @staticmethod
+    def video_report_pack(stream_id: int, loss: float, jitter: float, throughput: float, frame_rate: float,
+                          keyframe_needed: bool = False):
+        """
+        :param keyframe_needed: Whether the receiver lost track of a stream in tile mode.
+        :return: datagram encoded. type: bytes
+        """
+        return PICommunication.video_report.pack(stream_id, loss, jitter, throughput, frame_rate, keyframe_needed)
+
+    @staticmethod
+    def parse_video_report(datagram):
+        """
+        :param datagram: report datagram of a video stream receiver
+        :return: stream id, loss, jitter, throughput, frame rate, keyframe needed
+        Raises ValueError if the datagram is not a report.
+        """
+        if len(datagram) != PICommunication.video_report.size:
+            raise ValueError("Not a video report")
+        stream_id, loss, jitter, throughput, frame_rate, keyframe_needed = PICommunication.video_report.unpack(datagram)
+        return stream_id, loss, jitter, throughput, frame_rate, bool(keyframe_needed)
+
+    @staticmethod
+    def video_tiles(keyframe: bool, base_frame_id: int, width: int, height: int, tile_size: int, tiles: list):
+        """
+        :param keyframe: Whether the frame is a keyframe, whose single tile is the whole frame.
+        :param base_frame_id: id of the frame a delta frame updates, ignored for a keyframe
+        :param width: width of the whole frame
+        :param height: height of the whole frame
+        :param tile_size: width and height of a tile. Tiles on the right and bottom edges may be smaller.
+        :param tiles: list of (tile index, jpeg), the index counting tiles row by row
+        :return: frame encoded. type: bytes
+        """
+        content = bytearray(PICommunication.video_tiles_header.pack(
+            PICommunication.video_tiles_code, keyframe, base_frame_id % PICommunication.video_max_frame_id, width,
+            height, tile_size, len(tiles)))
+        for tile_index, jpeg in tiles:
+            content += PICommunication.video_tile_header.pack(tile_index, len(jpeg))
+            content += jpeg
+        return bytes(content)
+
+    @staticmethod
+    def is_video_tiles(frame):
+        """
+        :param frame: encoded frame of the video stream
+        :return: Whether the frame is in tile mode, rather than a plain jpeg.
+        """
+        return bytes(frame[:len(PICommunication.video_tiles_code)]) == PICommunication.video_tiles_code
+
+    @staticmethod
+    def parse_video_tiles(frame):
+        """
+        :param frame: encoded frame of a stream in tile mode
+        :return: keyframe, base frame id, width, height, tile size, list of (tile index, jpeg (memoryview))
+        Raises ValueError if the frame is truncated.
+        """
+        frame = memoryview(frame)
+        if len(frame) < PICommunication.video_tiles_header.size:
+            raise ValueError("Tile frame is truncated")
+        code, keyframe, base_frame_id, width, height, tile_size, tile_count = \
+            PICommunication.video_tiles_header.unpack_from(frame)
+        if code != PICommunication.video_tiles_code or tile_size == 0:
+            raise ValueError("Not a tile frame")
+        tiles = []
+        index = PICommunication.video_tiles_header.size
+        for i in range(tile_count):
+            if index + PICommunication.video_tile_header.size > len(frame):
+                raise ValueError("Tile frame is truncated")
+            tile_index, jpeg_size = PICommunication.video_tile_header.unpack_from(frame, index)
+            index += PICommunication.video_tile_header.size
+            if index + jpeg_size > len(frame):
+                raise ValueError("Tile frame is truncated")
+            tiles.append((tile_index, frame[index:index + jpeg_size]))
+            index += jpeg_size
+        return bool(keyframe), base_frame_id, width, height, tile_size, tiles
+
     @staticmethod
     def __format_message(code: MessageCode, content: bytes = b""):
         """
@@ -121,9 +522,29 @@ class PICommunication:
     def parse_message(message: bytes):
         """
         :param message: message in bytes
-        :return: message code, content (in bytes)
+        :return: message code, content. The content of a batch stays bytes, the content of other messages is decoded.
         """
+        if bytes(message[:PICommunication.msg_code_size]) == PICommunication.MessageCode.BATCH.value.encode():
+            return PICommunication.MessageCode.BATCH, bytes(message[PICommunication.msg_code_size:])
         message = message.decode()
         code = message[:PICommunication.msg_code_size]
         content = message[PICommunication.msg_code_size:]
         return PICommunication.MessageCode(code), content
+
+
+# Axis of every car command. Commands on the same axis supersede each other, so only the latest pending one needs to
+# be sent or executed.
+COMMAND_AXES = {
+    PICommunication.MessageCode.MOVE_FORWARD.value.encode(): "drive",
+    PICommunication.MessageCode.MOVE_BACKWARDS.value.encode(): "drive",
+    PICommunication.MessageCode.TURN_LEFT.value.encode(): "drive",
+    PICommunication.MessageCode.TURN_RIGHT.value.encode(): "drive",
+    PICommunication.MessageCode.STOP.value.encode(): "drive",
+    PICommunication.MessageCode.LOW_SPEED.value.encode(): "speed",
+    PICommunication.MessageCode.MEDIUM_SPEED.value.encode(): "speed",
+    PICommunication.MessageCode.HIGH_SPEED.value.encode(): "speed",
+    PICommunication.MessageCode.CAMERA_LEFT.value.encode(): "camera_horizontal",
+    PICommunication.MessageCode.CAMERA_RIGHT.value.encode(): "camera_horizontal",
+    PICommunication.MessageCode.CAMERA_UP.value.encode(): "camera_vertical",
+    PICommunication.MessageCode.CAMERA_DOWN.value.encode(): "camera_vertical",
+}
@@ -0,0 +1,169 @@
+import itertools
+import threading
+
+from network.protocol import PICommunication
+
+ROLE_CONTROLLER = "controller"
+ROLE_VIEWER = "viewer"
+# Bytes per second of video each viewer may get, 0 for no limit. The controller is never limited.
+VIEWER_BANDWIDTH_CAP = 2 * 1024 * 1024
+
+
+class Session:
+    """
+    A connected client. Every session can watch the camera streams and the car state, only the controlling one can
+    drive the car.
+    """
+
+    def __init__(self, session_id, host, send, key=None):
+        """
+        Initialize Session object
+        :param session_id: number of the session, unique while the server runs
+        :param host: host of the client, where its camera streams are sent
+        :param send: function that sends a message to the client
+        :param key: session key of the stream of the client, which a client resuming with its session ticket presents.
+        None if the stream has none.
+        acks: AckBatcher of the client, set by the server
+        watching_cameras: Whether the client asked for the camera streams.
+        bandwidth_cap: Bytes per second of video the client may get, 0 for no limit. Set by the SessionManager.
+        """
+        self.id = session_id
+        self.host = host
+        self.send = send
+        self.key = key
+        self.role = ROLE_VIEWER
+        self.bandwidth_cap = 0
+        self.acks = None
+        self.watching_cameras = False
+
+    def is_controller(self):
+        return self.role == ROLE_CONTROLLER
+
+
+class SessionManager:
+    """
+    Keeps the sessions of the connected clients, of which at most one controls the car. The first client to connect
+    while nobody is in control takes control, every other client is a viewer. The controller hands control off by
+    releasing it, after which a viewer can take it.
+    A client that reconnects with its session ticket before its old session was closed gets the role of the old
+    session back, so a dropped connection never costs the controller its control.
+    Clients are told their role whenever it changes.
+    """
+
+    def __init__(self, viewer_bandwidth_cap: int = VIEWER_BANDWIDTH_CAP, on_role_change=None):
+        """
+        Initialize SessionManager object
+        :param viewer_bandwidth_cap: Bytes per second of video each viewer may get, 0 for no limit.
+        :param on_role_change: function called with a session whenever its role changed, None for none.
+        """
+        self.viewer_bandwidth_cap = viewer_bandwidth_cap
+        self.on_role_change = on_role_change
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.controller = None
+        self.session_ids = itertools.count(1)
+        self.handoffs = 0
+
+    def open(self, host, send, key=None, resumed_key=None):
+        """
+        Open the session of a new client, in control if nobody is, or if it resumed the session in control.
+        :param host: host of the client
+        :param send: function that sends a message to the client
+        :param key: session key of the stream of the client, None if it has none.
+        :param resumed_key: session key of the stream whose session ticket the client resumed, None if it did not.
+        :return: Session
+        """
+        self.lock.acquire()
+        session = Session(next(self.session_ids), host, send, key)
+        session.bandwidth_cap = self.viewer_bandwidth_cap
+        self.sessions[session.id] = session
+        stale_controller = None
+        if self.controller is None:
+            self.__set_controller(session)
+        elif resumed_key is not None and self.controller.key == resumed_key:
+            stale_controller = self.controller
+            stale_controller.role = ROLE_VIEWER
+            stale_controller.bandwidth_cap = self.viewer_bandwidth_cap
+            self.__set_controller(session)
+        self.lock.release()
+        if stale_controller is not None:
+            print(f"[Log] - Session {session.id} resumed control from session {stale_controller.id}")
+            self.__notify(stale_controller)
+        self.__notify(session)
+        return session
+
+    def close(self, session):
+        """
+        Close the session of a client that left. If it was in control, nobody is until a client takes control.
+        :param session: Session
+        :return: Whether the session was in control.
+        """
+        self.lock.acquire()
+        self.sessions.pop(session.id, None)
+        was_controller = self.controller is session
+        if was_controller:
+            self.controller = None
+        self.lock.release()
+        return was_controller
+
+    def take_control(self, session):
+        """
+        :param session: Session of a viewer
+        :return: Whether the session is in control now. Fails while another session is in control.
+        """
+        self.lock.acquire()
+        taken = self.controller is None or self.controller is session
+        if self.controller is None:
+            self.__set_controller(session)
+            self.handoffs += 1
+        self.lock.release()
+        if taken:
+            self.__notify(session)
+        return taken
+
+    def release_control(self, session):
+        """
+        :param session: Session of the controller
+        :return: Whether the session was in control.
+        """
+        self.lock.acquire()
+        released = self.controller is session
+        if released:
+            self.controller = None
+            session.role = ROLE_VIEWER
+            session.bandwidth_cap = self.viewer_bandwidth_cap
+        self.lock.release()
+        if released:
+            self.__notify(session)
+        return released
+
+    def get_counters(self):
+        """
+        :return: {"sessions": connected clients, "controller": id of the controlling session, None if there is none,
+        "handoffs": times control was taken after being released or left}
+        """
+        self.lock.acquire()
+        counters = {"sessions": len(self.sessions),
+                    "controller": None if self.controller is None else self.controller.id,
+                    "handoffs": self.handoffs}
+        self.lock.release()
+        return counters
+
+    def __set_controller(self, session):
+        """
+        Must be called with self.lock held.
+        """
+        self.controller = session
+        session.role = ROLE_CONTROLLER
+        session.bandwidth_cap = 0
+
+    def __notify(self, session):
+        """
+        Tell the client its role, and call on_role_change.
+        """
+        try:
+            session.send(PICommunication.role(session.role))
+        except (ConnectionError, OSError) as e:
+            print(f"[Log] - Failed sending role to session {session.id}: {e}")
+        if self.on_role_change is not None:
+            self.on_role_change(session)
@@ -0,0 +1,61 @@
+import socket
+
+PROFILE_BULK_VIDEO = "bulk-video"
+PROFILE_LOW_LATENCY_CONTROL = "low-latency-control"
+
+# Profile setting: (level, option name, whether the option only applies to tcp sockets). Options missing on this
+# platform are skipped.
+SOCKET_OPTIONS = {
+    "tcp_nodelay": (socket.IPPROTO_TCP, "TCP_NODELAY", True),
+    # Linux turns delayed acks back on by itself, so this only helps right after it is set.
+    "tcp_quickack": (socket.IPPROTO_TCP, "TCP_QUICKACK", True),
+    "ip_tos": (socket.IPPROTO_IP, "IP_TOS", False),
+    "sndbuf": (socket.SOL_SOCKET, "SO_SNDBUF", False),
+    "rcvbuf": (socket.SOL_SOCKET, "SO_RCVBUF", False),
+    "keepalive": (socket.SOL_SOCKET, "SO_KEEPALIVE", True),
+    "keepalive_idle": (socket.IPPROTO_TCP, "TCP_KEEPIDLE", True),
+    "keepalive_interval": (socket.IPPROTO_TCP, "TCP_KEEPINTVL", True),
+    "keepalive_count": (socket.IPPROTO_TCP, "TCP_KEEPCNT", True),
+}
+
+
+def get_socket_profile(constants, profile_name):
+    """
+    :param constants: json containing constants
+    :param profile_name: name of a profile in constants["socket_profiles"], or None
+    :return: dict of socket settings, None if profile_name is None or unknown.
+    """
+    if profile_name is None:
+        return None
+    profile = constants.get("socket_profiles", {}).get(profile_name)
+    if profile is None:
+        print(f"[Log] - Unknown socket profile: {profile_name}")
+    return profile
+
+
+def apply_socket_profile(sock, profile):
+    """
+    Apply the settings of a socket profile. Settings this platform or socket type doesn't support are skipped.
+    :param sock: socket.socket
+    :param profile: dict of socket settings from get_socket_profile, or None
+    :return: {setting: value read back from the socket} of the settings that were applied. The kernel may adjust
+    values, for example Linux doubles buffer sizes and caps them at its configured maximum.
+    """
+    effective = {}
+    if not profile:
+        return effective
+    is_tcp = sock.type == socket.SOCK_STREAM
+    for setting, value in profile.items():
+        if setting not in SOCKET_OPTIONS:
+            print(f"[Log] - Unknown socket setting: {setting}")
+            continue
+        level, option_name, tcp_only = SOCKET_OPTIONS[setting]
+        option = getattr(socket, option_name, None)
+        if option is None or (tcp_only and not is_tcp):
+            continue
+        try:
+            sock.setsockopt(level, option, int(value))
+            effective[setting] = sock.getsockopt(level, option)
+        except OSError as e:
+            print(f"[Log] - Failed setting {setting}: {e}")
+    return effective
@@ -1,7 +1,8 @@
 import socket
 import threading
 
-from network.communication import TCPServer, UDPServer
+from network.communication import DROP_OLDEST, KEY_EXCHANGE_ECDH, UDP_QUEUE_CAPACITY, TCPServer, UDPServer
+from network.socket_profiles import get_socket_profile
 
 
 def initialize_server(constants, server_name, THREADS, new_thread=True):
@@ -15,10 +16,15 @@ def initialize_server(constants, server_name, THREADS, new_thread=True):
     """
     server_info = constants[server_name]
     print(f"[Log] - Started server - {server_info}")
+    socket_profile = get_socket_profile(constants, server_info.get("socket_profile"))
     if server_info["type"] == "tcp":
-        server = TCPServer((server_info["ip"], int(server_info["port"])), server_info["recv_size"])
+        server = TCPServer((server_info["ip"], int(server_info["port"])), server_info["recv_size"],
+                           key_exchange=server_info.get("key_exchange", KEY_EXCHANGE_ECDH),
+                           socket_profile=socket_profile)
     elif server_info["type"] == "udp":
-        server = UDPServer((server_info["ip"], int(server_info["port"])), server_info["recv_size"])
+        server = UDPServer((server_info["ip"], int(server_info["port"])), server_info["recv_size"],
+                           capacity=server_info.get("queue_capacity", UDP_QUEUE_CAPACITY),
+                           drop_policy=server_info.get("drop_policy", DROP_OLDEST), socket_profile=socket_profile)
     else:
         raise ValueError(f"Invalid server_type: {server_name}")
 
@@ -1,76 +1,404 @@
-import pickle
 import socket
 import sys
 import threading
+import time
+import zlib
 
 import cv2
 import numpy as np
 
+from network.channel import MODE_LATEST, Channel
+from network.protocol import PICommunication
+from network.socket_profiles import apply_socket_profile
+
 MAX_LENGTH = 65540
+# Packs of frames up to this many frames older than the last frame received are late. Older frame ids mean the
+# streamer restarted, so they start a new frame.
+LATE_FRAMES = 64
+# Frames being reassembled at once. A frame that needs a slot while all are taken evicts the oldest one.
+IN_FLIGHT_FRAMES = 4
+# Largest frame that can be reassembled, in packs of PICommunication.video_pack_size.
+MAX_FRAME_PACKS = 8
+# Seconds an incomplete frame is kept after its first pack arrived.
+FRAME_DEADLINE = 0.2
+# Seconds between the reports sent back to the streamer.
+REPORT_INTERVAL = 1.0
+
+
+def split_stereo_frame(frame, layout: str = PICommunication.stereo_side_by_side):
+    """
+    :param frame: numpy.ndarray, frame of a stereo stream
+    :param layout: PICommunication.stereo_side_by_side or PICommunication.stereo_top_bottom
+    :return: left frame, right frame. Both are views of frame, taken at the same moment.
+    """
+    if layout == PICommunication.stereo_side_by_side:
+        half = frame.shape[1] // 2
+        return frame[:, :half], frame[:, half:2 * half]
+    if layout == PICommunication.stereo_top_bottom:
+        half = frame.shape[0] // 2
+        return frame[:half], frame[half:2 * half]
+    raise ValueError(f"Unknown stereo layout: {layout}")
+
+
+class FrameSlot:
+    """
+    Preallocated buffer a frame is reassembled in. Every pack is written straight to its place in the buffer.
+    """
+
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.frame_id = None
+        self.pack_count = 0
+        self.received_packs = []
+        self.received_count = 0
+        self.frame_size = 0
+        self.crc = 0
+        self.capture_time = 0.0
+        self.deadline = 0.0
+
+    def reset(self, frame_id, pack_count, crc, capture_time, deadline):
+        self.frame_id = frame_id
+        self.pack_count = pack_count
+        self.received_packs = [False] * pack_count
+        self.received_count = 0
+        self.frame_size = 0
+        self.crc = crc
+        self.capture_time = capture_time
+        self.deadline = deadline
+
+
+class FrameReassembler:
+    """
+    Reassembles the frames of a video stream from its datagrams, which may arrive in any order. A few frames are
+    reassembled at once, each in a slot allocated up front, so memory stays bounded however lossy the link is:
+    incomplete frames are evicted after FRAME_DEADLINE, or when a newer frame needs their slot. Frames are returned in
+    order, and a frame that completes after a newer one is dropped as stale.
+    Not thread safe.
+    """
+
+    def __init__(self, slot_count: int = IN_FLIGHT_FRAMES, max_frame_packs: int = MAX_FRAME_PACKS,
+                 deadline: float = FRAME_DEADLINE):
+        """
+        Initialize FrameReassembler object
+        :param slot_count: How many frames to reassemble at once.
+        :param max_frame_packs: Largest frame to reassemble, in packs. Larger frames are dropped.
+        :param deadline: Seconds an incomplete frame is kept.
+        """
+        self.max_frame_packs = max_frame_packs
+        self.deadline = deadline
+        self.free_slots = [FrameSlot(max_frame_packs * PICommunication.video_pack_size) for i in range(slot_count)]
+        # {frame id: FrameSlot} of the frames being reassembled
+        self.slots = {}
+        self.last_frame_id = None
+        # Capture and arrival time of the last frame received, for the jitter.
+        self.last_frame_times = None
+        self.jitter = 0.0
+        self.lost_packs = 0
+        self.received_packs = 0
+        self.received_bytes = 0
+        self.received_frames = 0
+        self.partial_frames = 0
+        self.corrupt_frames = 0
+        self.invalid_datagrams = 0
+        self.late_datagrams = 0
+
+    def add(self, datagram, now: float = None):
+        """
+        :param datagram: datagram of the video stream
+        :param now: time.monotonic(), None to read it
+        :return: None, or (capture time, memoryview of the encoded frame) once the datagram completes a frame. The
+        memoryview is only valid until the next call.
+        """
+        now = now if now is not None else time.monotonic()
+        self.__evict_expired(now)
+        try:
+            stream_id, frame_id, pack_index, pack_count, capture_time, crc, payload = \
+                PICommunication.parse_video_pack(datagram)
+        except ValueError:
+            self.invalid_datagrams += 1
+            return None
+        pack_size = PICommunication.video_pack_size
+        if pack_count > self.max_frame_packs or len(payload) > pack_size or \
+                (pack_index < pack_count - 1 and len(payload) != pack_size):
+            self.invalid_datagrams += 1
+            return None
+
+        slot = self.slots.get(frame_id)
+        if slot is None:
+            if self.__is_late(frame_id):
+                self.late_datagrams += 1
+                return None
+            slot = self.__take_slot()
+            slot.reset(frame_id, pack_count, crc, capture_time, now + self.deadline)
+            self.slots[frame_id] = slot
+        elif slot.pack_count != pack_count or slot.crc != crc or slot.received_packs[pack_index]:
+            # A duplicate, or a pack of another frame with the same id.
+            self.invalid_datagrams += 1
+            return None
+
+        offset = pack_index * pack_size
+        slot.view[offset:offset + len(payload)] = payload
+        slot.received_packs[pack_index] = True
+        slot.received_count += 1
+        self.received_packs += 1
+        self.received_bytes += len(datagram)
+        if pack_index == pack_count - 1:
+            slot.frame_size = offset + len(payload)
+        if slot.received_count < pack_count:
+            return None
+
+        self.__release(slot)
+        # Older frames still being reassembled would be shown after this one, so they are dropped.
+        for older_slot in list(self.slots.values()):
+            if self.__is_late(older_slot.frame_id, frame_id):
+                self.__drop(older_slot)
+        self.last_frame_id = frame_id
+        frame = slot.view[:slot.frame_size]
+        if zlib.crc32(frame) != slot.crc:
+            self.corrupt_frames += 1
+            return None
+        self.received_frames += 1
+        if self.last_frame_times is not None:
+            # Interarrival jitter as in RTP: the clock offset between the car and here cancels out.
+            transit_change = (now - self.last_frame_times[1]) - (slot.capture_time - self.last_frame_times[0])
+            self.jitter += (abs(transit_change) - self.jitter) / 16
+        self.last_frame_times = (slot.capture_time, now)
+        return slot.capture_time, frame
+
+    def get_counters(self):
+        """
+        :return: {"frames": frames received, "partial": frames missing packs, "corrupt": frames failing their crc,
+        "invalid": malformed or duplicate datagrams, "late": packs of frames older than the last frame received,
+        "in_flight": frames being reassembled, "packs": packs received, "lost_packs": packs missing from incomplete
+        frames, "bytes": bytes received, "jitter_ms"}
+        """
+        return {"frames": self.received_frames, "partial": self.partial_frames, "corrupt": self.corrupt_frames,
+                "invalid": self.invalid_datagrams, "late": self.late_datagrams, "in_flight": len(self.slots),
+                "packs": self.received_packs, "lost_packs": self.lost_packs, "bytes": self.received_bytes,
+                "jitter_ms": round(self.jitter * 1000, 3)}
+
+    def __is_late(self, frame_id, newer_frame_id=None):
+        """
+        :return: Whether frame_id is up to LATE_FRAMES frames older than or the same as newer_frame_id, the last
+        frame received by default.
+        """
+        newer_frame_id = newer_frame_id if newer_frame_id is not None else self.last_frame_id
+        if newer_frame_id is None:
+            return False
+        return (newer_frame_id - frame_id) % PICommunication.video_max_frame_id <= LATE_FRAMES
+
+    def __take_slot(self):
+        """
+        :return: free FrameSlot, evicting the oldest incomplete frame if there is none.
+        """
+        if not self.free_slots:
+            self.__drop(min(self.slots.values(), key=lambda slot: slot.deadline))
+        return self.free_slots.pop()
+
+    def __evict_expired(self, now):
+        for slot in [slot for slot in self.slots.values() if slot.deadline <= now]:
+            self.__drop(slot)
+
+    def __drop(self, slot):
+        """
+        Give up on an incomplete frame.
+        """
+        self.partial_frames += 1
+        self.lost_packs += slot.pack_count - slot.received_count
+        self.__release(slot)
+
+    def __release(self, slot):
+        self.slots.pop(slot.frame_id)
+        self.free_slots.append(slot)
+
+
+class TileCanvas:
+    """
+    Frame of a stream in tile mode, composited from its keyframes and the tiles of its delta frames. A delta frame that
+    doesn't update the frame on the canvas, because a frame in between was lost, is dropped, and a keyframe is needed.
+    Not thread safe.
+    """
+
+    def __init__(self):
+        """
+        Initialize TileCanvas object
+        frame: numpy.ndarray, the frame composited so far. None before the first keyframe.
+        frame_id: id of the last frame applied to the canvas
+        keyframe_needed: Whether the canvas lost track of the stream, until the next keyframe.
+        """
+        self.frame = None
+        self.frame_id = None
+        self.keyframe_needed = False
+        self.keyframes = 0
+        self.delta_frames = 0
+        self.tiles = 0
+        self.unsynced_frames = 0
+        self.invalid_frames = 0
+
+    def apply(self, encoded_frame, frame_id):
+        """
+        :param encoded_frame: encoded frame of a stream in tile mode
+        :param frame_id: id of the frame in its stream
+        :return: numpy.ndarray, the canvas, None if the frame couldn't be applied. The canvas changes with the next
+        call, so it must be copied to be kept.
+        """
+        try:
+            keyframe, base_frame_id, width, height, tile_size, tiles = PICommunication.parse_video_tiles(encoded_frame)
+        except ValueError:
+            self.invalid_frames += 1
+            self.keyframe_needed = True
+            return None
+        if keyframe:
+            frame = cv2.imdecode(np.frombuffer(tiles[0][1], dtype=np.uint8), cv2.IMREAD_COLOR) if tiles else None
+            if frame is None or frame.shape[:2] != (height, width):
+                self.keyframe_needed = True
+                return None
+            self.frame = frame
+            self.keyframe_needed = False
+            self.keyframes += 1
+        else:
+            if self.frame is None or base_frame_id != self.frame_id or self.frame.shape[:2] != (height, width):
+                self.unsynced_frames += 1
+                self.keyframe_needed = True
+                return None
+            columns = -(-width // tile_size)
+            for tile_index, jpeg in tiles:
+                top = tile_index // columns * tile_size
+                left = tile_index % columns * tile_size
+                region = self.frame[top:top + tile_size, left:left + tile_size]
+                tile = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if tile is None or tile.shape != region.shape:
+                    # The tile stays stale on the canvas until it changes again or the next keyframe.
+                    self.keyframe_needed = True
+                    continue
+                region[...] = tile
+            self.delta_frames += 1
+            self.tiles += len(tiles)
+        self.frame_id = frame_id
+        return self.frame
+
+    def get_counters(self):
+        """
+        :return: {"keyframes", "delta_frames", "tiles": tiles of the delta frames, "unsynced": delta frames dropped
+        as they didn't update the frame on the canvas, "invalid_tile_frames": malformed frames}
+        """
+        return {"keyframes": self.keyframes, "delta_frames": self.delta_frames, "tiles": self.tiles,
+                "unsynced": self.unsynced_frames, "invalid_tile_frames": self.invalid_frames}
 
 
 class StreamReceiver:
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, socket_profile: dict = None):
         """
         Initialize a StreamReceiver object
         :param host: source host
         :param port: source port
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile. A large receive buffer keeps
+        the packs of a frame from overflowing it.
         lock: threading.Lock() -> to handle common resources
-        frame_queue: queue of frames, keeping all frames that arrived.
+        frames: Channel of the frames received, keeping only the latest one so the display never lags behind.
         running: bool. The receiver will work as long as running == True
+        last_capture_time: When the last frame received was captured, time.time() on the car. None before the first.
+        reassembler: FrameReassembler of the stream
+        canvas: TileCanvas of the stream, used once it sends frames in tile mode
         """
         self.host = host
         self.port = port
+        self.socket_profile = socket_profile
         self.lock = threading.Lock()
-        self.frame_queue = []
+        self.frames = Channel(f"stream {port}", MODE_LATEST)
         self.running = True
+        self.last_capture_time = None
+        self.reassembler = FrameReassembler()
+        self.canvas = TileCanvas()
+        self.sent_reports = 0
 
     def receive_stream(self):
         """
-        Receive stream and append frames received to self.frame_queue
+        Receive stream and put frames received in self.frames. Every datagram carries the header of its frame,
+        so a lost datagram only loses its own frame. Frames that miss packs or fail their crc are dropped.
+        Frames in tile mode are composited on self.canvas, and a keyframe is asked for in the next report when it lost
+        track of the stream.
         """
-        frame_info = None
-        buffer = None
-        frame = None
+        datagram = bytearray(MAX_LENGTH)
+        datagram_view = memoryview(datagram)
+        source_address = None
+        stream_id = 0
+        next_report = time.monotonic() + REPORT_INTERVAL
+        last_report_counters = self.reassembler.get_counters()
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        print(f"[Log] - Socket settings of {self.host}:{self.port}: {apply_socket_profile(sock, self.socket_profile)}")
         sock.bind((self.host, self.port))
         sock.settimeout(0.5)
         print("-> waiting for connection", self.host, self.port)
         while self.running:
+            now = time.monotonic()
+            if source_address is not None and now >= next_report:
+                last_report_counters = self.__send_report(sock, source_address, stream_id, last_report_counters,
+                                                          now - next_report + REPORT_INTERVAL)
+                next_report = now + REPORT_INTERVAL
             try:
-                data, address = sock.recvfrom(MAX_LENGTH)
+                size, address = sock.recvfrom_into(datagram)
             except socket.error:
                 continue
-            if len(data) < 100:
-                frame_info = pickle.loads(data)
-
-                if frame_info:
-                    nums_of_packs = frame_info["packs"]
+            source_address = address
+            stream_id = datagram[0]
+            received = self.reassembler.add(datagram_view[:size])
+            if received is None:
+                continue
+            capture_time, buffer = received
 
-                    for i in range(nums_of_packs):
-                        try:
+            if PICommunication.is_video_tiles(buffer):
+                frame = self.canvas.apply(buffer, self.reassembler.last_frame_id)
+            else:
+                frame = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
 
-                            data, address = sock.recvfrom(MAX_LENGTH)
-                        except socket.error:
-                            break
-                        if i == 0:
-                            buffer = data
-                        else:
-                            buffer += data
+            if frame is not None and type(frame) == np.ndarray:
+                frame = cv2.flip(frame, 1)
+                self.lock.acquire()
+                self.last_capture_time = capture_time
+                self.lock.release()
+                self.frames.put(frame)
 
-                    frame = np.frombuffer(buffer, dtype=np.uint8)
-                    frame = frame.reshape(frame.shape[0], 1)
+    def get_counters(self):
+        """
+        :return: counters of the reassembler, see FrameReassembler.get_counters, "reports": reports sent, and the
+        counters of the canvas, see TileCanvas.get_counters, once frames in tile mode arrived.
+        """
+        counters = self.reassembler.get_counters()
+        counters["reports"] = self.sent_reports
+        canvas_counters = self.canvas.get_counters()
+        if any(canvas_counters.values()):
+            counters.update(canvas_counters)
+        return counters
 
-                    frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
-                    frame = cv2.flip(frame, 1)
+    def __send_report(self, sock, address, stream_id, last_counters, elapsed):
+        """
+        Report the loss, jitter, throughput and frame rate since the last report to the streamer, which adapts its
+        encoding to them, and whether the canvas needs a keyframe.
+        :param address: address the stream comes from
+        :param last_counters: counters of the reassembler at the last report
+        :param elapsed: seconds since the last report
+        :return: counters of the reassembler now
+        """
+        counters = self.reassembler.get_counters()
+        lost_packs = counters["lost_packs"] - last_counters["lost_packs"]
+        received_packs = counters["packs"] - last_counters["packs"]
+        loss = lost_packs / (lost_packs + received_packs) if lost_packs else 0.0
+        report = PICommunication.video_report_pack(stream_id, loss, self.reassembler.jitter,
+                                                   (counters["bytes"] - last_counters["bytes"]) / elapsed,
+                                                   (counters["frames"] - last_counters["frames"]) / elapsed,
+                                                   self.canvas.keyframe_needed)
+        try:
+            sock.sendto(report, address)
+            self.sent_reports += 1
+        except OSError as e:
+            print(f"[Log] - Failed sending stream report to {address}: {e}")
+        return counters
 
-                    if frame is not None and type(frame) == np.ndarray:
-                        self.lock.acquire()
-                        self.frame_queue.append(frame)
-                        self.lock.release()
 
 def main():
     receiver1 = StreamReceiver('0.0.0.0', 5000)
@@ -84,12 +412,14 @@ def main():
     right_frame = None
     i = 0
     while True:
-        if receiver1.frame_queue:
-            left_frame = receiver1.frame_queue.pop(0)
+        frame = receiver1.frames.get_nowait()
+        if frame is not None:
+            left_frame = frame
             cv2.imshow("Receiver1", left_frame)
 
-        if receiver2.frame_queue:
-            right_frame = receiver2.frame_queue.pop(0)
+        frame = receiver2.frames.get_nowait()
+        if frame is not None:
+            right_frame = frame
             cv2.imshow("Receiver2", right_frame)
 
         key = cv2.waitKey(1)
@@ -1,92 +1,806 @@
-import pickle
+import json
+import random
+import select
 import socket
+import sys
+import threading
+import time
+import zlib
 
 import cv2
 import math
+import numpy as np
 
-MAX_LENGTH = 65000
+from network.protocol import PICommunication
+from network.socket_profiles import PROFILE_BULK_VIDEO, apply_socket_profile, get_socket_profile
+
+CONSTANTS_PATH = "constants.json"
+MAX_LENGTH = PICommunication.video_pack_size
+# Reads in a row that may fail before a camera is considered disconnected.
+MAX_FAILED_READS = 30
+# How many seconds of bandwidth a destination may send at once.
+BURST_TIME = 0.5
+# Bytes per second of video the cameras share, for constants.json without "video": {"link_budget"}.
+LINK_BUDGET = 1500000
+# Encoding levels from best to worst: (scale of the captured resolution, jpeg quality, frames per second).
+ENCODING_LEVELS = [(1.0, 80, 24), (1.0, 65, 24), (0.75, 65, 24), (0.75, 50, 20), (0.5, 50, 20), (0.5, 40, 15),
+                   (0.5, 30, 10)]
+# Seconds between adjustments of the encoding, so the effect of one is measured before the next.
+ADJUST_INTERVAL = 1.0
+# Reported loss above which the bitrate target is cut, and below which it grows again.
+HIGH_LOSS = 0.05
+LOW_LOSS = 0.01
+# Reported jitter above which the link is considered congested, in seconds.
+HIGH_JITTER = 0.05
+TARGET_DECREASE = 0.7
+# Part of the maximum bitrate the target grows by every adjustment without loss.
+TARGET_INCREASE = 0.05
+# Lowest bitrate target, as a part of the maximum bitrate.
+MIN_TARGET = 0.1
+# A better level is only tried when the bitrate is under this part of the target, so it likely fits, or when it was
+# measured under the target within the last LEVEL_MEMORY seconds.
+UPGRADE_HEADROOM = 0.7
+LEVEL_MEMORY = 10.0
+# Tile mode: width and height of a tile, for constants.json without "video": {"tile_size"}. 0 sends whole frames.
+TILE_SIZE = 0
+# Difference of a pixel from the tile last sent above which it changed, out of 255. Camera noise stays below it.
+PIXEL_THRESHOLD = 24
+# Part of the pixels of a tile that must change for the tile to be sent again.
+TILE_CHANGE_SHARE = 0.01
+# Seconds between keyframes, which bring receivers that lost a delta frame back in sync.
+KEYFRAME_INTERVAL = 2.0
+# Part of the tiles that changed above which a keyframe is sent instead, as one jpeg costs less than that many tiles.
+KEYFRAME_TILE_SHARE = 0.5
+# {stereo layout: axis the left and right frames are packed along}
+STEREO_AXES = {PICommunication.stereo_side_by_side: 1, PICommunication.stereo_top_bottom: 0}
+
+
+class BandwidthLimiter:
+    """
+    Token bucket of a stream destination. Whole frames are sent or skipped, so a capped destination gets fewer frames
+    instead of broken ones.
+    """
+
+    def __init__(self, bandwidth_cap: int):
+        """
+        Initialize BandwidthLimiter object
+        :param bandwidth_cap: bytes per second
+        """
+        self.bandwidth_cap = bandwidth_cap
+        self.tokens = bandwidth_cap * BURST_TIME
+        self.last_time = time.monotonic()
+
+    def allow(self, size):
+        """
+        :param size: bytes of a frame
+        :return: Whether the frame may be sent. A frame larger than the tokens left is still sent, and paid for by
+        skipping the next frames.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.bandwidth_cap * BURST_TIME, self.tokens + (now - self.last_time) * self.bandwidth_cap)
+        self.last_time = now
+        if self.tokens <= 0:
+            return False
+        self.tokens -= size
+        return True
+
+
+class BitrateController:
+    """
+    Picks the encoding level of a stream from the reports of its receivers. The bitrate target is cut when they report
+    loss or jitter and grows back slowly while they don't, up to the share of the link budget of the stream. The level
+    steps down while the stream is over the target, and up while it is well under it.
+    Not thread safe.
+    """
+
+    def __init__(self, max_bitrate: float):
+        """
+        Initialize BitrateController object
+        :param max_bitrate: bytes per second the stream may use
+        """
+        self.max_bitrate = max_bitrate
+        self.target_bitrate = max_bitrate
+        self.level = 0
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+        self.bitrate = 0.0
+        # {level: (bitrate, time.monotonic())} measured at every level
+        self.level_bitrates = {}
+        self.worst_loss = None
+        self.worst_jitter = 0.0
+        self.adjustments = 0
+
+    def get_encoding(self):
+        """
+        :return: (scale of the captured resolution, jpeg quality, frames per second) to encode with
+        """
+        return ENCODING_LEVELS[self.level]
+
+    def set_max_bitrate(self, max_bitrate: float):
+        self.max_bitrate = max_bitrate
+        self.target_bitrate = min(self.target_bitrate, max_bitrate)
+
+    def add_frame(self, size):
+        """
+        :param size: bytes of a frame that was encoded
+        """
+        self.window_bytes += size
+
+    def add_report(self, loss, jitter):
+        """
+        :param loss: fraction of packs a receiver lost since its last report
+        :param jitter: jitter of the receiver, in seconds
+        """
+        self.worst_loss = loss if self.worst_loss is None else max(self.worst_loss, loss)
+        self.worst_jitter = max(self.worst_jitter, jitter)
+
+    def update(self, now: float = None):
+        """
+        Adjust the target and the level, once every ADJUST_INTERVAL in which reports arrived.
+        :param now: time.monotonic(), None to read it
+        :return: Whether the level changed.
+        """
+        now = now if now is not None else time.monotonic()
+        if now - self.window_start < ADJUST_INTERVAL or self.worst_loss is None:
+            return False
+        self.bitrate = self.window_bytes / (now - self.window_start)
+        self.level_bitrates[self.level] = (self.bitrate, now)
+        congested = self.worst_loss > HIGH_LOSS or self.worst_jitter > HIGH_JITTER
+        if congested:
+            self.target_bitrate = max(self.max_bitrate * MIN_TARGET, self.target_bitrate * TARGET_DECREASE)
+        elif self.worst_loss < LOW_LOSS:
+            self.target_bitrate = min(self.max_bitrate, self.target_bitrate + self.max_bitrate * TARGET_INCREASE)
+        self.window_start = now
+        self.window_bytes = 0
+        self.worst_loss = None
+        self.worst_jitter = 0.0
+
+        level = self.level
+        if self.bitrate > self.target_bitrate and self.level < len(ENCODING_LEVELS) - 1:
+            self.level += 1
+        elif not congested and self.level > 0 and self.__fits(self.level - 1, now):
+            self.level -= 1
+        if self.level == level:
+            return False
+        self.adjustments += 1
+        return True
+
+    def __fits(self, level, now):
+        """
+        :return: Whether level likely fits the target: it was measured under it lately, or the current level is well
+        under it.
+        """
+        bitrate, measure_time = self.level_bitrates.get(level, (None, 0.0))
+        if bitrate is not None and now - measure_time < LEVEL_MEMORY:
+            return bitrate <= self.target_bitrate
+        return self.bitrate < self.target_bitrate * UPGRADE_HEADROOM
+
+
+class TileEncoder:
+    """
+    Encodes the frames of a stream in tile mode. Every frame is split into tiles and compared to the frame the receivers
+    have, and only the tiles that changed are encoded and sent, so a still scene costs next to no bandwidth or cpu.
+    A keyframe of the whole frame is sent every KEYFRAME_INTERVAL, when most tiles changed or the resolution did, and
+    when a receiver asks for one.
+    Not thread safe.
+    """
+
+    def __init__(self, tile_size: int, pixel_threshold: int = PIXEL_THRESHOLD,
+                 change_share: float = TILE_CHANGE_SHARE):
+        """
+        Initialize TileEncoder object
+        :param tile_size: width and height of a tile
+        :param pixel_threshold: difference of a pixel from the tile last sent above which it changed
+        :param change_share: part of the pixels of a tile that must change for the tile to be sent
+        reference: numpy.ndarray, the frame as the receivers have it. None before the first keyframe.
+        """
+        self.tile_size = tile_size
+        self.pixel_threshold = pixel_threshold
+        self.change_share = change_share
+        self.reference = None
+        self.keyframe_requested = False
+        self.next_keyframe_time = 0.0
+        self.keyframes = 0
+        self.delta_frames = 0
+        self.sent_tiles = 0
+        self.still_frames = 0
+
+    def request_keyframe(self):
+        self.keyframe_requested = True
+
+    def encode(self, frame, quality: int, base_frame_id: int, now: float = None):
+        """
+        :param frame: numpy.ndarray, frame
+        :param quality: jpeg quality
+        :param base_frame_id: id of the last frame sent, which a delta frame updates
+        :param now: time.monotonic(), None to read it
+        :return: (Whether the frame is a keyframe, frame encoded), None if no tile changed or encoding failed.
+        """
+        now = now if now is not None else time.monotonic()
+        height, width = frame.shape[:2]
+        keyframe = self.keyframe_requested or now >= self.next_keyframe_time or self.reference is None or \
+            self.reference.shape != frame.shape
+        if not keyframe:
+            changed_tiles = self.__get_changed_tiles(frame)
+            if not changed_tiles.any():
+                self.still_frames += 1
+                return None
+            keyframe = changed_tiles.mean() > KEYFRAME_TILE_SHARE
+
+        if keyframe:
+            retval, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not retval:
+                return None
+            self.reference = frame.copy()
+            self.keyframe_requested = False
+            self.next_keyframe_time = now + KEYFRAME_INTERVAL
+            self.keyframes += 1
+            return True, PICommunication.video_tiles(True, base_frame_id, width, height, self.tile_size,
+                                                     [(0, buffer.tobytes())])
+
+        tiles = []
+        columns = changed_tiles.shape[1]
+        for row, column in zip(*np.nonzero(changed_tiles)):
+            top = row * self.tile_size
+            left = column * self.tile_size
+            tile = frame[top:top + self.tile_size, left:left + self.tile_size]
+            retval, buffer = cv2.imencode(".jpg", tile, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not retval:
+                # Left out of the reference, so it is tried again with the next frame.
+                continue
+            self.reference[top:top + self.tile_size, left:left + self.tile_size] = tile
+            tiles.append((int(row * columns + column), buffer.tobytes()))
+        if not tiles:
+            return None
+        self.delta_frames += 1
+        self.sent_tiles += len(tiles)
+        return False, PICommunication.video_tiles(False, base_frame_id, width, height, self.tile_size, tiles)
+
+    def get_counters(self):
+        """
+        :return: {"keyframes", "delta_frames", "tiles": tiles of the delta frames, "still": frames not sent, as
+        nothing changed}
+        """
+        return {"keyframes": self.keyframes, "delta_frames": self.delta_frames, "tiles": self.sent_tiles,
+                "still": self.still_frames}
+
+    def __get_changed_tiles(self, frame):
+        """
+        :param frame: numpy.ndarray of the shape of the reference
+        :return: numpy.ndarray of bools, (tile rows, tile columns), True for the tiles in which enough pixels changed
+        since the reference
+        """
+        # Stays in uint8, unlike a subtraction in a wider type.
+        difference = np.maximum(frame, self.reference) - np.minimum(frame, self.reference)
+        if difference.ndim == 3:
+            difference = difference.max(axis=2)
+        changed = difference > self.pixel_threshold
+        height, width = changed.shape
+        rows = -(-height // self.tile_size)
+        columns = -(-width // self.tile_size)
+        changed = np.pad(changed, ((0, rows * self.tile_size - height), (0, columns * self.tile_size - width)))
+        changed_pixels = changed.reshape(rows, self.tile_size, columns, self.tile_size).sum(axis=(1, 3))
+        # Tiles on the right and bottom edges may be smaller.
+        tile_heights = np.minimum(self.tile_size, height - np.arange(rows) * self.tile_size)
+        tile_widths = np.minimum(self.tile_size, width - np.arange(columns) * self.tile_size)
+        return changed_pixels > np.outer(tile_heights, tile_widths) * self.change_share
 
 
 class Streamer:
+    """
+    Sends the frames of a camera to any number of destinations. Every frame is encoded once, and every destination
+    can have a bandwidth cap, so a slow destination only gets fewer frames.
+    The receivers report their loss and jitter back to the socket of the stream, and the jpeg quality, resolution and
+    frame rate are adapted to them by a BitrateController. Only the reports of uncapped destinations, such as the
+    controller, are adapted to while there are any, so a lossy viewer never degrades the video of the driver.
+    In tile mode only the tiles that changed are sent, by a TileEncoder. A destination that missed a frame, because of
+    its bandwidth cap, gets no more delta frames until the next keyframe.
+    """
 
-    def __init__(self, host, port):
+    def __init__(self, host=None, port=None, socket_profile: dict = None, stream_id: int = 0,
+                 max_bitrate: float = LINK_BUDGET, tile_size: int = TILE_SIZE):
         """
         Initialize a Streamer object
-        :param host: destination host
+        :param host: destination host, None to start without destinations
         :param port: destination port
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile
+        :param stream_id: id of the stream in the header of its datagrams, 0 to 255
+        :param max_bitrate: bytes per second the stream may use
+        :param tile_size: width and height of the tiles in tile mode, 0 to send whole frames
         """
-        self.host = host
-        self.port = port
+        self.bitrate_controller = BitrateController(max_bitrate)
+        self.tile_encoder = TileEncoder(tile_size) if tile_size else None
+        self.received_reports = 0
+        self.stream_id = stream_id
+        # Starting at a random frame id, a restarted streamer isn't mistaken for late packs of its previous run.
+        self.next_frame_id = random.randrange(PICommunication.video_max_frame_id)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        print(self.host, type(self.host), self.port, type(self.port))
-        
-    def send_frame(self, frame):
+        print(f"[Log] - Socket settings of stream: {apply_socket_profile(self.sock, socket_profile)}")
+        self.lock = threading.Lock()
+        # {(host, port): BandwidthLimiter, None for no cap}
+        self.destinations = {}
+        # Destinations waiting for a keyframe, in tile mode
+        self.unsynced_destinations = set()
+        self.sent_frames = 0
+        self.skipped_frames = 0
+        if host is not None:
+            self.add_destination(host, port)
+
+    def add_destination(self, host, port, bandwidth_cap: int = 0):
+        """
+        Add a destination, or change the bandwidth cap of an existing one.
+        :param bandwidth_cap: bytes per second, 0 for no cap
+        """
+        self.lock.acquire()
+        if (host, port) not in self.destinations and self.tile_encoder is not None:
+            self.unsynced_destinations.add((host, port))
+            self.tile_encoder.request_keyframe()
+        self.destinations[(host, port)] = BandwidthLimiter(bandwidth_cap) if bandwidth_cap else None
+        self.lock.release()
+        print(f"[Log] - Streaming to {host}:{port}, bandwidth cap: {bandwidth_cap or None}")
+
+    def remove_destination(self, host, port):
+        self.lock.acquire()
+        self.destinations.pop((host, port), None)
+        self.unsynced_destinations.discard((host, port))
+        self.lock.release()
+        print(f"[Log] - Stopped streaming to {host}:{port}")
+
+    def handle_command(self, line):
         """
-        Send frame to destination
+        Handle a line of the control commands the server writes to the stdin of the streamer process:
+        "add <host>:<port> <bandwidth cap>" or "remove <host>:<port>".
+        """
+        words = line.split()
+        if not words:
+            return
+        try:
+            host, port = words[1].split(":")
+            if words[0] == "add":
+                self.add_destination(host, int(port), int(words[2]) if len(words) > 2 else 0)
+            elif words[0] == "remove":
+                self.remove_destination(host, int(port))
+            else:
+                print(f"[Log] - Unknown streamer command: {line}")
+        except (IndexError, ValueError) as e:
+            print(f"[Log] - Malformed streamer command {line}: {e}")
+
+    def send_frame(self, frame, capture_time: float = None):
+        """
+        Send frame to every destination whose bandwidth cap allows it
         :param frame: numpy.ndarray, frame
+        :param capture_time: When the frame was captured, time.time(). None for now.
         """
-        # compress frame
-        retval, buffer = cv2.imencode(".jpg", frame)
+        self.read_reports()
+        self.lock.acquire()
+        # Destinations without a cap go first, so capped ones never delay them.
+        destinations = sorted(self.destinations.items(), key=lambda destination: destination[1] is not None)
+        self.lock.release()
+        if not destinations:
+            return
 
-        if retval:
+        scale, quality, frame_rate = self.bitrate_controller.get_encoding()
+        if scale != 1.0:
+            height, width = frame.shape[:2]
+            frame = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        frame_id = self.next_frame_id
+        if self.tile_encoder is not None:
+            encoded = self.tile_encoder.encode(frame, quality, frame_id - 1)
+            if encoded is None:
+                return
+            keyframe, buffer = encoded
+        else:
+            # compress frame
+            retval, buffer = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not retval:
+                return
+            keyframe = True
             # convert to byte array
             buffer = buffer.tobytes()
-            # get size of the frame
-            buffer_size = len(buffer)
+        # get size of the frame
+        buffer_size = len(buffer)
+        self.bitrate_controller.add_frame(buffer_size)
+
+        num_of_packs = 1
+        if buffer_size > MAX_LENGTH:
+            num_of_packs = math.ceil(buffer_size / MAX_LENGTH)
 
-            num_of_packs = 1
-            if buffer_size > MAX_LENGTH:
-                num_of_packs = math.ceil(buffer_size / MAX_LENGTH)
+        # Every pack carries the header, so the receiver never depends on a single datagram arriving.
+        self.next_frame_id += 1
+        crc = zlib.crc32(buffer)
+        capture_time = capture_time if capture_time is not None else time.time()
+        packs = []
 
-            frame_info = {"packs": num_of_packs}
+        left = 0
+        right = MAX_LENGTH
 
-            # send the number of packs to be expected
-            # print("Number of packs:", num_of_packs)
-            self.sock.sendto(pickle.dumps(frame_info), (self.host, self.port))
+        for i in range(num_of_packs):
+            # truncate data to send
+            packs.append(PICommunication.video_pack(self.stream_id, frame_id, i, num_of_packs, capture_time, crc,
+                                                    buffer[left:right]))
+            left = right
+            right += MAX_LENGTH
 
-            left = 0
-            right = MAX_LENGTH
+        for address, limiter in destinations:
+            # A delta frame is useless to a destination that missed the frame it updates.
+            if not keyframe and address in self.unsynced_destinations:
+                self.skipped_frames += 1
+                continue
+            if limiter is not None and not limiter.allow(buffer_size):
+                self.skipped_frames += 1
+                self.__unsync(address)
+                continue
+            try:
+                for data in packs:
+                    self.sock.sendto(data, address)
+            except OSError as e:
+                print(f"[Log] - Failed streaming to {address}: {e}")
+                self.__unsync(address)
+                continue
+            self.unsynced_destinations.discard(address)
+            self.sent_frames += 1
 
-            for i in range(num_of_packs):
-                # print("left:", left)
-                # print("right:", right)
+    def read_reports(self):
+        """
+        Read the reports the receivers sent since the last call, without blocking, and adapt the encoding to them.
+        """
+        while select.select([self.sock], [], [], 0)[0]:
+            try:
+                report, address = self.sock.recvfrom(PICommunication.video_report.size + 1)
+                stream_id, loss, jitter, throughput, frame_rate, keyframe_needed = \
+                    PICommunication.parse_video_report(report)
+            except ValueError:
+                continue
+            except OSError:
+                # An ICMP error of a destination that is gone, reported on the next receive.
+                continue
+            self.received_reports += 1
+            if self.__adapts_to(address):
+                self.bitrate_controller.add_report(loss, jitter)
+            if keyframe_needed and self.tile_encoder is not None:
+                self.tile_encoder.request_keyframe()
+        if self.bitrate_controller.update():
+            scale, quality, frame_rate = self.bitrate_controller.get_encoding()
+            print(f"[Log] - Stream {self.stream_id} encoding: scale {scale}, quality {quality}, {frame_rate} fps, "
+                  f"target {self.bitrate_controller.target_bitrate:.0f} B/s")
+
+    def get_frame_interval(self):
+        """
+        :return: seconds between the frames of the current encoding level
+        """
+        return 1.0 / self.bitrate_controller.get_encoding()[2]
+
+    def __adapts_to(self, address):
+        """
+        :param address: (host, port) a report came from
+        :return: Whether to adapt the encoding to the report: it came from an uncapped destination, or every
+        destination is capped.
+        """
+        self.lock.acquire()
+        if address in self.destinations:
+            adapts = self.destinations[address] is None or None not in self.destinations.values()
+        else:
+            adapts = False
+        self.lock.release()
+        return adapts
+
+    def __unsync(self, address):
+        """
+        Stop sending delta frames to a destination that missed a frame, until the next keyframe.
+        """
+        if self.tile_encoder is not None:
+            self.unsynced_destinations.add(address)
+
+
+class StereoCapture:
+    """
+    Captures the left and right cameras as one, with the interface of cv2.VideoCapture. Both cameras are grabbed back
+    to back before either frame is decoded, so the two frames are as close in time as the cameras allow, and read
+    returns them packed into one frame.
+    """
+
+    def __init__(self, device_indexes, layout: str = PICommunication.stereo_side_by_side):
+        """
+        Initialize StereoCapture object and open the cameras.
+        :param device_indexes: (index of the left video device, index of the right video device)
+        :param layout: PICommunication.stereo_side_by_side or PICommunication.stereo_top_bottom
+        """
+        if layout not in STEREO_AXES:
+            raise ValueError(f"Unknown stereo layout: {layout}")
+        self.axis = STEREO_AXES[layout]
+        self.captures = [cv2.VideoCapture(device_index) for device_index in device_indexes]
+
+    def isOpened(self):
+        return all(capture.isOpened() for capture in self.captures)
+
+    def grab(self):
+        # Every camera is grabbed, even after one failed, so they stay in step.
+        return all([capture.grab() for capture in self.captures])
+
+    def read(self):
+        """
+        :return: Whether both frames were read, numpy.ndarray of the left and right frames packed together
+        """
+        if not self.grab():
+            return False, None
+        (left_ret, left_frame), (right_ret, right_frame) = [capture.retrieve() for capture in self.captures]
+        if not left_ret or not right_ret:
+            return False, None
+        if right_frame.shape != left_frame.shape:
+            right_frame = cv2.resize(right_frame, (left_frame.shape[1], left_frame.shape[0]))
+        return True, np.concatenate((left_frame, right_frame), axis=self.axis)
+
+    def release(self):
+        for capture in self.captures:
+            capture.release()
+
+
+class CameraWorker:
+    """
+    Captures the frames of a camera and sends them with a Streamer, from its own thread. The camera stays open while
+    the worker runs, so a new destination gets frames right away instead of waiting for the camera to open. While the
+    streamer has no destinations, and between the frames of the frame rate of its encoding, frames are grabbed but
+    neither decoded nor encoded.
+    """
+
+    def __init__(self, streamer, device_index, flip: bool = True, stereo_layout: str = None):
+        """
+        Initialize CameraWorker object
+        :param streamer: Streamer to send the frames with
+        :param device_index: Index of video device, (index of the left device, index of the right device) in stereo
+        :param flip: Whether to flip the frames horizontally.
+        :param stereo_layout: layout of the frames packing both cameras, see StereoCapture. None for a single camera.
+        """
+        if stereo_layout is not None and stereo_layout not in STEREO_AXES:
+            raise ValueError(f"Unknown stereo layout: {stereo_layout}")
+        self.streamer = streamer
+        self.device_index = device_index
+        self.flip = flip
+        self.stereo_layout = stereo_layout
+        self.running = False
+        self.opened = threading.Event()
+        self.captured_frames = 0
+        self.failed_reads = 0
+        self.thread = None
+
+    def start(self):
+        """
+        Start the thread, which opens the camera. Returns right away.
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the thread and release the camera.
+        """
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def run(self):
+        """
+        Capture and send frames until stopped, or until the camera fails.
+        """
+        open_time = time.monotonic()
+        if self.stereo_layout is not None:
+            cap = StereoCapture(self.device_index, self.stereo_layout)
+        else:
+            cap = cv2.VideoCapture(self.device_index)
+        if not cap.isOpened():
+            print(f"[Log] - Failed opening video device {self.device_index}")
+            self.running = False
+            return
+        print(f"[Log] - Opened video device {self.device_index} in {(time.monotonic() - open_time) * 1000:.1f} ms")
+        self.opened.set()
+        next_frame_time = time.monotonic()
+        try:
+            while self.running:
+                now = time.monotonic()
+                if not self.streamer.destinations or now < next_frame_time:
+                    # Grabbing keeps the camera buffer fresh, so the first frame sent isn't a stale one.
+                    ret = cap.grab()
+                    frame = None
+                else:
+                    # Frames are sent at the frame rate of the encoding, on average.
+                    next_frame_time = max(next_frame_time + self.streamer.get_frame_interval(), now)
+                    ret, frame = cap.read()
+                    capture_time = time.time()
+                if not ret:
+                    self.failed_reads += 1
+                    if self.failed_reads >= MAX_FAILED_READS:
+                        print(f"[Log] - Video device {self.device_index} stopped sending frames")
+                        break
+                    continue
+                self.failed_reads = 0
+                self.captured_frames += 1
+                if frame is not None:
+                    if self.flip:
+                        # A stereo frame is flipped whole, and the receiver flips it back before splitting it.
+                        frame = cv2.flip(frame, 1)  # flip horizontal
+                    self.streamer.send_frame(frame, capture_time)
+        finally:
+            cap.release()
+            self.opened.clear()
+            self.running = False
+
+
+class StreamingService:
+    """
+    Streams the cameras from inside the server process: one CameraWorker per camera, started, stopped and sent to
+    through this API. The destinations of a camera are kept while its worker is restarted.
+    The cameras being watched split the link budget evenly, and each adapts its encoding within its share.
+    """
+
+    def __init__(self, socket_profile: dict = None, link_budget: float = LINK_BUDGET, tile_size: int = TILE_SIZE):
+        """
+        Initialize StreamingService object
+        :param socket_profile: socket settings of the streams, from socket_profiles.get_socket_profile
+        :param link_budget: bytes per second of video all the cameras may send together
+        :param tile_size: width and height of the tiles in tile mode, 0 to send whole frames
+        """
+        self.socket_profile = socket_profile
+        self.link_budget = link_budget
+        self.tile_size = tile_size
+        self.lock = threading.Lock()
+        # {camera: Streamer}
+        self.streamers = {}
+        # {camera: CameraWorker}
+        self.workers = {}
+
+    def start(self, camera, device_index, stereo_layout: str = None):
+        """
+        Start streaming a camera, unless it already streams from device_index. A camera streaming from another device
+        is restarted with the new one.
+        :param camera: name of the camera, such as "left"
+        :param device_index: Index of video device, (index of the left device, index of the right device) in stereo
+        :param stereo_layout: layout of the frames packing both cameras into one stream, see StereoCapture. None for
+        a single camera.
+        """
+        self.lock.acquire()
+        worker = self.workers.get(camera)
+        if worker is not None and worker.is_alive() and worker.device_index == device_index:
+            self.lock.release()
+            return
+        new_worker = CameraWorker(self.__get_streamer(camera), device_index, stereo_layout=stereo_layout)
+        self.workers[camera] = new_worker
+        self.lock.release()
+        if worker is not None:
+            worker.stop()
+        print(f"[Log] - Starting camera stream {camera} from video device {device_index}")
+        new_worker.start()
+
+    def stop(self, camera):
+        """
+        Stop streaming a camera and release it. Its destinations are kept for the next start.
+        """
+        self.lock.acquire()
+        worker = self.workers.pop(camera, None)
+        self.lock.release()
+        if worker is not None:
+            worker.stop()
+
+    def is_streaming(self, camera):
+        """
+        :return: Whether the worker of the camera runs.
+        """
+        worker = self.workers.get(camera)
+        return worker is not None and worker.is_alive()
+
+    def add_destination(self, camera, host, port, bandwidth_cap: int = 0):
+        """
+        Send the frames of a camera to host:port, or change the bandwidth cap of an existing destination.
+        :param bandwidth_cap: bytes per second, 0 for no cap
+        """
+        self.lock.acquire()
+        self.__get_streamer(camera).add_destination(host, port, bandwidth_cap)
+        self.__split_link_budget()
+        self.lock.release()
+
+    def remove_destination(self, camera, host, port):
+        self.lock.acquire()
+        self.__get_streamer(camera).remove_destination(host, port)
+        self.__split_link_budget()
+        self.lock.release()
+
+    def get_counters(self):
+        """
+        :return: {camera: {"streaming", "destinations", "captured", "sent", "skipped": frames, "reports": receiver
+        reports, "level": encoding level, "target": bitrate target, "adjustments": encoding level changes}}, and
+        the counters of TileEncoder.get_counters in tile mode
+        """
+        self.lock.acquire()
+        counters = {camera: {"streaming": self.is_streaming(camera), "destinations": len(streamer.destinations),
+                             "captured": self.workers[camera].captured_frames if camera in self.workers else 0,
+                             "sent": streamer.sent_frames, "skipped": streamer.skipped_frames,
+                             "reports": streamer.received_reports, "level": streamer.bitrate_controller.level,
+                             "target": round(streamer.bitrate_controller.target_bitrate),
+                             "adjustments": streamer.bitrate_controller.adjustments}
+                    for camera, streamer in self.streamers.items()}
+        for camera, streamer in self.streamers.items():
+            if streamer.tile_encoder is not None:
+                counters[camera].update(streamer.tile_encoder.get_counters())
+        self.lock.release()
+        return counters
+
+    def close(self):
+        """
+        Stop every camera stream and release the cameras.
+        """
+        for camera in list(self.workers):
+            self.stop(camera)
+        for streamer in self.streamers.values():
+            streamer.sock.close()
+
+    def __get_streamer(self, camera):
+        """
+        Must be called with self.lock held.
+        :return: Streamer of the camera, created if there is none.
+        """
+        if camera not in self.streamers:
+            self.streamers[camera] = Streamer(socket_profile=self.socket_profile, stream_id=len(self.streamers),
+                                              max_bitrate=self.link_budget, tile_size=self.tile_size)
+            self.__split_link_budget()
+        return self.streamers[camera]
+
+    def __split_link_budget(self):
+        """
+        Give every camera being watched an even share of the link budget. Must be called with self.lock held.
+        """
+        watched_count = max(1, len([streamer for streamer in self.streamers.values() if streamer.destinations]))
+        for streamer in self.streamers.values():
+            streamer.bitrate_controller.set_max_bitrate(self.link_budget / watched_count)
 
-                # truncate data to send
-                data = buffer[left:right]
-                left = right
-                right += MAX_LENGTH
 
-                # send the frames accordingly
-                self.sock.sendto(data, (self.host, self.port))
+def read_commands(streamer):
+    """
+    Handle the control commands written to stdin, until it closes.
+    :param streamer: Streamer
+    """
+    for line in sys.stdin:
+        streamer.handle_command(line)
 
 import argparse
 def main():
 
     parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('-a', '--address', dest='address',
-                    help='<host>:<port> representing the destination address for the streamer')
+    parser.add_argument('-a', '--address', dest='address', default=None,
+                    help='<host>:<port> of a first destination. More are added with commands on stdin')
     parser.add_argument('-i', '--video-device-id', dest='video_device_id',
                     help='Index of video device')
+    parser.add_argument('-r', '--right-video-device-id', dest='right_video_device_id', default=None,
+                    help='Index of the right video device, to stream both cameras packed into one stereo stream')
+    parser.add_argument('-s', '--stereo-layout', dest='stereo_layout', default=PICommunication.stereo_side_by_side,
+                    help='Layout of the stereo frames: side-by-side or top-bottom')
+    parser.add_argument('-p', '--socket-profile', dest='socket_profile', default=PROFILE_BULK_VIDEO,
+                    help='Name of the socket profile in constants.json to apply')
+    parser.add_argument('-t', '--tile-size', dest='tile_size', type=int, default=TILE_SIZE,
+                    help='Size of the tiles to send only the changed parts of the frames, 0 to send whole frames')
 
     args = parser.parse_args()
     print(args)
 
-    address = args.address
-    host, port = address.split(":")
-    port = int(port)
-    streamer = Streamer(host, port)
-    id = int(args.video_device_id)
-    cap = cv2.VideoCapture(id)
-    print("Entering loop", host, port, args.video_device_id)
-    while True:
-        ret, frame = cap.read()
-
-        if ret:
-            frame = cv2.flip(frame, 1)  # flip horizontal
-            streamer.send_frame(frame)
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
+    socket_profile = get_socket_profile(json.load(open(CONSTANTS_PATH)), args.socket_profile)
+    streamer = Streamer(socket_profile=socket_profile, stream_id=int(args.video_device_id), tile_size=args.tile_size)
+    if args.address is not None:
+        host, port = args.address.split(":")
+        streamer.add_destination(host, int(port))
+    threading.Thread(target=read_commands, args=(streamer,), daemon=True).start()
+    if args.right_video_device_id is not None:
+        worker = CameraWorker(streamer, (int(args.video_device_id), int(args.right_video_device_id)),
+                              stereo_layout=args.stereo_layout)
+    else:
+        worker = CameraWorker(streamer, int(args.video_device_id))
+    print("Entering loop", args.video_device_id)
+    worker.start()
+    try:
+        worker.thread.join()
+    except KeyboardInterrupt:
+        worker.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,182 @@
+import threading
+import time
+
+from network.protocol import PICommunication
+
+ACK_TIMEOUT = 2.0
+RTT_WINDOW = 1024
+
+
+class RTTHistogram:
+    """
+    Rolling window of the last round trip times, for percentiles that follow the current link conditions.
+    """
+
+    def __init__(self, window: int = RTT_WINDOW):
+        """
+        Initialize RTTHistogram object
+        :param window: How many of the last samples to keep.
+        """
+        self.window = window
+        self.samples = [0.0] * window
+        self.next_index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, rtt):
+        """
+        :param rtt: round trip time in seconds
+        """
+        self.lock.acquire()
+        self.samples[self.next_index] = rtt
+        self.next_index = (self.next_index + 1) % self.window
+        self.count += 1
+        self.lock.release()
+
+    def get_percentiles(self):
+        """
+        :return: {"count": samples so far, "p50_ms", "p95_ms", "p99_ms": percentiles of the window}. Only the count if
+        there are no samples yet.
+        """
+        self.lock.acquire()
+        samples = sorted(self.samples[:min(self.count, self.window)])
+        count = self.count
+        self.lock.release()
+        if not samples:
+            return {"count": count}
+        percentiles = {"count": count}
+        for percentile in (50, 95, 99):
+            index = min(len(samples) - 1, len(samples) * percentile // 100)
+            percentiles[f"p{percentile}_ms"] = round(samples[index] * 1000, 3)
+        return percentiles
+
+
+class AckBatcher:
+    """
+    Collects the sequence numbers of the commands received from a client, and acknowledges all of them in a single
+    ack message.
+    """
+
+    def __init__(self, send):
+        """
+        Initialize AckBatcher object
+        :param send: function that sends a message to the client. Called from flush.
+        """
+        self.send = send
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def add(self, sequence_number):
+        self.lock.acquire()
+        self.pending.append(sequence_number)
+        self.lock.release()
+
+    def flush(self):
+        """
+        Acknowledge the commands received since the last flush, if there are any.
+        """
+        self.lock.acquire()
+        sequence_numbers = self.pending
+        self.pending = []
+        self.lock.release()
+        if sequence_numbers:
+            self.send(PICommunication.ack(sequence_numbers))
+
+
+class ControlTelemetry:
+    """
+    Round trip and command latency measurements of the control channel.
+    Round trips are measured with ping and pong messages carrying time.monotonic() timestamps, which are only ever
+    compared to the clock of the side that created them. A pong answering a ping carries a timestamp of its own, which
+    is echoed back in one more pong, so both sides get round trip samples from a single ping.
+    Commands can be sent with sequence numbers, and the time until their ack arrives is kept as the command latency.
+    """
+
+    def __init__(self, window: int = RTT_WINDOW, ack_timeout: float = ACK_TIMEOUT):
+        """
+        Initialize ControlTelemetry object
+        :param window: How many of the last samples to keep in each histogram.
+        :param ack_timeout: How long to wait for the ack of a command before counting it as lost, in seconds.
+        """
+        self.rtt = RTTHistogram(window)
+        self.command_latency = RTTHistogram(window)
+        self.ack_timeout = ack_timeout
+        self.lock = threading.Lock()
+        self.next_sequence_number = 0
+        self.outstanding = {}
+        self.acked_commands = 0
+        self.lost_commands = 0
+
+    def sequence(self, message):
+        """
+        Give a message the next sequence number, and start timing it.
+        :param message: message from PICommunication
+        :return: sequenced message
+        """
+        self.lock.acquire()
+        sequence_number = self.next_sequence_number
+        self.next_sequence_number = (self.next_sequence_number + 1) & 0xFFFFFFFF
+        now = time.monotonic()
+        self.outstanding[sequence_number] = now
+        if len(self.outstanding) > self.command_latency.window:
+            self.__expire_outstanding(now)
+        self.lock.release()
+        return PICommunication.sequenced(sequence_number, message)
+
+    def handle_ack(self, content):
+        """
+        :param content: content of an ack message
+        """
+        now = time.monotonic()
+        self.lock.acquire()
+        for sequence_number in PICommunication.parse_ack(content):
+            sent_time = self.outstanding.pop(sequence_number, None)
+            if sent_time is not None:
+                self.acked_commands += 1
+                self.command_latency.add(now - sent_time)
+        self.__expire_outstanding(now)
+        self.lock.release()
+
+    def __expire_outstanding(self, now):
+        """
+        Count commands whose ack is overdue as lost. Must be called with self.lock held.
+        """
+        for sequence_number, sent_time in list(self.outstanding.items()):
+            if now - sent_time > self.ack_timeout:
+                self.outstanding.pop(sequence_number)
+                self.lost_commands += 1
+
+    @staticmethod
+    def ping():
+        """
+        :return: ping message stamped with the current time
+        """
+        return PICommunication.ping(time.monotonic())
+
+    @staticmethod
+    def handle_ping(content):
+        """
+        :param content: content of a ping message
+        :return: pong to send back, with a timestamp for the other side to echo.
+        """
+        return PICommunication.pong(PICommunication.parse_timestamps(content)[0], time.monotonic())
+
+    def handle_pong(self, content):
+        """
+        Record the round trip of the echoed timestamp.
+        :param content: content of a pong message
+        :return: pong to send back if the pong carries a timestamp to echo, otherwise None.
+        """
+        timestamps = PICommunication.parse_timestamps(content)
+        self.rtt.add(time.monotonic() - timestamps[0])
+        if len(timestamps) > 1:
+            return PICommunication.pong(timestamps[1])
+        return None
+
+    def get_report(self):
+        """
+        :return: {"rtt": percentiles of the round trip, "command_latency": percentiles of the time until commands were
+        acknowledged, "acked", "lost", "outstanding": command counters}
+        """
+        return {"rtt": self.rtt.get_percentiles(), "command_latency": self.command_latency.get_percentiles(),
+                "acked": self.acked_commands, "lost": self.lost_commands, "outstanding": len(self.outstanding)}
@@ -0,0 +1,155 @@
+import socket
+import threading
+
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+
+from network.aes_utils import AESCTRHMACCipher
+from network.protocol import COMMAND_AXES, PICommunication
+from network.socket_profiles import apply_socket_profile
+
+CAPABILITY_UDP_CONTROL = b"udp-control="
+LANE_ID_SIZE = 8
+# Only idempotent, latest-value commands may be lost or dropped as stale, everything else stays on the tcp stream.
+# Batches are allowed when all of their commands are.
+UDP_CONTROL_CODES = set(COMMAND_AXES)
+BATCH_CODE = PICommunication.MessageCode.BATCH.value.encode()
+SEQUENCED_CODE = PICommunication.MessageCode.SEQUENCED.value.encode()
+
+
+def derive_udp_lane(session_key, is_server: bool):
+    """
+    Derive the udp control lane of a tcp session. Both sides derive the same lane from the session key, so nothing
+    has to be exchanged, and a resumed session gets a new lane.
+    :param session_key: session_key of the TCPStream
+    :param is_server: Whether this side is the server.
+    :return: lane_id, AESCTRHMACCipher. The cipher counter is the sequence number of the datagram.
+    """
+    key = HKDF(session_key, LANE_ID_SIZE + 32, b"", SHA256, context=CAPABILITY_UDP_CONTROL)
+    return key[:LANE_ID_SIZE], AESCTRHMACCipher(key[LANE_ID_SIZE:], is_server)
+
+
+class UDPControlSender:
+    """
+    Client side of the udp control lane. Every command is a single datagram:
+    lane id (8 bytes) + message code (4 bytes) + counter (8 bytes) + encrypted content + tag (16 bytes).
+    A lost datagram never delays the ones after it.
+    """
+
+    def __init__(self, address, session_key, socket_profile: dict = None):
+        """
+        Initialize UDPControlSender object
+        :param address: (host, port) of the udp control server
+        :param session_key: session_key of the TCPStream to the server
+        :param socket_profile: socket settings from socket_profiles.get_socket_profile
+        """
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        apply_socket_profile(self.sock, socket_profile)
+        self.lane_id, self.cipher = derive_udp_lane(session_key, False)
+
+    def send(self, message):
+        """
+        :param message: message from PICommunication, its code must be in UDP_CONTROL_CODES, or a batch of such
+        messages, with or without a sequence number.
+        """
+        header = self.lane_id + message[:PICommunication.msg_code_size]
+        self.sock.sendto(header + self.cipher.encrypt(message[PICommunication.msg_code_size:], header), self.address)
+
+    def close(self):
+        self.sock.close()
+
+
+def create_udp_control_sender(tcp_stream, host, socket_profile: dict = None):
+    """
+    :param tcp_stream: TCPStream to the server, after the handshake
+    :param host: host of the server
+    :param socket_profile: socket settings from socket_profiles.get_socket_profile
+    :return: UDPControlSender, or None if the server doesn't offer a udp control lane.
+    """
+    for capability in tcp_stream.peer_capabilities:
+        if capability.startswith(CAPABILITY_UDP_CONTROL):
+            port = int(capability[len(CAPABILITY_UDP_CONTROL):])
+            return UDPControlSender((host, port), tcp_stream.session_key, socket_profile)
+    return None
+
+
+class UDPControlReceiver:
+    """
+    Server side of the udp control lane. Holds a lane for every connected tcp session, and turns datagrams back into
+    messages. Datagrams of unknown lanes, forged ones, and ones older than the last received on their lane are dropped.
+    """
+
+    def __init__(self, port):
+        """
+        Initialize UDPControlReceiver object
+        :param port: port of the udp control server, announced to clients in the hello
+        """
+        self.capability = CAPABILITY_UDP_CONTROL + str(port).encode()
+        self.lanes = {}
+        self.lock = threading.Lock()
+        self.received_datagrams = 0
+        self.dropped_datagrams = 0
+
+    def register(self, session_key, owner=None):
+        """
+        Open the lane of a tcp session.
+        :param session_key: session_key of the TCPStream of the client
+        :param owner: any object, returned by decode with the messages of this lane.
+        :return: lane_id, to unregister the lane when the session ends.
+        """
+        lane_id, cipher = derive_udp_lane(session_key, True)
+        self.lock.acquire()
+        self.lanes[lane_id] = (cipher, owner)
+        self.lock.release()
+        return lane_id
+
+    def unregister(self, lane_id):
+        self.lock.acquire()
+        self.lanes.pop(lane_id, None)
+        self.lock.release()
+
+    def decode(self, datagram):
+        """
+        Not thread safe, datagrams must be decoded by a single thread.
+        :param datagram: datagram received on the udp control server
+        :return: message, same as the content received on the tcp stream, and the owner of its lane. None, None if the
+        datagram was dropped.
+        """
+        self.received_datagrams += 1
+        header_size = LANE_ID_SIZE + PICommunication.msg_code_size
+        self.lock.acquire()
+        cipher, owner = self.lanes.get(datagram[:LANE_ID_SIZE], (None, None))
+        self.lock.release()
+        code = datagram[LANE_ID_SIZE:header_size]
+        if cipher is None or (code not in UDP_CONTROL_CODES and code not in (BATCH_CODE, SEQUENCED_CODE)):
+            self.dropped_datagrams += 1
+            return None, None
+        try:
+            message = code + cipher.decrypt(datagram[header_size:], datagram[:header_size])
+            if not self.is_allowed(message):
+                raise ValueError("Message holds commands that are not allowed on the udp control lane")
+        except ValueError:
+            self.dropped_datagrams += 1
+            return None, None
+        return message, owner
+
+    @staticmethod
+    def is_allowed(message):
+        """
+        :param message: message from PICommunication
+        :return: Whether the message may be sent over the udp control lane.
+        Raises ValueError if the message is malformed.
+        """
+        sequence_number, message = PICommunication.split_sequenced(message)
+        code = message[:PICommunication.msg_code_size]
+        if code == BATCH_CODE:
+            return all(batched_message[:PICommunication.msg_code_size] in UDP_CONTROL_CODES
+                       for batched_message in PICommunication.split_batch(message[PICommunication.msg_code_size:]))
+        return code in UDP_CONTROL_CODES
+
+    def get_counters(self):
+        """
+        :return: {"received": datagrams received, "dropped": datagrams dropped as unknown, forged or stale}
+        """
+        return {"received": self.received_datagrams, "dropped": self.dropped_datagrams}
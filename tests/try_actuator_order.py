@@ -0,0 +1,73 @@
+import threading
+
+from network.actuator import ActuatorWorker
+from network.protocol import PICommunication
+
+MessageCode = PICommunication.MessageCode
+
+
+class RecordingDispatcher:
+    """
+    Records the codes of the commands it executes, batched ones one by one. Blocks on the first command until
+    released, so the commands submitted meanwhile wait in the lanes.
+    """
+
+    def __init__(self):
+        self.executed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def dispatch(self, message, session):
+        code = bytes(message[:PICommunication.msg_code_size])
+        if code == MessageCode.BATCH.value.encode():
+            for batched_message in PICommunication.split_batch(message[PICommunication.msg_code_size:]):
+                self.dispatch(batched_message, session)
+            return True
+        if not self.started.is_set():
+            self.started.set()
+            self.release.wait()
+        self.executed.append(MessageCode(code.decode()).name)
+        return True
+
+
+def run(messages):
+    """
+    :param messages: messages submitted while the worker executes a first camera command
+    :return: names of the commands executed after the first one, in order
+    """
+    dispatcher = RecordingDispatcher()
+    worker = ActuatorWorker(dispatcher, threading.Lock())
+    done = threading.Semaphore(0)
+    worker.submit(PICommunication.move_camera_right(), done=lambda known: done.release())
+    dispatcher.started.wait()
+    for message in messages:
+        worker.submit(message, done=lambda known: done.release())
+    dispatcher.release.set()
+    for i in range(len(messages) + 1):
+        done.acquire()
+    worker.close()
+    return dispatcher.executed[1:]
+
+
+def main():
+    """
+    A STOP overtakes the pending commands, so it must take the drive and speed commands out of pending batches, or the
+    car drives off after it stopped. Run from the repository root with PYTHONPATH=.
+    """
+    executed = run([PICommunication.batch([PICommunication.set_medium_speed(), PICommunication.move_forward()]),
+                    PICommunication.stop()])
+    print("batch, stop:", executed)
+    assert executed == ["STOP"], executed
+
+    executed = run([PICommunication.batch([PICommunication.move_forward(), PICommunication.move_camera_up()]),
+                    PICommunication.stop()])
+    print("batch with a camera step, stop:", executed)
+    assert executed == ["STOP", "CAMERA_UP"], executed
+
+    executed = run([PICommunication.stop(), PICommunication.batch([PICommunication.move_forward()])])
+    print("stop, batch:", executed)
+    assert executed == ["STOP", "MOVE_FORWARD"], executed
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import timeit
+from os import urandom
+
+from network.aes_utils import AESCipher, AESCTRHMACCipher
+from network.communication import BINARY_FRAME_HEADER
+from network.protocol import PICommunication
+
+MESSAGES = {
+    "move forward": PICommunication.move_forward(),
+    "turn right": PICommunication.turn_right(1.5),
+    "error": PICommunication.error("Unknown command"),
+    "1KB": PICommunication.error("x" * 1024),
+}
+REPEAT = 20000
+LEGACY_HEADER_SIZE = PICommunication.msg_size_header_size
+
+
+def main():
+    """
+    Compare bytes on the wire and microseconds per message (encrypt + decrypt) of the AES-CBC path with the legacy
+    ascii header against the AES-CTR+HMAC path with the binary header.
+    """
+    key = urandom(32)
+    cbc_cipher = AESCipher(key)
+    ctr_sender = AESCTRHMACCipher(key, False)
+    ctr_receiver = AESCTRHMACCipher(key, True)
+    header = bytes(BINARY_FRAME_HEADER.size)
+
+    print(f"{'message':<14}{'cbc bytes':>10}{'ctr bytes':>10}{'cbc us':>10}{'ctr us':>10}")
+    for name, message in MESSAGES.items():
+        payload = message[PICommunication.msg_code_size:]
+        cbc_bytes = LEGACY_HEADER_SIZE + len(cbc_cipher.encrypt(message))
+        ctr_bytes = BINARY_FRAME_HEADER.size + len(ctr_sender.encrypt(payload, header))
+
+        cbc_time = timeit.timeit(lambda: cbc_cipher.decrypt(cbc_cipher.encrypt(message)), number=REPEAT)
+        ctr_time = timeit.timeit(lambda: ctr_receiver.decrypt(ctr_sender.encrypt(payload, header), header),
+                                 number=REPEAT)
+        cbc_us = cbc_time / REPEAT * 1e6
+        ctr_us = ctr_time / REPEAT * 1e6
+        print(f"{name:<14}{cbc_bytes:>10}{ctr_bytes:>10}{cbc_us:>10.1f}{ctr_us:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import socket
+
+from network.command_sender import CommandSender
+from network.protocol import PICommunication
+
+MessageCode = PICommunication.MessageCode
+
+
+class RecordingLane:
+    """
+    Records the codes of the commands sent over it, batched ones one by one, with the name of the lane.
+    """
+
+    def __init__(self, name, sent):
+        self.name = name
+        self.sent = sent
+
+    def send(self, message):
+        code = bytes(message[:PICommunication.msg_code_size])
+        if code == MessageCode.BATCH.value.encode():
+            for batched_message in PICommunication.split_batch(message[PICommunication.msg_code_size:]):
+                self.send(batched_message)
+            return
+        self.sent.append((self.name, MessageCode(code.decode()).name))
+
+    def send_by_size(self, message):
+        self.send(message)
+
+    def close(self):
+        pass
+
+
+def main():
+    """
+    Commands go over the tcp stream or the udp lane depending on their code, but a flush must still send them in the
+    order they were queued. Run from the repository root with PYTHONPATH=.
+    """
+    sent = []
+    sock, peer = socket.socketpair()
+    tcp_stream = RecordingLane("tcp", sent)
+    tcp_stream.sock = sock
+    udp_lane = RecordingLane("udp", sent)
+    # A long tick, so the commands are flushed together when STOP is queued.
+    sender = CommandSender(tcp_stream, tick=10, create_udp_lane=lambda stream: udp_lane)
+    sender.send(PICommunication.set_high_speed())
+    sender.send(PICommunication.move_forward())
+    sender.send(PICommunication.move_forward(1.5))
+    sender.send(PICommunication.move_camera_up())
+    sender.send(PICommunication.stop())
+    sender.close()
+    sock.close()
+    peer.close()
+    print("sent:", sent)
+    assert sent == [("udp", "HIGH_SPEED"), ("udp", "MOVE_FORWARD"), ("tcp", "MOVE_FORWARD"), ("udp", "CAMERA_UP"),
+                    ("tcp", "STOP")], sent
+
+
+if __name__ == '__main__':
+    main()